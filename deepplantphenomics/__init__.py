@@ -12,3 +12,4 @@ from deepplantphenomics.countception_object_counter_model import *
 from deepplantphenomics.heatmap_object_counting_model import *
 from deepplantphenomics.tools import *
 from deepplantphenomics.networks import *
+from deepplantphenomics.server import InferenceServer
@@ -50,7 +50,7 @@ class ClassificationModel(DPPModel):
                 self._graph_parse_data()
 
                 # Batch the datasets and create iterators for them
-                train_iter = self._batch_and_iterate(self._train_dataset, shuffle=True)
+                train_iter = self._batch_and_iterate(self._train_dataset, shuffle=True, augment=True)
                 if self._testing:
                     test_iter = self._batch_and_iterate(self._test_dataset)
                 if self._validation:
@@ -179,42 +179,41 @@ class ClassificationModel(DPPModel):
         is_correct = tf.equal(pred_idx, lab_idx)
         return pred_idx, is_correct
 
-    def _training_batch_results(self, batch_num, start_time, tqdm_range, train_writer=None):
+    def _training_batch_report_ops(self, with_summary=False):
+        report_ops = {'cost': self._graph_ops['cost'], 'accuracy': self._graph_ops['accuracy']}
+        if self._validation:
+            report_ops['val_accuracy'] = self._graph_ops['val_accuracy']
+        if with_summary:
+            report_ops['merged'] = self._graph_ops['merged']
+        return report_ops
+
+    def _training_batch_results(self, batch_num, start_time, tqdm_range, results, train_writer=None):
         elapsed = time.time() - start_time
+        samples_per_sec = self._batch_size / elapsed
 
         if train_writer is not None:
-            summary = self._session.run(self._graph_ops['merged'])
-            train_writer.add_summary(summary, batch_num)
+            train_writer.add_summary(results['merged'], batch_num)
 
         if self._validation:
-            loss, epoch_accuracy, epoch_val_accuracy = self._session.run([self._graph_ops['cost'],
-                                                                          self._graph_ops['accuracy'],
-                                                                          self._graph_ops['val_accuracy']])
-            samples_per_sec = self._batch_size / elapsed
-
             desc_str = "{}: Results for batch {} (epoch {:.1f}) " + \
                        "- Loss: {:.5f}, Training Accuracy: {:.4f}, Validation Accuracy: {:.4f}, samples/sec: {:.2f}"
             tqdm_range.set_description(
                 desc_str.format(datetime.datetime.now().strftime("%I:%M%p"),
                                 batch_num,
                                 batch_num / (self._total_training_samples / self._batch_size),
-                                loss,
-                                epoch_accuracy,
-                                epoch_val_accuracy,
+                                results['cost'],
+                                results['accuracy'],
+                                results['val_accuracy'],
                                 samples_per_sec))
         else:
-            loss, epoch_accuracy = self._session.run([self._graph_ops['cost'],
-                                                      self._graph_ops['accuracy']])
-            samples_per_sec = self._batch_size / elapsed
-
             desc_str = "{}: Results for batch {} (epoch {:.1f}) " + \
                        "- Loss: {:.5f}, Training Accuracy: {:.4f}, samples/sec: {:.2f}"
             tqdm_range.set_description(
                 desc_str.format(datetime.datetime.now().strftime("%I:%M%p"),
                                 batch_num,
                                 batch_num / (self._total_training_samples / self._batch_size),
-                                loss,
-                                epoch_accuracy,
+                                results['cost'],
+                                results['accuracy'],
                                 samples_per_sec))
 
     def compute_full_test_accuracy(self):
@@ -242,30 +241,7 @@ class ClassificationModel(DPPModel):
             return 1.0 - mean.astype(np.float32)
 
     def forward_pass_with_file_inputs(self, images):
-        with self._graph.as_default():
-            num_batches = len(images) // self._batch_size
-            if len(images) % self._batch_size != 0:
-                num_batches += 1
-
-            self._parse_images(images)
-            im_data = self._all_images.batch(self._batch_size).prefetch(1)
-            x_test = im_data.make_one_shot_iterator().get_next()
-
-            if self._load_from_saved:
-                self.load_state()
-
-            # Run model on them
-            x_pred = self.forward_pass(x_test, deterministic=True)
-
-            total_outputs = []
-            for i in range(int(num_batches)):
-                xx = self._session.run(x_pred)
-                for img in np.array_split(xx, xx.shape[0]):
-                    total_outputs.append(img)
-
-            total_outputs = np.concatenate(total_outputs, axis=0)
-
-        return total_outputs
+        return self._stack_inference_batches(len(images), self._forward_pass_batches(images))
 
     def forward_pass_with_interpreted_outputs(self, x):
         # Perform forward pass of the network to get raw outputs and apply a softmax
@@ -41,7 +41,7 @@ class CountCeptionModel(DPPModel):
                 self._graph_parse_data()
 
                 # Batch the datasets and create iterators for them
-                train_iter = self._batch_and_iterate(self._train_dataset, shuffle=True)
+                train_iter = self._batch_and_iterate(self._train_dataset, shuffle=True, augment=True)
                 if self._testing:
                     test_iter = self._batch_and_iterate(self._test_dataset)
                 if self._validation:
@@ -150,43 +150,41 @@ class CountCeptionModel(DPPModel):
         count_diff = tf.abs(pred_count - true_count)
         return pred_count, true_count, count_diff
 
-    def _training_batch_results(self, batch_num, start_time, tqdm_range, train_writer=None):
+    def _training_batch_report_ops(self, with_summary=False):
+        report_ops = {'cost': self._graph_ops['cost'], 'accuracy': self._graph_ops['accuracy']}
+        if self._validation:
+            report_ops['val_accuracy'] = self._graph_ops['val_accuracy']
+        if with_summary:
+            report_ops['merged'] = self._graph_ops['merged']
+        return report_ops
+
+    def _training_batch_results(self, batch_num, start_time, tqdm_range, results, train_writer=None):
         elapsed = time.time() - start_time
+        samples_per_sec = self._batch_size / elapsed
 
         if train_writer is not None:
-            summary = self._session.run(self._graph_ops['merged'])
-            train_writer.add_summary(summary, batch_num)
+            train_writer.add_summary(results['merged'], batch_num)
 
         if self._validation:
-            loss, epoch_accuracy, epoch_val_accuracy = self._session.run([self._graph_ops['cost'],
-                                                                          self._graph_ops['accuracy'],
-                                                                          self._graph_ops['val_accuracy']])
-            samples_per_sec = self._batch_size / elapsed
-
             desc_str = "{}: Results for batch {} (epoch {:.1f}) " + \
                        "- Loss: {:.5f}, Training Accuracy: {:.4f}, Validation Accuracy: {:.4f}, samples/sec: {:.2f}"
             tqdm_range.set_description(
                 desc_str.format(datetime.datetime.now().strftime("%I:%M%p"),
                                 batch_num,
                                 batch_num / (self._total_training_samples / self._batch_size),
-                                loss,
-                                epoch_accuracy,
-                                epoch_val_accuracy,
+                                results['cost'],
+                                results['accuracy'],
+                                results['val_accuracy'],
                                 samples_per_sec))
-
         else:
-            loss, epoch_accuracy = self._session.run([self._graph_ops['cost'],
-                                                      self._graph_ops['accuracy']])
-            samples_per_sec = self._batch_size / elapsed
-
             desc_str = "{}: Results for batch {} (epoch {:.1f}) " + \
                        "- Loss: {:.5f}, Training Accuracy: {:.4f}, samples/sec: {:.2f}"
             tqdm_range.set_description(
                 desc_str.format(datetime.datetime.now().strftime("%I:%M%p"),
                                 batch_num,
                                 batch_num / (self._total_training_samples / self._batch_size),
-                                loss,
-                                epoch_accuracy,
+                                results['cost'],
+                                results['accuracy'],
                                 samples_per_sec))
 
     def compute_full_test_accuracy(self):
@@ -225,30 +223,12 @@ class CountCeptionModel(DPPModel):
             self._log('Average test absolute difference: {:.3f}'.format(abs_diff_mean))
             return 1.0 - loss_mean.astype(np.float32), abs_diff_mean
 
-    def forward_pass_with_file_inputs(self, x):
-        with self._graph.as_default():
-            self._parse_images(x)
-
-            dataset_batch = self._all_images.batch(self._batch_size).prefetch(self._batch_size * 2)
-            iterator = dataset_batch.make_one_shot_iterator()
-            image_data = iterator.get_next()
-
-            if self._load_from_saved:
-                self.load_state()
+    def _inference_batch_outputs(self, xx):
+        # Each output is squeezed down to its non-trivial dimensions
+        return np.reshape(xx, (xx.shape[0],) + np.squeeze(xx[0]).shape)
 
-            # Run model on them
-            x_pred = self.forward_pass(image_data, deterministic=True)
-
-            total_outputs = []
-            try:
-                while True:
-                    x_pred_value = self._session.run(x_pred)
-                    for pr in x_pred_value:
-                        total_outputs.append(np.squeeze(pr))
-            except tf.errors.OutOfRangeError:
-                pass
-
-        return total_outputs
+    def forward_pass_with_file_inputs(self, x):
+        return self._stack_inference_batches(len(x), map(self._inference_batch_outputs, self._forward_pass_batches(x)))
 
     def forward_pass_with_interpreted_outputs(self, x):
         xx = self.forward_pass_with_file_inputs(x)
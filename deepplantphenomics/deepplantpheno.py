@@ -5,16 +5,98 @@ import tensorflow.contrib
 from tensorflow.python.client import device_lib
 import os
 import json
+import glob
+import hashlib
 import datetime
 import time
 import warnings
 import copy
 import math
 import random
+import multiprocessing
+import socket
+import pickle
+import shutil
+import functools
+import threading
+import collections
 from abc import ABC, abstractmethod
 from tqdm import tqdm
 
 
+# Local CPU clusters, by number of workers. A Tensorflow server can't be stopped once it's started, so a cluster is kept
+# for the life of the process and reused by any later training with the same number of workers (e.g. the next run of a
+# hyperparameter search) instead of leaking a server and its ports every time.
+_cpu_clusters = {}
+_CPU_CLUSTER_START_ATTEMPTS = 5
+_CPU_WORKER_START_TIMEOUT = 120
+
+
+def _free_local_ports(num_ports):
+    """
+    Lets the OS pick free ports on localhost. Another process can still take a port between it being picked here and
+    bound again by a server, so starting a server on it has to be able to fail and be retried.
+    :param num_ports: The number of ports to pick
+    :return: A list of port numbers
+    """
+    port_sockets = [socket.socket(socket.AF_INET, socket.SOCK_STREAM) for _ in range(num_ports)]
+    try:
+        for port_socket in port_sockets:
+            port_socket.bind(('localhost', 0))
+        return [port_socket.getsockname()[1] for port_socket in port_sockets]
+    finally:
+        for port_socket in port_sockets:
+            port_socket.close()
+
+
+def _run_cpu_worker(cluster, task_index, num_threads, started):
+    """Runs a worker for a local CPU cluster until it's terminated, setting an event once its server is up"""
+    config = tf.ConfigProto(intra_op_parallelism_threads=num_threads, inter_op_parallelism_threads=num_threads)
+    server = tf.train.Server(tf.train.ClusterSpec(cluster), job_name='worker', task_index=task_index, config=config)
+    started.set()
+    server.join()
+
+
+def _wait_for_cpu_workers(processes, events):
+    """
+    Waits for spawned CPU workers to start their servers
+    :param processes: The worker processes
+    :param events: The event each worker sets once its server is up
+    :return: True if every worker started, or False if any of them exited (e.g. because its port was taken) or timed out
+    """
+    deadline = time.time() + _CPU_WORKER_START_TIMEOUT
+    while not all(event.is_set() for event in events):
+        if time.time() > deadline or not all(process.is_alive() for process in processes):
+            return False
+        time.sleep(0.1)
+    return True
+
+
+def _run_hyperparameter_search_process(model_bytes, num_threads, base_tb_dir, cell):
+    """Trains a pickled model with one set of hyperparameters from a search, in a separate process"""
+    i, j, current_l2, current_lr = cell
+    model = pickle.loads(model_bytes)
+    model._num_session_threads = num_threads
+
+    # Several processes can't build the same image cache at once, so each process gets its own
+    if model._image_cache_dir is not None:
+        model._image_cache_dir = os.path.join(model._image_cache_dir, 'search_process_' + str(os.getpid()))
+
+    unaltered = (model._image_height, model._image_width, model._maximum_training_batches)
+    return i, j, model._train_hyperparameter_search_cell(current_l2, current_lr, base_tb_dir, unaltered)
+
+
+def _copy_layer_without_graph(layer):
+    """Makes a shallow copy of a layer (and any layers inside of it) with its graph components removed"""
+    layer = copy.copy(layer)
+    for name, value in list(vars(layer).items()):
+        if isinstance(value, (tf.Tensor, tf.Variable, tf.Operation)):
+            setattr(layer, name, None)
+        elif type(value).__module__ == layers.__name__:
+            setattr(layer, name, _copy_layer_without_graph(value))
+    return layer
+
+
 class DPPModel(ABC):
     """
     The DPPModel class represents a model which can either be trained, or loaded from an existing checkpoint file. It
@@ -27,6 +109,7 @@ class DPPModel(ABC):
     _supported_weight_initializers = ['normal', 'xavier']
     _supported_activation_functions = ['relu', 'tanh', 'lrelu', 'selu']
     _supported_pooling_types = ['max', 'avg']
+    _supported_patch_blending = ['uniform', 'linear', 'gaussian']
     _supported_loss_fns = ['softmax cross entropy', 'l2', 'l1', 'smooth l1', 'sigmoid cross entropy',
                            'yolo']
     _supported_predefined_models = ['vgg-16', 'alexnet', 'resnet-18', 'yolov2', 'xsmall', 'small', 'medium', 'large',
@@ -60,6 +143,11 @@ class DPPModel(ABC):
         self._validation = True
         self._testing = True
         self._hyper_param_search = False
+        self._warm_start_dir = None
+        self._final_validation_loss = None
+        self._max_checkpoints = 5
+        self._checkpoint_thread = None
+        self._checkpoint_error = None
 
         # Input options
         self._total_classes = 0
@@ -75,10 +163,16 @@ class DPPModel(ABC):
         self._image_depth = None
         self._patch_height = None
         self._patch_width = None
+        self._patch_overlap = 0
+        self._patch_blending = 'linear'
+        self._inference_output_file = None
+        self._inference_source = None
+        self._inference_paths = collections.deque()
         self._resize_bbox_coords = False
 
         self._crop_or_pad_images = False
         self._resize_images = False
+        self._image_cache_dir = None
 
         # Augmentation options
         self._augmentation_flip_horizontal = False
@@ -88,6 +182,7 @@ class DPPModel(ABC):
         self._augmentation_contrast = False
         self._augmentation_rotate = False
         self._rotate_crop_borders = False
+        self._batch_augmentation = False
 
         # Dataset storage
         self._all_ids = None
@@ -110,6 +205,10 @@ class DPPModel(ABC):
 
         self._images_only = False
 
+        self._records_dir = None
+        self._records_info = None
+        self._parse_from_records = False
+
         self._raw_image_files = None
         self._raw_test_image_files = None
         self._raw_train_image_files = None
@@ -172,8 +271,13 @@ class DPPModel(ABC):
 
         # Multi-threading and GPU
         self._num_threads = 1
+        self._fused_input_pipeline = False
+        self._input_stage_limit = None
         self._num_gpus = 1
         self._max_gpus = 1  # Set this properly below
+        self._num_cpu_workers = 1
+        self._num_session_threads = 0  # Let Tensorflow decide
+        self._cluster_server = None
         self._subbatch_size = self._batch_size
 
         # Now do actual initialization stuff
@@ -206,11 +310,42 @@ class DPPModel(ABC):
                     isinstance(layer, layers.convLayer) or isinstance(layer, layers.fullyConnectedLayer))
 
     def _reset_session(self):
-        self._session = tf.Session(graph=self._graph,
-                                   config=tf.ConfigProto(allow_soft_placement=True))
+        # Sessions connect to the local cluster instead of running in-process once CPU workers are started
+        target = self._cluster_server.target if self._cluster_server is not None else ''
+        self._session = tf.Session(target=target, graph=self._graph,
+                                   config=tf.ConfigProto(allow_soft_placement=True,
+                                                         intra_op_parallelism_threads=self._num_session_threads,
+                                                         inter_op_parallelism_threads=self._num_session_threads))
 
     def _reset_graph(self):
         self._graph = tf.Graph()
+        self._graph_ops = {}
+
+    def __getstate__(self):
+        """
+        Gets the model's settings, layers, and loaded data for pickling (e.g. to send the model to another process).
+        Tensors (such as labels) are evaluated into arrays, and the rest of the graph and the session are left out to be
+        rebuilt after unpickling.
+        """
+        state = dict(self.__dict__)
+        for key, value in state.items():
+            if isinstance(value, tf.Tensor):
+                state[key] = self._session.run(value)
+            elif isinstance(value, (tf.Graph, tf.Session, tf.Variable, tf.Operation, tf.data.Dataset,
+                                    tf.train.Server)):
+                state[key] = None
+
+        state['_graph_ops'] = {}
+        state['_checkpoint_thread'] = None
+        state['_inference_source'] = None
+        state['_inference_paths'] = collections.deque()
+        state['_layers'] = [_copy_layer_without_graph(layer) for layer in self._layers]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset_graph()
+        self._reset_session()
 
     def set_number_of_threads(self, num_threads):
         """Set number of threads for preprocessing tasks"""
@@ -221,6 +356,16 @@ class DPPModel(ABC):
 
         self._num_threads = num_threads
 
+    def set_fused_input_pipeline(self, fused):
+        """
+        Fuse the per-image loading and augmentation steps into single dataset maps and let Tensorflow tune their
+        parallelism and prefetching, instead of running each step as its own map with a fixed number of threads
+        """
+        if not isinstance(fused, bool):
+            raise TypeError("fused must be a bool")
+
+        self._fused_input_pipeline = fused
+
     def set_number_of_gpus(self, num_gpus):
         """Set the number of GPUs to use for graph evaluation. Setting this higher than the number of available GPUs
         has the same effect as setting this to exactly that amount (i.e. setting this to 4 with 2 GPUs available will
@@ -241,6 +386,39 @@ class DPPModel(ABC):
             raise RuntimeError("{0} GPUs can't evenly distribute a batch size of {1}"
                                .format(self._num_gpus, self._batch_size))
 
+    def set_number_of_cpu_workers(self, num_workers):
+        """
+        Set the number of local worker processes to split each training batch across when there are no GPUs. Each
+        worker runs the forward and backward passes on its share of the batch, and the gradients are averaged in the
+        main process, which also holds the input pipeline and the trainable parameters.
+        """
+        if not isinstance(num_workers, int):
+            raise TypeError("num_workers must be an int")
+        if num_workers <= 0:
+            raise ValueError("num_workers must be positive")
+        if self._cluster_server is not None:
+            raise RuntimeError("The number of CPU workers can't be changed after they have been started")
+
+        if self._max_gpus == 0:
+            if self._batch_size % num_workers != 0:
+                raise RuntimeError("{0} CPU workers can't evenly distribute a batch size of {1}"
+                                   .format(num_workers, self._batch_size))
+            self._subbatch_size = self._batch_size // num_workers
+
+        self._num_cpu_workers = num_workers
+
+    def set_maximum_checkpoints(self, max_to_keep):
+        """
+        Set how many of the most recent checkpoints to keep while training; older ones are deleted as new ones are
+        saved. Set this to 0 to keep every checkpoint.
+        """
+        if not isinstance(max_to_keep, int):
+            raise TypeError("max_to_keep must be an int")
+        if max_to_keep < 0:
+            raise ValueError("max_to_keep must be non-negative")
+
+        self._max_checkpoints = max_to_keep
+
     def set_random_seed(self, seed):
         """
         Sets a random seed for any random operations used during augmentation and training. This is used to help
@@ -270,6 +448,13 @@ class DPPModel(ABC):
             raise RuntimeError("{0} GPUs can't evenly distribute a batch size of {1}"
                                .format(self._num_gpus, size))
 
+        if self._max_gpus == 0:
+            if size % self._num_cpu_workers == 0:
+                self._subbatch_size = size // self._num_cpu_workers
+            else:
+                raise RuntimeError("{0} CPU workers can't evenly distribute a batch size of {1}"
+                                   .format(self._num_cpu_workers, size))
+
     def set_test_split(self, ratio):
         """Set a ratio for the total number of samples to use as a testing set"""
         if not isinstance(ratio, float) and ratio != 0:
@@ -350,6 +535,16 @@ class DPPModel(ABC):
 
         self._resize_images = resize
 
+    def set_image_cache_dir(self, cache_dir):
+        """
+        Cache the decoded (and resized) images in a directory during the first pass through each dataset, so that later
+        epochs and later training runs skip reading and decoding them. Pass None to turn caching off.
+        """
+        if cache_dir is not None and not isinstance(cache_dir, str):
+            raise TypeError("cache_dir must be a str or None")
+
+        self._image_cache_dir = cache_dir
+
     def set_augmentation_flip_horizontal(self, flip):
         """Randomly flip training images horizontally"""
         if not isinstance(flip, bool):
@@ -403,6 +598,16 @@ class DPPModel(ABC):
         self._augmentation_rotate = rot
         self._rotate_crop_borders = crop_borders
 
+    def set_batch_augmentation(self, batch):
+        """
+        Apply the flip, contrast, and rotation augmentations to whole batches of training images at once (with random
+        settings for each image) instead of to each image separately
+        """
+        if not isinstance(batch, bool):
+            raise TypeError("batch must be a bool")
+
+        self._batch_augmentation = batch
+
     def set_regularization_coefficient(self, lamb):
         """Set lambda for L2 weight decay"""
         if not isinstance(lamb, float):
@@ -481,6 +686,7 @@ class DPPModel(ABC):
         self._image_width = image_width
         self._image_height = image_height
         self._image_depth = image_depth
+        self._reset_inference_ops()
 
     def set_original_image_dimensions(self, image_height, image_width):
         """
@@ -520,6 +726,42 @@ class DPPModel(ABC):
         self._patch_height = height
         self._patch_width = width
         self._with_patching = True
+        self._reset_inference_ops()
+
+    def set_patch_overlap(self, overlap, blending='linear'):
+        """
+        Sets how much neighbouring patches overlap when images are split into patches for inference, and how the
+        overlapping outputs are blended together for models that stitch their outputs back into whole images
+        :param overlap: The number of pixels that neighbouring patches share along each side
+        :param blending: How to weight each patch's outputs when blending them. One of 'uniform' (a plain average),
+        'linear' (weights taper off linearly over the overlapping border), or 'gaussian' (weights fall off from the
+        patch centre)
+        """
+        if not isinstance(overlap, int):
+            raise TypeError("overlap must be an int")
+        if overlap < 0:
+            raise ValueError("overlap can't be negative")
+        if not isinstance(blending, str):
+            raise TypeError("blending must be a str")
+        if blending not in self._supported_patch_blending:
+            raise ValueError("'" + blending + "' is not one of the currently supported blending methods." +
+                             " Choose one of: " + " ".join("'" + x + "'" for x in self._supported_patch_blending))
+
+        self._patch_overlap = overlap
+        self._patch_blending = blending
+        self._reset_inference_ops()
+
+    def set_inference_output_file(self, filename):
+        """
+        Sets a .npy file for forward passes to write their raw outputs into. The outputs are streamed into a
+        memory-mapped array in the file one batch at a time, and the memory-mapped array is returned, so outputs larger
+        than the available memory can be produced. Set to None (the default) to keep outputs in memory.
+        :param filename: The path of the .npy file to write outputs to, or None
+        """
+        if filename is not None and not isinstance(filename, str):
+            raise TypeError("filename must be a str or None")
+
+        self._inference_output_file = filename
 
     def set_gen_data_overwrite(self, overwrite):
         """Sets whether to overwrite generated data like patches and object heatmaps when loading data or to load any
@@ -532,6 +774,8 @@ class DPPModel(ABC):
     def _get_device_list(self):
         """Returns the list of CPU and/or GPU devices to construct and evaluate graphs for"""
         if not tf.test.is_gpu_available():
+            if self._num_cpu_workers > 1:
+                return ['/job:worker/task:{0}/device:cpu:0'.format(i) for i in range(self._num_cpu_workers)]
             return ['/device:cpu:0']
         else:
             return ['/device:gpu:' + str(x) for x in range(self._num_gpus)]
@@ -545,6 +789,8 @@ class DPPModel(ABC):
         # can go on whatever device Tensorflow deems sensible.
         if tf.test.is_gpu_available() and self._num_gpus > 1:
             d = '/device:cpu:0'
+        elif self._num_cpu_workers > 1 and not tf.test.is_gpu_available():
+            d = '/job:worker/task:0/device:cpu:0'  # Keep the variables in the main process with the CPU workers
         else:
             d = None  # Effectively /device:cpu:0 for CPU-only or /device:gpu:0 for 1 GPU
 
@@ -558,7 +804,19 @@ class DPPModel(ABC):
         Add graph components that parse the input images and labels into tensors and split them into training,
         validation, and testing sets
         """
-        if self._raw_test_labels is not None:
+        if self._records_info is not None:
+            # The records were already split into partitions when they were written, so each partition's shards are
+            # passed along in place of its images
+            shards = {name: [os.path.join(self._records_dir, f) for f in partition['shards']]
+                      for name, partition in self._records_info['partitions'].items()}
+            self._parse_from_records = True
+            try:
+                self._parse_dataset(shards['train'], None, None,
+                                    shards.get('test'), None, None,
+                                    shards.get('val'), None, None)
+            finally:
+                self._parse_from_records = False
+        elif self._raw_test_labels is not None:
             # currently think of moderation features as None so they are passed in hard-coded
             self._parse_dataset(self._raw_train_image_files, self._raw_train_labels, None,
                                 self._raw_test_image_files, self._raw_test_labels, None,
@@ -600,6 +858,90 @@ class DPPModel(ABC):
                                      normalized=False, centered=False)
         return x, offsets
 
+    def _patch_tiling(self):
+        """
+        Works out how inference images are tiled with patches, based on the image, patch, and overlap sizes
+        :return: The number of patch rows and columns, and the vertical and horizontal strides between patches
+        """
+        if self._patch_overlap >= min(self._patch_height, self._patch_width):
+            raise RuntimeError("The patch overlap must be smaller than the patch size")
+
+        stride_h = self._patch_height - self._patch_overlap
+        stride_w = self._patch_width - self._patch_overlap
+        num_patch_rows = math.ceil(max(self._image_height - self._patch_height, 0) / stride_h) + 1
+        num_patch_cols = math.ceil(max(self._image_width - self._patch_width, 0) / stride_w) + 1
+        return num_patch_rows, num_patch_cols, stride_h, stride_w
+
+    def _patch_blend_weights(self):
+        """
+        Makes the weights for blending overlapping patch outputs together, as set by set_patch_overlap
+        :return: An ndarray with a weight for each pixel in a patch, with a trailing dimension for broadcasting
+        """
+        def weights_1d(size):
+            pos = np.arange(size, dtype=np.float32)
+            if self._patch_blending == 'linear':
+                # Ramp up over the overlapping border and stay flat in the middle. Weights never reach 0, so there's
+                # always something to normalize by at the image edges.
+                return np.minimum(np.minimum(pos + 1, size - pos) / (self._patch_overlap + 1), 1)
+            elif self._patch_blending == 'gaussian':
+                sigma = size / 4
+                return np.exp(-np.square(pos - (size - 1) / 2) / (2 * sigma ** 2))
+            else:
+                return np.ones(size, dtype=np.float32)
+
+        weights = np.outer(weights_1d(self._patch_height), weights_1d(self._patch_width))
+        return weights[..., np.newaxis].astype(np.float32)
+
+    def _allocate_inference_output(self, shape, dtype=np.float32):
+        """
+        Preallocates the array that inference outputs are written into. This is a memory-mapped .npy file if one was
+        set with set_inference_output_file.
+        :param shape: The shape of the full set of outputs
+        :param dtype: The data type of the outputs
+        :return: A zero-filled array to write outputs into
+        """
+        if self._inference_output_file is not None:
+            return np.lib.format.open_memmap(self._inference_output_file, mode='w+', dtype=dtype, shape=tuple(shape))
+        return np.zeros(shape, dtype=dtype)
+
+    def _stack_inference_batches(self, num_outputs, batch_outputs):
+        """
+        Writes batches of inference outputs into one preallocated array as they arrive, instead of concatenating them
+        at the end
+        :param num_outputs: The total number of outputs across all of the batches
+        :param batch_outputs: An iterable of ndarrays with the outputs for each batch, in order
+        :return: The array with all of the outputs
+        """
+        total_outputs = None
+        i = 0
+        for xx in batch_outputs:
+            if total_outputs is None:
+                total_outputs = self._allocate_inference_output((num_outputs,) + xx.shape[1:], xx.dtype)
+            total_outputs[i:i + xx.shape[0]] = xx
+            i += xx.shape[0]
+
+        return total_outputs
+
+    def _graph_tile_patches(self, x):
+        """
+        Adds graph components to split a batch of images into tiled patches for inference. Patches overlap by the
+        amount set by set_patch_overlap (none by default). The images are padded on the bottom and right sides as
+        needed to fit a whole number of patches.
+        :param x: Tensor, a batch of images to split into patches
+        :return: The patches, with all of the patches for one image consecutive and in row-major order
+        """
+        num_patch_rows, num_patch_cols, stride_h, stride_w = self._patch_tiling()
+        final_height = (num_patch_rows - 1) * stride_h + self._patch_height
+        final_width = (num_patch_cols - 1) * stride_w + self._patch_width
+
+        x = tf.image.pad_to_bounding_box(x, 0, 0, final_height, final_width)
+        sizes = [1, self._patch_height, self._patch_width, 1]
+        strides = [1, stride_h, stride_w, 1]
+        rates = [1, 1, 1, 1]
+        x = tf.image.extract_image_patches(x, sizes=sizes, strides=strides, rates=rates, padding="VALID")
+        x = tf.reshape(x, shape=[-1, self._patch_height, self._patch_width, self._image_depth])
+        return x
+
     def _graph_make_optimizer(self):
         """Generate a new optimizer object for computing and applying gradients"""
         if self._optimizer == 'adagrad':
@@ -757,59 +1099,76 @@ class DPPModel(ABC):
         """
         pass
 
-    def _batch_and_iterate(self, dataset, shuffle=False):
+    def _batch_and_iterate(self, dataset, shuffle=False, augment=False):
         """
         Sets up batching and prefetching for a Dataset, with optional shuffling (for training), and returns an iterator
         for the final Dataset.
         :param dataset: The Dataset to prepare with batching and prefetching
         :param shuffle: A flag for whether to shuffle the Dataset items
+        :param augment: A flag for whether to apply the training augmentations to each batch, when batch augmentation
+        is being used
         :return: A one-shot iterator for the prepared Dataset
         """
         if shuffle:
             dataset = dataset.shuffle(10000)
         dataset = dataset.batch(self._subbatch_size)
+        if augment and self._batch_augmentation:
+            parallel_calls = tf.data.experimental.AUTOTUNE if self._fused_input_pipeline else self._num_threads
+            dataset = dataset.map(self._parse_augment_batch, num_parallel_calls=parallel_calls)
         dataset = dataset.repeat()
-        dataset = dataset.prefetch(self._num_gpus)
+        if self._fused_input_pipeline:
+            dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+        else:
+            dataset = dataset.prefetch(self._num_gpus)
         data_iter = dataset.make_one_shot_iterator()
         return data_iter
 
-    def _training_batch_results(self, batch_num, start_time, tqdm_range, train_writer=None):
+    def _training_batch_report_ops(self, with_summary=False):
+        """
+        Gets the graph ops whose values are reported mid-training. These are fetched in the same session run as the
+        optimizer, since running them separately would pull another batch through the network.
+        :param with_summary: A flag for whether to also fetch the merged Tensorboard summaries
+        :return: A dict of the graph ops to fetch, keyed by the names expected by `_training_batch_results`
         """
-        Calculates and reports mid-training losses and other statistics, both through the console and through writing
-        Tensorboard log files
+        report_ops = {'cost': self._graph_ops['cost']}
+        if self._validation:
+            report_ops['val_cost'] = self._graph_ops['val_cost']
+        if with_summary:
+            report_ops['merged'] = self._graph_ops['merged']
+        return report_ops
+
+    def _training_batch_results(self, batch_num, start_time, tqdm_range, results, train_writer=None):
+        """
+        Reports mid-training losses and other statistics, both through the console and through writing Tensorboard
+        log files
         :param batch_num: The batch number for the mid-training results
         :param start_time: The start time to use for calculating the processing rate
         :param tqdm_range: A `tqdm` object for displaying training results to the console
+        :param results: A dict of the values fetched for the ops from `_training_batch_report_ops`
         :param train_writer: A `tf.summary.FileWriter` for writing Tensorboard log files
         """
         elapsed = time.time() - start_time
+        samples_per_sec = self._batch_size / elapsed
 
         if train_writer is not None:
-            summary = self._session.run(self._graph_ops['merged'])
-            train_writer.add_summary(summary, batch_num)
+            train_writer.add_summary(results['merged'], batch_num)
 
         if self._validation:
-            loss, epoch_test_loss = self._session.run([self._graph_ops['cost'], self._graph_ops['val_cost']])
-            samples_per_sec = self._batch_size / elapsed
-
             desc_str = "{}: Results for batch {} (epoch {:.1f}) - Loss: {}, Validation Loss: {}, samples/sec: {:.2f}"
             tqdm_range.set_description(
                 desc_str.format(datetime.datetime.now().strftime("%I:%M%p"),
                                 batch_num,
                                 batch_num / (self._total_training_samples / self._batch_size),
-                                loss,
-                                epoch_test_loss,
+                                results['cost'],
+                                results['val_cost'],
                                 samples_per_sec))
         else:
-            loss = self._session.run([self._graph_ops['cost']])
-            samples_per_sec = self._batch_size / elapsed
-
             desc_str = "{}: Results for batch {} (epoch {:.1f}) - Loss: {}, samples/sec: {:.2f}"
             tqdm_range.set_description(
                 desc_str.format(datetime.datetime.now().strftime("%I:%M%p"),
                                 batch_num,
                                 batch_num / (self._total_training_samples / self._batch_size),
-                                loss,
+                                results['cost'],
                                 samples_per_sec))
 
     def begin_training(self, return_test_loss=False):
@@ -819,10 +1178,14 @@ class DPPModel(ABC):
         session is shut down. Before calling this function, the images and labels should be loaded, as well as all
         relevant hyper-parameters.
         """
+        if self._num_cpu_workers > 1 and self._max_gpus == 0:
+            self._start_cpu_workers()
+
         with self._graph.as_default():
             self._lr_epoch = tf.Variable(0, trainable=False)
             self._set_learning_rate()
             self._assemble_graph()
+            self._get_saver()
             self._log('Assembled the graph')
 
             # Either load the network parameters from a checkpoint file or start training
@@ -832,12 +1195,18 @@ class DPPModel(ABC):
                 self.compute_full_test_accuracy()
                 self.shut_down()
             else:
+                train_writer = None
                 if self._tb_dir is not None:
                     train_writer = tf.summary.FileWriter(self._tb_dir, self._session.graph)
 
                 self._log('Initializing parameters...')
                 self._session.run(tf.global_variables_initializer())
 
+                if self._warm_start_dir is not None:
+                    self._log('Continuing training from the checkpoint in ' + self._warm_start_dir)
+                    self._get_saver().restore(
+                        self._session, tf.train.latest_checkpoint(os.path.join(self._warm_start_dir, 'saved_state')))
+
                 self._log('Beginning training...')
 
                 # Needed for batch norm
@@ -852,19 +1221,24 @@ class DPPModel(ABC):
                 for i in tqdm_range:
                     start_time = time.time()
                     self._global_epoch = i
-                    self._session.run(self._graph_ops['optimizer'])
+                    is_report_batch = self._global_epoch > 0 and self._global_epoch % self._report_rate == 0
+
+                    # The loss (and any reported metrics) come from the same run as the gradient update; running them
+                    # separately would do another forward pass on a fresh batch from the input pipeline
+                    if is_report_batch:
+                        fetches = self._training_batch_report_ops(with_summary=train_writer is not None)
+                    else:
+                        fetches = {'cost': self._graph_ops['cost']}
+                    fetches['optimizer'] = self._graph_ops['optimizer']
+                    results = self._session.run(fetches)
+                    loss = results['cost']
 
-                    if self._global_epoch > 0 and self._global_epoch % self._report_rate == 0:
-                        if self._tb_dir is not None:
-                            self._training_batch_results(i, start_time, tqdm_range, train_writer)
-                        else:
-                            self._training_batch_results(i, start_time, tqdm_range)
+                    if is_report_batch:
+                        self._training_batch_results(i, start_time, tqdm_range, results, train_writer)
 
                         if self._save_checkpoints and self._global_epoch % (self._report_rate * 100) == 0:
-                            self.save_state(self._save_dir)
+                            self._save_state_in_background(self._save_dir)
                     else:
-                        loss = self._session.run([self._graph_ops['cost']])
-
                         if False:
                             self._session.run(decay_ops)
 
@@ -877,6 +1251,9 @@ class DPPModel(ABC):
 
                 self.save_state(self._save_dir)
 
+                if self._hyper_param_search and self._validation:
+                    self._final_validation_loss = self._compute_validation_loss()
+
                 final_test_loss = None
                 if self._testing:
                     final_test_loss = self.compute_full_test_accuracy()
@@ -888,22 +1265,198 @@ class DPPModel(ABC):
                 else:
                     return
 
-    def begin_training_with_hyperparameter_search(self, l2_reg_limits=None, lr_limits=None, num_steps=3):
+    def begin_training_with_hyperparameter_search(self, l2_reg_limits=None, lr_limits=None, num_steps=3,
+                                                  num_processes=1):
         """
         Performs grid-based hyper-parameter search given the ranges passed. Parameters are optional.
 
         :param l2_reg_limits: array representing a range of L2 regularization coefficients in the form [low, high]
         :param lr_limits: array representing a range of learning rates in the form [low, high]
         :param num_steps: the size of the grid. Larger numbers are exponentially slower.
-        """
+        :param num_processes: the number of grid cells to train at once, each in its own process with an even share of
+        the CPU threads
+        """
+        if not isinstance(num_processes, int):
+            raise TypeError("num_processes must be an int")
+        if num_processes <= 0:
+            raise ValueError("num_processes must be positive")
+        if num_processes > 1 and self._num_cpu_workers > 1 and self._max_gpus == 0:
+            # The search's processes are daemons, which can't start CPU worker processes of their own
+            raise RuntimeError("CPU workers can't be used when training several runs at once. Use num_processes=1 or "
+                               "set_number_of_cpu_workers(1).")
+
         self._hyper_param_search = True
 
         base_tb_dir = self._tb_dir
 
+        unaltered = (self._image_height, self._image_width, self._maximum_training_batches)
+
+        all_l2_reg, all_lr = self._hyperparameter_grid(l2_reg_limits, lr_limits, num_steps)
+
+        all_loss_results = np.empty([len(all_l2_reg), len(all_lr)])
+        cells = [(i, j, current_l2, current_lr)
+                 for i, current_l2 in enumerate(all_l2_reg) for j, current_lr in enumerate(all_lr)]
+
+        if num_processes == 1:
+            for i, j, current_l2, current_lr in cells:
+                all_loss_results[i][j] = self._train_hyperparameter_search_cell(current_l2, current_lr, base_tb_dir,
+                                                                                unaltered)
+        else:
+            # Make the partition mask once up front, so that every process trains and tests on the same split instead
+            # of racing to write their own
+            if self._records_info is None and self._raw_test_labels is None and self._raw_labels is not None:
+                raw_labels = self._raw_labels
+                if isinstance(raw_labels, tf.Tensor):
+                    raw_labels = self._session.run(raw_labels)
+                n_aug = len(self._training_augmentation_labels) \
+                    if self._training_augmentation_images is not None else 0
+                loaders._get_split_mask(self._test_split, self._validation_split, len(raw_labels), n_aug,
+                                        self._force_split_partition)
+
+            force_split_partition = self._force_split_partition
+            self._force_split_partition = False
+            model_bytes = pickle.dumps(self)
+            self._force_split_partition = force_split_partition
+
+            num_threads = max((os.cpu_count() or 1) // num_processes, 1)
+            self._log('HYPERPARAMETER SEARCH: Training {0} runs at once with {1} threads each'
+                      .format(num_processes, num_threads))
+
+            run_cell = functools.partial(_run_hyperparameter_search_process, model_bytes, num_threads, base_tb_dir)
+            with multiprocessing.get_context('spawn').Pool(num_processes) as pool:
+                for i, j, current_loss in pool.imap_unordered(run_cell, cells):
+                    self._log('HYPERPARAMETER SEARCH: Finished l2reg=%f, lr=%f with loss %f'
+                              % (all_l2_reg[i], all_lr[j], current_loss))
+                    all_loss_results[i][j] = current_loss
+
+        self._log('Finished hyperparameter search, failed runs will appear as NaN.')
+        self._log('All l2 coef. tested:')
+        self._log('\n'+np.array2string(np.transpose(all_l2_reg)))
+        self._log('All learning rates tested:')
+        self._log('\n'+np.array2string(all_lr))
+        self._log('Loss/error grid:')
+        self._log('\n'+np.array2string(all_loss_results, precision=4))
+
+    def begin_training_with_successive_halving(self, l2_reg_limits=None, lr_limits=None, num_steps=3,
+                                               reduction_factor=3, search_dir='./hyperparameter_search'):
+        """
+        Performs hyper-parameter search over the same grid as begin_training_with_hyperparameter_search, but stops poor
+        settings early. Every setting is first trained for a short time, then only the best 1/reduction_factor of them
+        (by validation loss) continue training, and so on until the best setting is trained for the full number of
+        epochs. Progress is saved in search_dir, and calling this again with the same arguments resumes the search.
+
+        :param l2_reg_limits: array representing a range of L2 regularization coefficients in the form [low, high]
+        :param lr_limits: array representing a range of learning rates in the form [low, high]
+        :param num_steps: the size of the grid
+        :param reduction_factor: the factor to cut the number of settings down by after each round of training
+        :param search_dir: the directory to save the search's progress and each setting's checkpoints in
+        :return: the L2 regularization coefficient and learning rate with the best validation loss
+        """
+        if not isinstance(reduction_factor, int):
+            raise TypeError("reduction_factor must be an int")
+        if reduction_factor < 2:
+            raise ValueError("reduction_factor must be at least 2")
+        if not isinstance(search_dir, str):
+            raise TypeError("search_dir must be a str")
+        if not self._validation:
+            raise RuntimeError("Successive halving needs a validation set to compare settings with")
+
+        self._hyper_param_search = True
+
+        base_tb_dir = self._tb_dir
         unaltered_image_height = self._image_height
         unaltered_image_width = self._image_width
         unaltered_epochs = self._maximum_training_batches
 
+        all_l2_reg, all_lr = self._hyperparameter_grid(l2_reg_limits, lr_limits, num_steps)
+        configs = [[float(current_l2), float(current_lr)] for current_l2 in all_l2_reg for current_lr in all_lr]
+
+        # Each round trains for about reduction_factor times as many epochs as the last, ending with the full epochs.
+        # Rounds end on whole epochs and each trains for at least one more, so there can't be more rounds than epochs.
+        num_rounds = min(int(math.floor(math.log(len(configs), reduction_factor) + 1e-9)) + 1, unaltered_epochs)
+        round_epochs = [unaltered_epochs]
+        for r in reversed(range(num_rounds - 1)):
+            epochs = int(round(unaltered_epochs * reduction_factor ** (r - num_rounds + 1)))
+            round_epochs.insert(0, min(max(epochs, r + 1), round_epochs[0] - 1))
+
+        # Pick up where a previous run of the same search left off
+        state_file = os.path.join(search_dir, 'search_state.json')
+        state = {'configs': configs, 'round_epochs': round_epochs, 'round': 0,
+                 'remaining': list(range(len(configs))), 'losses': {}}
+        if os.path.isfile(state_file):
+            with open(state_file, 'r') as f:
+                saved_state = json.load(f)
+            if saved_state['configs'] == configs and saved_state['round_epochs'] == round_epochs:
+                self._log('HYPERPARAMETER SEARCH: Resuming search from ' + state_file)
+                state = saved_state
+            else:
+                warnings.warn('Ignoring the saved search state in {0}, which is for a different search'
+                              .format(search_dir))
+        elif not os.path.isdir(search_dir):
+            os.makedirs(search_dir)
+
+        def save_search_state():
+            # Write to a temporary file first so a crash can't leave a half-written state file behind
+            with open(state_file + '.tmp', 'w') as f:
+                json.dump(state, f, indent=4)
+            os.replace(state_file + '.tmp', state_file)
+
+        while True:
+            r = state['round']
+            for idx in state['remaining']:
+                if str(idx) in state['losses']:
+                    continue  # Already trained in this round before the search was interrupted
+
+                current_l2, current_lr = configs[idx]
+                round_dir = os.path.join(search_dir, 'config_{0}'.format(idx), 'round_{0}'.format(r))
+                if not os.path.isdir(round_dir):
+                    os.makedirs(round_dir)
+
+                # Continue training each setting from its checkpoint from the end of the last round. Each round saves
+                # into its own directory, so a checkpoint from partway through an interrupted round is never used.
+                self._save_dir = round_dir
+                self._warm_start_dir = os.path.join(search_dir, 'config_{0}'.format(idx), 'round_{0}'.format(r - 1)) \
+                    if r > 0 else None
+                epochs = round_epochs[r] - (round_epochs[r - 1] if r > 0 else 0)
+                unaltered = (unaltered_image_height, unaltered_image_width, epochs)
+
+                self._final_validation_loss = np.nan
+                self._train_hyperparameter_search_cell(np.float64(current_l2), np.float64(current_lr), base_tb_dir,
+                                                       unaltered)
+                loss = float(self._final_validation_loss)
+                self._log('HYPERPARAMETER SEARCH: l2reg=%f, lr=%f has validation loss %f after %s epochs'
+                          % (current_l2, current_lr, loss, round_epochs[r]))
+
+                state['losses'][str(idx)] = loss
+                save_search_state()
+
+            # Failed runs have a NaN loss and are dropped first
+            ranked = sorted(state['remaining'],
+                            key=lambda i: state['losses'][str(i)] if not np.isnan(state['losses'][str(i)]) else np.inf)
+            if r == num_rounds - 1 or len(ranked) == 1:
+                break
+
+            state['remaining'] = ranked[:max(len(ranked) // reduction_factor, 1)]
+            state['round'] = r + 1
+            state['losses'] = {}
+            save_search_state()
+
+        self._warm_start_dir = None
+        best_l2, best_lr = configs[ranked[0]]
+        self._log('Finished hyperparameter search, failed runs will appear as NaN.')
+        self._log('Final validation losses:')
+        for i in ranked:
+            self._log('l2reg=%f, lr=%f: %f' % (configs[i][0], configs[i][1], state['losses'][str(i)]))
+        self._log('Best settings are l2reg=%f, lr=%f, with their checkpoint in %s'
+                  % (best_l2, best_lr, os.path.join(search_dir, 'config_{0}'.format(ranked[0]), 'round_{0}'.format(r))))
+
+        return best_l2, best_lr
+
+    def _hyperparameter_grid(self, l2_reg_limits, lr_limits, num_steps):
+        """
+        Gets the values to search over for each hyperparameter
+        :return: The L2 regularization coefficients and learning rates to search over
+        """
         if l2_reg_limits is None:
             all_l2_reg = [self._reg_coeff]
         else:
@@ -918,48 +1471,51 @@ class DPPModel(ABC):
             all_lr = np.arange(lr_limits[0], lr_limits[1], step_size)
             all_lr = np.append(all_lr, lr_limits[1])
 
-        all_loss_results = np.empty([len(all_l2_reg), len(all_lr)])
+        return all_l2_reg, all_lr
 
-        for i, current_l2 in enumerate(all_l2_reg):
-            for j, current_lr in enumerate(all_lr):
-                self._log('HYPERPARAMETER SEARCH: Doing l2reg=%f, lr=%f' % (current_l2, current_lr))
+    def _compute_validation_loss(self):
+        """Computes the average validation loss over (about) one pass through the validation set"""
+        num_batches = max(int(math.ceil(self._total_validation_samples / self._subbatch_size)), 1)
+        losses = [self._session.run(self._graph_ops['val_cost']) for _ in range(num_batches)]
+        return float(np.mean(losses))
 
-                # Make a new graph, associate a new session with it.
-                self._reset_graph()
-                self._reset_session()
+    def _train_hyperparameter_search_cell(self, current_l2, current_lr, base_tb_dir, unaltered):
+        """
+        Trains the model from scratch with one set of hyperparameters from a hyperparameter search
+        :param current_l2: The L2 regularization coefficient to use
+        :param current_lr: The learning rate to use
+        :param base_tb_dir: The Tensorboard directory to put this run's logs next to, or None
+        :param unaltered: The (image height, image width, maximum training batches) from before any training, which
+        training changes and so need to be set back
+        :return: The test loss after training, or NaN if training failed
+        """
+        self._log('HYPERPARAMETER SEARCH: Doing l2reg=%f, lr=%f' % (current_l2, current_lr))
 
-                self._learning_rate = current_lr
-                self._reg_coeff = current_l2
+        # Make a new graph, associate a new session with it.
+        self._reset_graph()
+        self._reset_session()
 
-                # Set calculated variables back to their unaltered form
-                self._image_height = unaltered_image_height
-                self._image_width = unaltered_image_width
-                self._maximum_training_batches = unaltered_epochs
+        self._learning_rate = current_lr
+        self._reg_coeff = current_l2
 
-                # Reset the reg. coef. for all fc layers.
-                with self._graph.as_default():
-                    for layer in self._layers:
-                        if isinstance(layer, layers.fullyConnectedLayer):
-                            layer.regularization_coefficient = current_l2
+        # Set calculated variables back to their unaltered form
+        self._image_height, self._image_width, self._maximum_training_batches = unaltered
 
-                if base_tb_dir is not None:
-                    self._tb_dir = base_tb_dir + '_lr:' + current_lr.astype('str') + '_l2:' + current_l2.astype('str')
+        # Reset the reg. coef. for all fc layers.
+        with self._graph.as_default():
+            for layer in self._layers:
+                if isinstance(layer, layers.fullyConnectedLayer):
+                    layer.regularization_coefficient = current_l2
 
-                try:
-                    current_loss = self.begin_training(return_test_loss=True)
-                    all_loss_results[i][j] = current_loss
-                except Exception as e:
-                    self._log('HYPERPARAMETER SEARCH: Run threw an exception, this result will be NaN.')
-                    print("Exception message: "+str(e))
-                    all_loss_results[i][j] = np.nan
+        if base_tb_dir is not None:
+            self._tb_dir = base_tb_dir + '_lr:' + current_lr.astype('str') + '_l2:' + current_l2.astype('str')
 
-        self._log('Finished hyperparameter search, failed runs will appear as NaN.')
-        self._log('All l2 coef. tested:')
-        self._log('\n'+np.array2string(np.transpose(all_l2_reg)))
-        self._log('All learning rates tested:')
-        self._log('\n'+np.array2string(all_lr))
-        self._log('Loss/error grid:')
-        self._log('\n'+np.array2string(all_loss_results, precision=4))
+        try:
+            return self.begin_training(return_test_loss=True)
+        except Exception as e:
+            self._log('HYPERPARAMETER SEARCH: Run threw an exception, this result will be NaN.')
+            print("Exception message: "+str(e))
+            return np.nan
 
     @abstractmethod
     def compute_full_test_accuracy(self):
@@ -972,7 +1528,63 @@ class DPPModel(ABC):
     def shut_down(self):
         """End the current session. The model cannot be used anymore after this is done."""
         self._log('Shutdown requested, ending session...')
+        self._wait_for_checkpoint()
+        self._session.close()
+
+        if self._cluster_server is not None:
+            # The cluster stays up to be reused, but the variables this model left on it are freed
+            tf.Session.reset(self._cluster_server.target)
+            self._cluster_server = None
+
+    def _start_cpu_workers(self):
+        """
+        Starts a cluster of CPU worker processes on this machine, with this process as the first worker, and connects
+        the session to it. A cluster with the same number of workers that was started earlier in this process is
+        reused. Nothing is done if the workers were already started.
+        """
+        if self._cluster_server is not None:
+            return
+        if self._num_cpu_workers not in _cpu_clusters:
+            num_threads = max((os.cpu_count() or 1) // self._num_cpu_workers, 1)
+            config = tf.ConfigProto(intra_op_parallelism_threads=num_threads, inter_op_parallelism_threads=num_threads)
+            self._log('Starting {0} CPU workers with {1} threads each'.format(self._num_cpu_workers, num_threads))
+
+            # Workers are spawned rather than forked, since Tensorflow's runtime can't be safely forked. They're
+            # daemons, so they end with this process.
+            context = multiprocessing.get_context('spawn')
+            for _ in range(_CPU_CLUSTER_START_ATTEMPTS):
+                cluster = {'worker': ['localhost:{0}'.format(port)
+                                      for port in _free_local_ports(self._num_cpu_workers)]}
+                processes = []
+                events = []
+                for task_index in range(1, self._num_cpu_workers):
+                    events.append(context.Event())
+                    processes.append(context.Process(target=_run_cpu_worker, daemon=True,
+                                                     args=(cluster, task_index, num_threads, events[-1])))
+                    processes[-1].start()
+
+                # This process's server is only started once the others are up, so a failed attempt doesn't leave a
+                # server behind here
+                if _wait_for_cpu_workers(processes, events):
+                    try:
+                        _cpu_clusters[self._num_cpu_workers] = tf.train.Server(tf.train.ClusterSpec(cluster),
+                                                                               job_name='worker', task_index=0,
+                                                                               config=config)
+                        break
+                    except tf.errors.OpError:
+                        pass
+
+                self._log('A CPU worker could not start its server, trying again with new ports')
+                for process in processes:
+                    process.terminate()
+                    process.join()
+            else:
+                raise RuntimeError("The CPU workers could not be started after {0} attempts"
+                                   .format(_CPU_CLUSTER_START_ATTEMPTS))
+
+        self._cluster_server = _cpu_clusters[self._num_cpu_workers]
         self._session.close()
+        self._reset_session()
 
     def _get_weights_as_image(self, kernel, size=None):
         """Filter visualization, adapted with permission from https://gist.github.com/kukuruza/03731dc494603ceab0c5"""
@@ -1025,6 +1637,15 @@ class DPPModel(ABC):
 
     def save_state(self, directory=None):
         """Save all trainable variables as a checkpoint in the current working path"""
+        self._save_state_in_background(directory)
+        self._wait_for_checkpoint()
+
+    def _save_state_in_background(self, directory=None):
+        """
+        Saves all of the variables as a checkpoint without waiting for it to be written. The variables are copied in the
+        graph first, then a background thread writes the copies while training continues.
+        :param directory: The directory to put the saved_state checkpoint directory in, or None for the current one
+        """
         self._log('Saving parameters...')
 
         if directory is None:
@@ -1035,12 +1656,60 @@ class DPPModel(ABC):
         if not os.path.isdir(state_dir):
             os.mkdir(state_dir)
 
-        with self._graph.as_default():
-            saver = tf.train.Saver(tf.global_variables())
-            saver.save(self._session, state_dir + '/tfhSaved')
+        # The copies can't be changed until the last checkpoint has finished writing them
+        self._wait_for_checkpoint()
+        self._get_saver()
+        self._session.run(self._graph_ops['checkpoint_snapshot'])
+
+        def write_checkpoint(saver, session, step):
+            try:
+                saver.save(session, state_dir + '/tfhSaved', global_step=step)
+            except Exception as e:
+                self._checkpoint_error = e
+
+        self._checkpoint_thread = threading.Thread(target=write_checkpoint,
+                                                   args=(self._graph_ops['checkpoint_saver'], self._session,
+                                                         self._global_epoch))
+        self._checkpoint_thread.start()
 
         self._has_trained = True
 
+    def _wait_for_checkpoint(self):
+        """Waits for any checkpoint being written in the background to finish, and raises any error from writing it"""
+        if self._checkpoint_thread is not None:
+            self._checkpoint_thread.join()
+            self._checkpoint_thread = None
+
+        if self._checkpoint_error is not None:
+            error = self._checkpoint_error
+            self._checkpoint_error = None
+            raise error
+
+    def _get_saver(self):
+        """
+        Gets the Saver for restoring the model's variables, creating it (along with the ops for saving checkpoints in
+        the background) the first time it's needed for the current graph
+        :return: The Saver for the model's variables
+        """
+        with self._graph.as_default():
+            variables = tf.global_variables()
+            variable_names = [v.name for v in variables]
+            if self._graph_ops.get('saved_variables') != variable_names:
+                self._graph_ops['saved_variables'] = variable_names
+                self._graph_ops['saver'] = tf.train.Saver(variables, max_to_keep=self._max_checkpoints)
+
+                # Checkpoints are written from copies of the variables so that training can keep updating them. The
+                # copies are saved under the original names, so the checkpoints restore like normal.
+                with tf.name_scope('checkpoint_snapshot'), tf.device('/device:cpu:0'):
+                    copies = [tf.Variable(tf.zeros(v.shape, dtype=v.dtype.base_dtype), trainable=False,
+                                          collections=[]) for v in variables]
+                    self._graph_ops['checkpoint_snapshot'] = tf.group(
+                        [tf.assign(c, v) for c, v in zip(copies, variables)])
+                self._graph_ops['checkpoint_saver'] = tf.train.Saver(
+                    {v.op.name: c for v, c in zip(variables, copies)}, max_to_keep=self._max_checkpoints)
+
+        return self._graph_ops['saver']
+
     def load_state(self):
         """
         Load all trainable variables from a checkpoint file specified from the load_from_saved parameter in the
@@ -1052,9 +1721,7 @@ class DPPModel(ABC):
         if self._load_from_saved is not False:
             self._log('Loading from checkpoint file...')
 
-            with self._graph.as_default():
-                saver = tf.train.Saver(tf.global_variables())
-                saver.restore(self._session, tf.train.latest_checkpoint(self._load_from_saved))
+            self._get_saver().restore(self._session, tf.train.latest_checkpoint(self._load_from_saved))
 
             self._has_trained = True
         else:
@@ -1107,6 +1774,108 @@ class DPPModel(ABC):
 
         return x
 
+    def _graph_inference_inputs(self, x):
+        """
+        Prepares a batch of parsed input images for the inference forward pass. Models which run inference on patches
+        of the input images override this.
+        :param x: Tensor, a batch of images parsed by `_parse_images`
+        :return: The batch of images (or patches) to run the forward pass on
+        """
+        return x
+
+    def _graph_inference_ops(self):
+        """
+        Builds the graph ops for inference with file inputs, unless they've already been built. The image filenames are
+        pulled from a Python iterator (see _forward_pass_path_batches) and the iterator is reinitialized for each set
+        of inputs, so repeated inference reuses the same ops and loaded weights instead of growing the graph.
+        """
+        if 'inference_output' in self._graph_ops:
+            return
+
+        with self._graph.as_default():
+            image_files = tf.data.Dataset.from_generator(self._inference_path_source, tf.string, tf.TensorShape([]))
+            self._parse_images(image_files)
+            im_data = self._all_images.batch(self._batch_size).prefetch(1)
+            data_iter = im_data.make_initializable_iterator()
+            x_test = self._graph_inference_inputs(data_iter.get_next())
+
+            if self._load_from_saved:
+                self.load_state()
+
+            self._graph_ops['inference_init'] = data_iter.initializer
+            self._graph_ops['inference_output'] = self.forward_pass(x_test, deterministic=True)
+
+    def _reset_inference_ops(self):
+        """
+        Drops the cached inference ops, so they're rebuilt with the current image and patch settings the next time
+        inference is run instead of tiling images the old way
+        """
+        self._graph_ops.pop('inference_init', None)
+        self._graph_ops.pop('inference_output', None)
+
+    def _inference_path_source(self):
+        """
+        A generator over the filenames currently being run through inference. Each filename is remembered as it goes
+        into the input pipeline, so the outputs coming out of the pipeline can be matched back up with them.
+        """
+        for path in self._inference_source:
+            self._inference_paths.append(path)
+            yield path
+
+    def _forward_pass_path_batches(self, paths):
+        """
+        Runs the inference forward pass on an iterable of image filenames, one batch at a time. The filenames are only
+        read as the input pipeline needs them, so they can be produced lazily. Images in the next batch are loaded
+        while the current batch runs through the network.
+        :param paths: An iterable of image filenames
+        :return: A generator of the filenames in each batch and an ndarray with the raw network outputs for the batch
+        """
+        self._graph_inference_ops()
+
+        self._inference_source = iter(paths)
+        self._inference_paths.clear()
+        self._session.run(self._graph_ops['inference_init'])
+        while True:
+            try:
+                xx = self._session.run(self._graph_ops['inference_output'])
+            except tf.errors.OutOfRangeError:
+                break
+
+            # Every batch but the last one is full, and the pipeline keeps the images in order
+            num_images = min(self._batch_size, len(self._inference_paths))
+            yield [self._inference_paths.popleft() for _ in range(num_images)], xx
+
+    def _forward_pass_batches(self, images):
+        """
+        Runs the inference forward pass on a list of image filenames, one batch at a time
+        :param images: A list of image filenames
+        :return: A generator of ndarrays with the raw network outputs for each batch of images, in order
+        """
+        for _, xx in self._forward_pass_path_batches(images):
+            yield xx
+
+    def _inference_batch_outputs(self, xx):
+        """
+        Turns the raw network outputs for a batch into the outputs for each image in it, as returned by
+        forward_pass_with_file_inputs. Models whose outputs need reshaping or stitching back together override this.
+        :param xx: ndarray with the raw network outputs for a batch
+        :return: ndarray with the outputs for each image in the batch
+        """
+        return xx
+
+    def forward_pass_with_file_stream(self, paths):
+        """
+        Get network outputs for a stream of image filenames, such as one fed by a directory watcher or a queue. Unlike
+        forward_pass_with_file_inputs, the filenames don't need to be known up front and outputs are produced as soon
+        as each batch is done, so memory use stays constant no matter how many images are run.
+
+        :param paths: An iterable of strings representing image filenames, which can be a generator
+        :return: A generator of (filename, output) pairs, with the same outputs as forward_pass_with_file_inputs
+        """
+        for batch_paths, xx in self._forward_pass_path_batches(paths):
+            for path, output in zip(batch_paths, self._inference_batch_outputs(xx)):
+                yield path, output
+
     @abstractmethod
     def forward_pass_with_file_inputs(self, x):
         """
@@ -2172,16 +2941,11 @@ class DPPModel(ABC):
             image_paths = [os.path.join(sd, name) for name in os.listdir(sd) if
                            os.path.isfile(os.path.join(sd, name)) & name.startswith('VIS_SV_')]
 
-            image_files = image_files + image_paths
+            image_files.extend(image_paths)
 
         # Put the image files in the order of the IDs (if there are any labels loaded)
-        sorted_paths = []
-
         if self._all_labels is not None:
-            for image_id in self._all_ids:
-                path = list(filter(lambda item: item.endswith(image_id), [p for p in image_files]))
-                assert len(path) == 1, 'Found no image or multiple images for %r' % image_id
-                sorted_paths.append(path[0])
+            sorted_paths = loaders.match_ids_to_files(self._all_ids, image_files, whole_names=False)
         else:
             sorted_paths = image_files
 
@@ -2233,13 +2997,8 @@ class DPPModel(ABC):
                        os.path.isfile(os.path.join(im_dir, name)) & name.endswith('.png')]
 
         # Put the image files in the order of the IDs (if there are any labels loaded)
-        sorted_paths = []
-
         if self._all_labels is not None:
-            for image_id in self._all_ids:
-                path = list(filter(lambda item: item.endswith('/' + image_id), [p for p in image_files]))
-                assert len(path) == 1, 'Found no image or multiple images for %r' % image_id
-                sorted_paths.append(path[0])
+            sorted_paths = loaders.match_ids_to_files(self._all_ids, image_files)
         else:
             sorted_paths = image_files
 
@@ -2271,12 +3030,7 @@ class DPPModel(ABC):
 
         labels, ids = loaders.read_csv_labels_and_ids(labels_file, column_number, id_column_number)
 
-        sorted_paths = []
-
-        for image_id in ids:
-            path = list(filter(lambda item: item.endswith('/' + image_id), [p for p in image_files]))
-            assert len(path) == 1, 'Found no image or multiple images for %r' % image_id
-            sorted_paths.append(path[0])
+        sorted_paths = loaders.match_ids_to_files(ids, image_files)
 
         self._training_augmentation_images = sorted_paths
         self._training_augmentation_labels = labels
@@ -2332,6 +3086,106 @@ class DPPModel(ABC):
                 boxes.append([x_min, x_max, y_min, y_max])
             self._all_labels.append(boxes)
 
+    def save_dataset_to_records(self, dirname, num_shards=16):
+        """
+        Writes the loaded dataset into sharded TFRecord files, which can be read much faster than many small image files
+        using load_dataset_from_records. The dataset is split into training, testing, and validation partitions with
+        the current split settings before being written, and those partitions are kept when loading it back in.
+        :param dirname: The directory to write the record files and their description into
+        :param num_shards: The maximum number of record files to split each partition into
+        """
+        if not isinstance(dirname, str):
+            raise TypeError("dirname must be a str")
+        if not isinstance(num_shards, int):
+            raise TypeError("num_shards must be an int")
+        if num_shards <= 0:
+            raise ValueError("num_shards must be positive")
+        if self._raw_labels is None and self._raw_train_labels is None:
+            raise RuntimeError("A labelled dataset needs to be loaded before it can be written to records")
+        if self._has_moderation:
+            raise RuntimeError("Datasets with moderation features can't be written to records")
+
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        info = {'model': type(self).__name__, 'num_classes': self._total_classes, 'partitions': {}}
+        for name, (images, labels) in self._get_raw_partitions().items():
+            if images is None or len(images) == 0:
+                continue
+            self._log('Writing {0} {1} samples to records'.format(len(images), name))
+            partition = loaders.write_records_shards(dirname, name, images, labels, num_shards)
+
+            for kind in ['image_kind', 'label_kind']:
+                if info.setdefault(kind, partition[kind]) != partition[kind]:
+                    raise ValueError("The {0} partition stores its {1} differently from the other partitions"
+                                     .format(name, kind.split('_')[0] + 's'))
+            for shape in ['image_shape', 'label_shape']:
+                if info.setdefault(shape, partition[shape]) != partition[shape]:
+                    info[shape] = None
+            info['partitions'][name] = {'shards': partition['shards'], 'num_samples': partition['num_samples']}
+
+        with open(os.path.join(dirname, 'dataset_info.json'), 'w') as f:
+            json.dump(info, f, indent=4)
+
+    def _get_raw_partitions(self):
+        """
+        Splits the raw images and labels into training, testing, and validation partitions outside of the model's graph
+        :return: A dict mapping 'train', 'test', and 'val' to (images, labels) tuples; missing partitions are None
+        """
+        def _evaluate(data):
+            return self._session.run(data) if isinstance(data, tf.Tensor) else data
+
+        if self._raw_test_labels is not None:
+            return {'train': (self._raw_train_image_files, _evaluate(self._raw_train_labels)),
+                    'test': (self._raw_test_image_files, _evaluate(self._raw_test_labels)),
+                    'val': (self._raw_val_image_files, _evaluate(self._raw_val_labels))}
+
+        # Split the data the same way training would (reusing the same partition mask), then pull the partitions out
+        with tf.Graph().as_default(), tf.Session() as session:
+            train_images, train_labels, _, test_images, test_labels, _, val_images, val_labels, _ = \
+                loaders.split_raw_data(_evaluate(self._raw_image_files), _evaluate(self._raw_labels),
+                                       self._test_split, self._validation_split, None,
+                                       self._training_augmentation_images, self._training_augmentation_labels,
+                                       self._split_labels,
+                                       force_mask_creation=self._force_split_partition)
+            partitions = {'train': (train_images, train_labels),
+                          'test': (test_images, test_labels),
+                          'val': (val_images, val_labels)}
+            return {name: session.run(partition) if partition[0] is not None else (None, None)
+                    for name, partition in partitions.items()}
+
+    def load_dataset_from_records(self, dirname):
+        """
+        Loads a dataset written with save_dataset_to_records. The record files are read in parallel during training,
+        and the training, testing, and validation partitions saved in them are used instead of the split settings.
+        :param dirname: The directory with the record files and their description
+        """
+        if not isinstance(dirname, str):
+            raise TypeError("dirname must be a str")
+        info_file = os.path.join(dirname, 'dataset_info.json')
+        if not os.path.isfile(info_file):
+            raise ValueError("No record dataset description found in " + dirname)
+
+        with open(info_file, 'r') as f:
+            info = json.load(f)
+        if info['model'] != type(self).__name__:
+            warnings.warn('Records were written by a {0} but are being loaded by a {1}'
+                          .format(info['model'], type(self).__name__))
+
+        partitions = info['partitions']
+        self._testing = 'test' in partitions
+        self._validation = 'val' in partitions
+        self._total_raw_samples = sum(partition['num_samples'] for partition in partitions.values())
+        self._test_split = partitions['test']['num_samples'] / self._total_raw_samples if self._testing else 0
+        self._validation_split = partitions['val']['num_samples'] / self._total_raw_samples if self._validation else 0
+        self._total_classes = info['num_classes']
+
+        self._log('Total raw examples is %d' % self._total_raw_samples)
+        self._log('Total classes is %d' % self._total_classes)
+
+        self._records_dir = dirname
+        self._records_info = info
+
     def _parse_dataset(self, train_images, train_labels, train_mf,
                        test_images, test_labels, test_mf,
                        val_images, val_labels, val_mf):
@@ -2389,45 +3243,79 @@ class DPPModel(ABC):
         for training data specifically
         :return: A tf.data.Dataset object that encapsulates the data input and augmentation pipeline
         """
+        load_stages, augment_stages = self._input_stages(train_set)
+
+        # Only build the pipeline up to a given stage when measuring its throughput
+        measuring = self._input_stage_limit is not None
+        if measuring:
+            augment_stages = augment_stages[:max(self._input_stage_limit - len(load_stages), 0)]
+            load_stages = load_stages[:self._input_stage_limit]
+
+        # Create the dataset and load in the images
+        if self._parse_from_records:
+            input_dataset = self._make_records_dataset(images, train_set)
+            labels = []
+        else:
+            input_dataset = tf.data.Dataset.from_tensor_slices((images, labels))
+        input_dataset = self._map_input_stages(input_dataset, load_stages)
+
+        # Optionally cache the decoded images before any random augmentations are applied
+        if self._image_cache_dir is not None and not measuring:
+            input_dataset = input_dataset.cache(self._get_image_cache_file(images, labels))
+
+        input_dataset = self._map_input_stages(input_dataset, augment_stages)
+
+        # The order of training samples is random anyway, so let samples that are ready early skip ahead of slow ones
+        if train_set and self._fused_input_pipeline:
+            options = tf.data.Options()
+            options.experimental_deterministic = False
+            input_dataset = input_dataset.with_options(options)
+
+        return input_dataset
+
+    def _input_stages(self, train_set):
+        """
+        Gets the per-sample stages of the input pipeline, in the order they are applied
+        :param train_set: A flag for whether this is the training dataset; certain augmentations only occur or change
+        for training data specifically
+        :return: Two lists of (name, function) stages, where each function maps an image and label to new ones. The
+        first list loads and resizes the inputs (and can be cached), and the second augments and formats them.
+        """
         def _with_labels(fn):
             """Takes a function on images only and appends its labels to the output"""
             return lambda im, lab: (fn(im), lab)
 
-        data_height = self._image_height
-        data_width = self._image_width
+        height = self._image_height
+        width = self._image_width
+        depth = self._image_depth
 
-        # Create the dataset and load in the images
-        input_dataset = tf.data.Dataset.from_tensor_slices((images, labels))
-        input_dataset = input_dataset.map(self._parse_apply_preprocessing, num_parallel_calls=self._num_threads)
+        load_stages = [('read', self._parse_apply_preprocessing)]
         if self._resize_images:
-            input_dataset = input_dataset.map(lambda x, y: self._parse_resize_images(x, y, data_height, data_width),
-                                              num_parallel_calls=self._num_threads)
+            load_stages.append(('resize', lambda x, y: self._parse_resize_images(x, y, height, width)))
 
         # Augmentations that we should do to every dataset (training, testing, and validation)
+        augment_stages = []
         if self._augmentation_crop:  # Apply random crops to images
-            data_height = int(data_height * self._crop_amount)
-            data_width = int(data_width * self._crop_amount)
+            height = int(height * self._crop_amount)
+            width = int(width * self._crop_amount)
             if train_set:
-                input_dataset = input_dataset.map(
-                    _with_labels(lambda x: tf.random_crop(x, [data_height, data_width, self._image_depth])),
-                    num_parallel_calls=self._num_threads)
+                augment_stages.append(('crop', lambda x, y: self._parse_random_crop(x, y, height, width, depth)))
             else:
-                input_dataset = input_dataset.map(lambda x, y: self._parse_crop_or_pad(x, y, data_height, data_width),
-                                                  num_parallel_calls=self._num_threads)
+                augment_stages.append(('crop', lambda x, y: self._parse_crop_or_pad(x, y, height, width)))
 
         if self._crop_or_pad_images:  # Apply padding or cropping to deal with images of different sizes
-            input_dataset = input_dataset.map(lambda x, y: self._parse_crop_or_pad(x, y, data_height, data_width),
-                                              num_parallel_calls=self._num_threads)
+            augment_stages.append(('crop_or_pad', lambda x, y: self._parse_crop_or_pad(x, y, height, width)))
 
-        if train_set:
+        # With batch augmentation, these are done in _parse_augment_batch after batching instead
+        batch_augment = train_set and self._batch_augmentation
+
+        if train_set and not batch_augment:
             # Augmentations that we should only do to the training dataset
             if self._augmentation_flip_horizontal:  # Apply random horizontal flips
-                input_dataset = input_dataset.map(_with_labels(tf.image.random_flip_left_right),
-                                                  num_parallel_calls=self._num_threads)
+                augment_stages.append(('flip_horizontal', lambda x, y: self._parse_random_flip(x, y, True)))
 
             if self._augmentation_flip_vertical:  # Apply random vertical flips
-                input_dataset = input_dataset.map(_with_labels(tf.image.random_flip_up_down),
-                                                  num_parallel_calls=self._num_threads)
+                augment_stages.append(('flip_vertical', lambda x, y: self._parse_random_flip(x, y, False)))
 
             if self._augmentation_contrast:  # Apply random contrast and brightness adjustments
                 def contrast_fn(x):
@@ -2435,36 +3323,288 @@ class DPPModel(ABC):
                     x = tf.image.random_contrast(x, lower=0.2, upper=1.8)
                     return x
 
-                input_dataset = input_dataset.map(_with_labels(contrast_fn), num_parallel_calls=self._num_threads)
+                augment_stages.append(('contrast', _with_labels(contrast_fn)))
 
             if self._augmentation_rotate:  # Apply random rotations, then optionally border crop and resize
-                input_dataset = input_dataset.map(_with_labels(self._parse_rotate),
-                                                  num_parallel_calls=self._num_threads)
+                augment_stages.append(('rotate', _with_labels(self._parse_rotate)))
                 if self._rotate_crop_borders:
-                    crop_fraction = self._smallest_crop_fraction(data_height, data_width)
-                    input_dataset = input_dataset.map(
-                        _with_labels(lambda x: self._parse_rotation_crop(x, crop_fraction, data_height, data_width)),
-                        num_parallel_calls=self._num_threads)
+                    crop_fraction = self._smallest_crop_fraction(height, width)
+                    augment_stages.append(
+                        ('rotation_crop',
+                         _with_labels(lambda x: self._parse_rotation_crop(x, crop_fraction, height, width))))
 
         # Mean-center all inputs
-        if self._supports_standardization:
-            input_dataset = input_dataset.map(_with_labels(tf.image.per_image_standardization),
-                                              num_parallel_calls=self._num_threads)
+        if self._supports_standardization and not batch_augment:
+            augment_stages.append(('standardize', _with_labels(tf.image.per_image_standardization)))
 
         # Manually set the shape of the image tensors so it matches the shape of the images
-        input_dataset = input_dataset.map(
-            lambda x, y: self._parse_force_set_shape(x, y, data_height, data_width, self._image_depth),
-            num_parallel_calls=self._num_threads)
+        augment_stages.append(('set_shape', lambda x, y: self._parse_force_set_shape(x, y, height, width, depth)))
+
+        return load_stages, augment_stages
+
+    def _map_input_stages(self, dataset, stages):
+        """
+        Applies input pipeline stages to a dataset, either as one map per stage or (for the fused input pipeline) as a
+        single map with its parallelism tuned by Tensorflow
+        :param dataset: The Dataset to apply the stages to
+        :param stages: A list of (name, function) stages from _input_stages
+        :return: The Dataset with the stages applied
+        """
+        if not stages:
+            return dataset
+
+        if self._fused_input_pipeline:
+            def fused_fn(x, y):
+                for _, fn in stages:
+                    x, y = fn(x, y)
+                return x, y
 
+            return dataset.map(fused_fn, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+        for _, fn in stages:
+            dataset = dataset.map(fn, num_parallel_calls=self._num_threads)
+        return dataset
+
+    def measure_input_pipeline_throughput(self, num_samples=500):
+        """
+        Measures how quickly the training input pipeline produces samples after each of its stages (reading, resizing,
+        each augmentation, etc.) to find the stages that hold training back. A dataset needs to be loaded first.
+        :param num_samples: The number of samples to time for each stage
+        :return: A list of (stage name, samples/sec of the pipeline up to and including that stage) tuples
+        """
+        if not isinstance(num_samples, int):
+            raise TypeError("num_samples must be an int")
+        if num_samples <= 0:
+            raise ValueError("num_samples must be positive")
+        if self._session is None:
+            raise RuntimeError("The model needs to be initialized to measure its input pipeline")
+
+        # Parsing the data changes a few settings (e.g. the image size when cropping), so they're all restored after.
+        # Each measurement is built in a throwaway graph and session, so the model's own graph doesn't grow; any
+        # tensors in the loaded data (such as labels) are evaluated first so they can be used in the other graphs.
+        saved_state = dict(self.__dict__)
+        loaded_tensors = {key: value for key, value in saved_state.items() if isinstance(value, tf.Tensor)}
+        loaded_data = self._session.run(loaded_tensors)
+        try:
+            load_stages, augment_stages = self._input_stages(True)
+            stage_names = [name for name, _ in load_stages + augment_stages]
+            batch_size = min(self._batch_size, num_samples)
+
+            throughput = []
+            for num_stages in range(1, len(stage_names) + 1):
+                self.__dict__.update(saved_state)
+                self.__dict__.update(loaded_data)
+                self._input_stage_limit = num_stages
+                self._image_cache_dir = None
+                self._reset_graph()
+                self._reset_session()
+
+                try:
+                    with self._graph.as_default(), tf.device('device:cpu:0'):
+                        self._graph_parse_data()
+                        dataset = self._train_dataset.repeat().batch(batch_size)
+                        next_batch = dataset.prefetch(1).make_one_shot_iterator().get_next()
+
+                    # The first batch includes starting up the pipeline, so it isn't timed
+                    self._session.run(next_batch)
+                    num_batches = math.ceil(num_samples / batch_size)
+                    start_time = time.time()
+                    for _ in range(num_batches):
+                        self._session.run(next_batch)
+                    samples_per_sec = num_batches * batch_size / (time.time() - start_time)
+                    throughput.append((stage_names[num_stages - 1], samples_per_sec))
+                finally:
+                    self._session.close()
+        finally:
+            self.__dict__.clear()
+            self.__dict__.update(saved_state)
+
+        prev_time = 0
+        for name, samples_per_sec in throughput:
+            self._log('Input stage {0}: {1:.1f} samples/sec, {2:.2f} ms/sample for this stage'
+                      .format(name, samples_per_sec, (1000 / samples_per_sec) - prev_time))
+            prev_time = 1000 / samples_per_sec
+
+        return throughput
+
+    def _make_records_dataset(self, shard_files, train_set):
+        """
+        Creates a dataset that reads encoded images and labels from TFRecord shards, reading several shards at once
+        :param shard_files: A list of TFRecord files for the dataset
+        :param train_set: A flag for whether this is the training dataset, whose shards are read in a random order
+        :return: A tf.data.Dataset of (encoded image, label) pairs
+        """
+        shard_dataset = tf.data.Dataset.from_tensor_slices(shard_files)
+        if train_set:
+            shard_dataset = shard_dataset.shuffle(len(shard_files))
+
+        # Large read buffers keep the reads sequential, which matters most for network filesystems
+        parallel_calls = tf.data.experimental.AUTOTUNE if self._fused_input_pipeline else self._num_threads
+        input_dataset = shard_dataset.interleave(lambda f: tf.data.TFRecordDataset(f, buffer_size=8 * 1024 * 1024),
+                                                 cycle_length=min(len(shard_files), max(self._num_threads, 2)),
+                                                 num_parallel_calls=parallel_calls)
+        input_dataset = input_dataset.map(self._parse_record, num_parallel_calls=parallel_calls)
         return input_dataset
 
+    def _parse_record(self, record):
+        """
+        Parses a serialized example from a TFRecord file written by save_dataset_to_records
+        :param record: The serialized example
+        :return: The image and label. Encoded images and labels are left for _parse_apply_preprocessing to decode
+        """
+        features = tf.io.parse_single_example(record, {
+            'image': tf.io.FixedLenFeature([], tf.string),
+            'image_shape': tf.io.VarLenFeature(tf.int64),
+            'label': tf.io.FixedLenFeature([], tf.string),
+            'label_shape': tf.io.VarLenFeature(tf.int64)})
+
+        def _decode(name):
+            value = features[name]
+            if self._records_info[name + '_kind'] != 'array':
+                return value
+            shape = self._records_info[name + '_shape']
+            if shape is None:
+                shape = tf.cast(tf.sparse.to_dense(features[name + '_shape']), tf.int32)
+            return tf.reshape(tf.io.decode_raw(value, tf.float32), shape)
+
+        return _decode('image'), _decode('label')
+
+    def _image_cache_settings(self):
+        """
+        Gets the settings that affect how images and labels are loaded and preprocessed before being cached
+        :return: A list of the relevant settings
+        """
+        return [type(self).__name__, self._image_height, self._image_width, self._image_depth, self._resize_images]
+
+    def _get_image_cache_file(self, images, labels):
+        """
+        Gets the file to cache a dataset's decoded images and labels in. The file name is a hash of the images and
+        labels, the modification times of any files they name, and the preprocessing settings, so changing any of them
+        will make a new cache instead of reusing a stale one.
+        :param images: A list or tensor of image names (or arrays) for the dataset
+        :param labels: A list or tensor of the labels corresponding to the images
+        :return: The cache file name to pass to tf.data.Dataset.cache
+        """
+        cache_hash = hashlib.sha1(repr(self._image_cache_settings()).encode())
+
+        for data in (images, labels):
+            if isinstance(data, tf.Tensor):
+                data = self._session.run(data)
+            for item in data:
+                self._update_data_hash(cache_hash, item)
+
+        if not os.path.isdir(self._image_cache_dir):
+            os.makedirs(self._image_cache_dir)
+        cache_file = os.path.join(self._image_cache_dir, 'dpp_image_cache_' + cache_hash.hexdigest())
+
+        # A cache is only finished once a full pass through the dataset is done. Leftovers from an unfinished pass
+        # (e.g. interrupted training) would stop Tensorflow from writing it again, so they get removed.
+        if not os.path.exists(cache_file + '.index'):
+            for leftover_file in glob.glob(cache_file + '*'):
+                os.remove(leftover_file)
+        else:
+            self._log('Using cached images from ' + cache_file)
+
+        return cache_file
+
+    @staticmethod
+    def _update_data_hash(data_hash, item):
+        """
+        Adds an item of data to a running hash. File names are hashed along with the file's modification time, so an
+        edited file changes the hash too.
+        :param data_hash: A hashlib hash object to update
+        :param item: A file name (as a str or bytes) or anything that converts to an ndarray
+        """
+        if isinstance(item, bytes):
+            item = item.decode()
+        if isinstance(item, str):
+            data_hash.update(item.encode())
+            if os.path.isfile(item):
+                data_hash.update(repr(os.path.getmtime(item)).encode())
+        else:
+            data_hash.update(np.asarray(item).tobytes())
+
+    def _generated_data_key(self, settings, *items):
+        """
+        Gets the key for an item of generated data (e.g. the patches cut from one image), which is a hash of the
+        generation settings and everything the item is generated from
+        :param settings: A list of the settings that affect how the item is generated
+        :param items: The file names and/or arrays (e.g. labels) that the item is generated from
+        :return: The key as a hex string
+        """
+        data_hash = hashlib.sha1(repr([type(self).__name__] + list(settings)).encode())
+        for item in items:
+            self._update_data_hash(data_hash, item)
+        return data_hash.hexdigest()
+
+    def _update_generated_data(self, data_dir, keys, generate):
+        """
+        Brings a directory of generated data up to date. The directory has a manifest of the data it holds, stored by
+        the key of each item, so only items with new keys (i.e. new or changed inputs or settings) are generated while
+        the rest are reused. Items that are no longer needed are deleted. If data overwriting is turned on, all of the
+        items are generated again.
+        :param data_dir: The directory holding the generated data
+        :param keys: A list of keys, from _generated_data_key, for each item of data that's needed
+        :param generate: A function taking a list of the indices of the items to generate, generating them in data_dir,
+        and yielding a JSON serializable dict describing each one (in the same order) with its generated file names
+        (relative to data_dir) in 'files'
+        :return: A list of the dicts describing each item, in the same order as keys
+        """
+        manifest_file = os.path.join(data_dir, 'dpp_manifest.json')
+
+        if os.path.exists(data_dir) and (self._gen_data_overwrite or not os.path.isfile(manifest_file)):
+            # Data without a manifest can't be checked against its inputs, so it isn't trusted
+            self._log("Overwriting preexisting generated data in " + data_dir)
+            shutil.rmtree(data_dir)
+        if not os.path.exists(data_dir):
+            os.makedirs(data_dir)
+            manifest = {}
+        else:
+            with open(manifest_file, 'r') as f:
+                manifest = json.load(f)
+
+        def is_complete(key):
+            return key in manifest and all(os.path.isfile(os.path.join(data_dir, f)) for f in manifest[key]['files'])
+
+        # Stale items are removed first, in case newly generated ones reuse their file names. Items that appear more
+        # than once (e.g. the same image loaded twice) only need to be generated once.
+        to_generate = []
+        generate_keys = set()
+        for i, key in enumerate(keys):
+            if key not in generate_keys and not is_complete(key):
+                to_generate.append(i)
+                generate_keys.add(key)
+        stale_keys = set(manifest.keys()).difference(keys).union(generate_keys)
+        for key in stale_keys.intersection(manifest.keys()):
+            for f in manifest.pop(key)['files']:
+                if os.path.isfile(os.path.join(data_dir, f)):
+                    os.remove(os.path.join(data_dir, f))
+
+        if to_generate:
+            self._log("Generating {} of {} items in {}".format(len(to_generate), len(keys), data_dir))
+        else:
+            self._log("Loading preexisting generated data from " + data_dir)
+
+        try:
+            for i, entry in zip(to_generate, generate(to_generate)):
+                manifest[keys[i]] = entry
+        finally:
+            # Whatever was generated is kept track of, even if generation is interrupted part of the way through
+            with open(manifest_file, 'w') as f:
+                json.dump(manifest, f)
+
+        return [manifest[key] for key in keys]
+
     def _parse_images(self, images):
         """
         Convert a list of image names into an internal Dataset of processed images
-        :param images: A list of image names to parse
+        :param images: A list of image names to parse, or a Dataset of them
         """
         with self._graph.as_default():
-            input_dataset = tf.data.Dataset.from_tensor_slices(images)
+            if isinstance(images, tf.data.Dataset):
+                input_dataset = images
+            else:
+                input_dataset = tf.data.Dataset.from_tensor_slices(images)
             input_dataset = input_dataset.map(lambda x: self._parse_read_images(x, channels=self._image_depth),
                                               num_parallel_calls=self._num_threads)
             input_dataset = input_dataset.map(
@@ -2500,6 +3640,16 @@ class DPPModel(ABC):
         :param test_images: A tensor or list of tensors with the testing images
         :param val_images: A tensor or list of tensors with the validation images
         """
+        # Records already know how many samples are in each partition
+        if self._parse_from_records:
+            partitions = self._records_info['partitions']
+            self._total_training_samples = partitions['train']['num_samples']
+            if self._testing:
+                self._total_testing_samples = partitions['test']['num_samples']
+            if self._validation:
+                self._total_validation_samples = partitions['val']['num_samples']
+            return
+
         # Try to get the number of samples the normal way
         if isinstance(train_images, tf.Tensor):
             self._total_training_samples = train_images.get_shape().as_list()[0]
@@ -2540,7 +3690,7 @@ class DPPModel(ABC):
     def _parse_read_images(self, images, channels=1, image_type=tf.float32):
         """
         Read in input images during dataset parsing. This involves reading from disk, decoding the images, and
-        converting them to 0-1 float images.
+        converting them to 0-1 float images. Images coming from TFRecord files are already read in and only decoded.
         :param images: Strings with the names of the images to preprocess
         :param channels: The number of channels in the image. Defaults to 1
         :param image_type: The desired Tensorflow type for the image after reading it in. Defaults to tf.float32
@@ -2550,7 +3700,8 @@ class DPPModel(ABC):
         # decode_png and decode_jpeg apparently both accept JPEG and PNG. We're using one of them because decode_image
         # also accepts GIF, preventing the return of a static shape and preventing resize_images from running. See this
         # Github issue for Tensorflow: https://github.com/tensorflow/tensorflow/issues/9356
-        images = tf.io.read_file(images)
+        if not self._parse_from_records:
+            images = tf.io.read_file(images)
         images = tf.io.decode_png(images, channels=channels)
         images = tf.image.convert_image_dtype(images, dtype=image_type)
         return images
@@ -2579,6 +3730,33 @@ class DPPModel(ABC):
         images = tf.image.resize_image_with_crop_or_pad(images, height, width)
         return images, labels
 
+    def _parse_random_crop(self, images, labels, height, width, depth):
+        """
+        Applies random crop augmentation to input images during dataset parsing
+        :param images: The images to crop
+        :param labels: The accompanying labels; normally passed through unchanged
+        :param height: The height of the crop
+        :param width: The width of the crop
+        :param depth: The depth/channels of the images
+        :return: The randomly cropped images and passed through labels
+        """
+        images = tf.random_crop(images, [height, width, depth])
+        return images, labels
+
+    def _parse_random_flip(self, images, labels, horizontal):
+        """
+        Applies random flip augmentation to input images during dataset parsing
+        :param images: The images to flip
+        :param labels: The accompanying labels; normally passed through unchanged
+        :param horizontal: Whether to flip the images horizontally (left-right) or vertically (up-down)
+        :return: The randomly flipped images and passed through labels
+        """
+        if horizontal:
+            images = tf.image.random_flip_left_right(images)
+        else:
+            images = tf.image.random_flip_up_down(images)
+        return images, labels
+
     def _parse_rotate(self, images):
         """
         Applies random rotation augmentation to input images during dataset parsing
@@ -2589,6 +3767,57 @@ class DPPModel(ABC):
         images = tensorflow.contrib.image.rotate(images, angle, interpolation='BILINEAR')
         return images
 
+    def _parse_augment_batch(self, images, labels):
+        """
+        Applies the training-only augmentations to a whole batch of images at once, drawing random settings for each
+        image in the batch so that the results match augmenting the images one at a time
+        :param images: A batch of images to augment
+        :param labels: The accompanying labels; passed through unchanged unless they have to follow a flip
+        :return: The augmented images (mean-centered if the model uses standardization) and their labels
+        """
+        batch_size = tf.shape(images)[0]
+
+        def _random_for_each_image(shape=(), minval=0, maxval=1):
+            return tf.random_uniform([batch_size] + list(shape), minval=minval, maxval=maxval)
+
+        if self._augmentation_flip_horizontal:
+            flipped = _random_for_each_image() < 0.5
+            images = tf.where(flipped, tf.reverse(images, axis=[2]), images)
+            labels = self._parse_flip_batch_labels(labels, flipped, axis=2)
+
+        if self._augmentation_flip_vertical:
+            flipped = _random_for_each_image() < 0.5
+            images = tf.where(flipped, tf.reverse(images, axis=[1]), images)
+            labels = self._parse_flip_batch_labels(labels, flipped, axis=1)
+
+        if self._augmentation_contrast:
+            # Same as random_brightness(max_delta=63) followed by random_contrast(lower=0.2, upper=1.8)
+            images = images + _random_for_each_image([1, 1, 1], minval=-63, maxval=63)
+            means = tf.reduce_mean(images, axis=[1, 2], keepdims=True)
+            images = (images - means) * _random_for_each_image([1, 1, 1], minval=0.2, maxval=1.8) + means
+
+        if self._augmentation_rotate:
+            angles = _random_for_each_image(maxval=2 * math.pi)
+            images = tensorflow.contrib.image.rotate(images, angles, interpolation='BILINEAR')
+            if self._rotate_crop_borders:
+                crop_fraction = self._smallest_crop_fraction(self._image_height, self._image_width)
+                images = self._parse_rotation_crop(images, crop_fraction, self._image_height, self._image_width)
+
+        if self._supports_standardization:
+            images = tf.image.per_image_standardization(images)
+
+        return images, labels
+
+    def _parse_flip_batch_labels(self, labels, flipped, axis):
+        """
+        Applies a batch flip to the labels for models whose labels are laid out like the images
+        :param labels: A batch of labels
+        :param flipped: A boolean vector marking which images in the batch were flipped
+        :param axis: The image axis the flipped images were reversed along
+        :return: The labels; normally passed through unchanged
+        """
+        return labels
+
     def _parse_rotation_crop(self, images, crop_fraction, height, width):
         """
         Applies optional centre cropping for random rotation augmentation
@@ -1,19 +1,66 @@
-from deepplantphenomics import loaders, layers, SemanticSegmentationModel
+from deepplantphenomics import loaders, layers, metrics, definitions, SemanticSegmentationModel
+from deepplantphenomics.semantic_segmentation_model import _patch_coords
 import tensorflow.compat.v1 as tf
 import numpy as np
 import os
 import warnings
 import numbers
-import itertools
-import shutil
-from tqdm import tqdm, trange
+import concurrent.futures
+from tqdm import tqdm
 from PIL import Image
 import cv2
 import copy
 
 
+def _points_to_density_map(points, height, width, sigma, multiplier):
+    """
+    Converts point labels for a heatmap into a grayscale image with a gaussian placed at each point. Rather than adding
+    each gaussian separately, the points are counted up in an image and the image is convolved with the gaussian.
+    :param points: A list of (x,y) tuples for object locations in an image
+    :param height: The height of the heatmap
+    :param width: The width of the heatmap
+    :param sigma: The standard deviation of the gaussians
+    :param multiplier: The value each gaussian sums to
+    :return: An ndarray of the heatmap image
+    """
+    diameter = int(sigma * 6)
+    radius = diameter / 2
+    pad = diameter - 1
+
+    # Count the points by the top-left corner of their gaussians, leaving room for gaussians that hang off the top and
+    # left of the image and ignoring any that are entirely outside of it
+    points = np.reshape(np.asarray(points, dtype=np.float64), [-1, 2])
+    corner_x = np.trunc(points[:, 0] - radius).astype(np.int64) + pad
+    corner_y = np.trunc(points[:, 1] - radius).astype(np.int64) + pad
+    in_bounds = (corner_x >= 0) & (corner_x < width + pad) & (corner_y >= 0) & (corner_y < height + pad)
+    counts = np.zeros([height + pad, width + pad], dtype=np.float32)
+    np.add.at(counts, (corner_y[in_bounds], corner_x[in_bounds]), 1)
+
+    # The gaussian is separable, so the convolution is done as two 1D passes. Anchoring the kernel at its far end
+    # places each gaussian's top-left corner on its count.
+    gauss = cv2.getGaussianKernel(diameter, sigma)
+    gauss = gauss / np.sum(gauss)
+    output_img = cv2.sepFilter2D(counts, -1, gauss, gauss, anchor=(pad, pad), borderType=cv2.BORDER_CONSTANT)
+    output_img = output_img[pad:, pad:] * multiplier
+
+    return np.expand_dims(output_img.astype(np.float32), -1)
+
+
+def _write_density_map(job):
+    """
+    Generates a heatmap from point labels and saves it as a binary .npy file for later use in training
+    :param job: A tuple of the file path to save to, followed by the arguments for _points_to_density_map
+    """
+    heatmap_file, points, height, width, sigma, multiplier = job
+    np.save(heatmap_file, _points_to_density_map(points, height, width, sigma, multiplier))
+
+
 class HeatmapObjectCountingModel(SemanticSegmentationModel):
     _supported_loss_fns = ['l2', 'l1', 'smooth l1']
+    # Augmentations that can move point labels along with the image, before the heatmaps are made from them
+    _point_augmentations = [definitions.AugmentationType.FLIP_HOR,
+                            definitions.AugmentationType.FLIP_VER,
+                            definitions.AugmentationType.CROP]
     _multiplier = 100.
 
     def __init__(self, debug=False, load_from_saved=False, save_checkpoints=True, initialize=True, tensorboard_dir=None,
@@ -29,6 +76,28 @@ class HeatmapObjectCountingModel(SemanticSegmentationModel):
         # come from an external image or are generated
         self.__label_from_image_file = False
 
+        # Generated heatmaps can be stored as files or synthesized from their points in the input pipeline
+        self._heatmaps_in_graph = False
+
+    def set_heatmaps_in_graph(self, in_graph):
+        """
+        Sets whether heatmaps for point labels are generated in the input pipeline as samples are loaded, instead of
+        being generated once and saved as files. Resizing, cropping, and flipping are then applied to the points before
+        the heatmaps are made from them, so crop and flip augmentations can only be used with this turned on.
+        :param in_graph: A flag for generating heatmaps in the input pipeline
+        """
+        if not isinstance(in_graph, bool):
+            raise TypeError("in_graph must be a bool")
+        if not in_graph and (self._augmentation_crop or self._augmentation_flip_horizontal
+                             or self._augmentation_flip_vertical):
+            raise RuntimeError("Crop and flip augmentations need heatmaps to be generated in the input pipeline")
+
+        self._heatmaps_in_graph = in_graph
+        if in_graph:
+            self._supported_augmentations = type(self)._supported_augmentations + self._point_augmentations
+        else:
+            self._supported_augmentations = type(self)._supported_augmentations
+
     def set_density_map_sigma(self, sigma):
         """
         Sets the standard deviation to use for gaussian points when generating ground truth heatmaps from object
@@ -94,38 +163,41 @@ class HeatmapObjectCountingModel(SemanticSegmentationModel):
                 warnings.warn('Less than a batch of testing data')
                 exit()
 
-            # Initialize storage for the retrieved test variables
-            all_losses = []
-            all_y = []
-            all_predictions = []
+            # Statistics are accumulated a batch at a time, so memory use doesn't grow with the test set (which matters
+            # for full resolution heatmaps)
+            loss_stats = metrics.StreamingStatistics()
+            abs_loss_stats = metrics.StreamingStatistics()
+            loss_hist = metrics.StreamingHistogram(num_bins=100)
+            difference_stats = metrics.StreamingStatistics()
 
             # Main test loop
             for _ in tqdm(range(num_batches)):
                 r_losses, r_y, r_predictions = self._session.run([self._graph_ops['test_losses'],
                                                                   self._graph_ops['y_test'],
                                                                   self._graph_ops['x_test_predicted']])
-                all_losses.append(r_losses)
-                all_y.append(r_y)
-                all_predictions.append(r_predictions)
+                loss_stats.update(r_losses)
+                abs_loss_stats.update(np.abs(r_losses))
+                loss_hist.update(r_losses)
 
-            all_losses = np.concatenate(all_losses, axis=0)
-            all_y = np.concatenate(all_y, axis=0)
-            all_predictions = np.concatenate(all_predictions, axis=0)
+                # Specifically for heatmap object counting, we also want to determine an accuracy in terms of how the
+                # sums over the predicted and ground truth heatmaps compare to each other
+                heatmap_differences = [self.__heatmap_difference(r_predictions[i, ...], r_y[i, ...])
+                                       for i in range(r_y.shape[0])]
+                difference_stats.update(heatmap_differences)
+                self._log('Heatmap Differences: {}'.format(np.array(heatmap_differences)))
 
             # For heatmap object counting losses, like with semantic segmentation, we want relative and abs mean, std
             # of L2 norms, plus a histogram of errors
-            abs_mean = np.mean(np.abs(all_losses))
-            abs_var = np.var(np.abs(all_losses))
-            abs_std = np.sqrt(abs_var)
+            abs_mean = abs_loss_stats.mean
+            abs_std = abs_loss_stats.std
 
-            mean = np.mean(all_losses)
-            var = np.var(all_losses)
-            mse = np.mean(np.square(all_losses))
-            std = np.sqrt(var)
-            loss_max = np.amax(all_losses)
-            loss_min = np.amin(all_losses)
+            mean = loss_stats.mean
+            mse = loss_stats.sum_squares / loss_stats.count
+            std = loss_stats.std
+            loss_max = loss_stats.max
+            loss_min = loss_stats.min
 
-            hist, _ = np.histogram(all_losses, bins=100)
+            hist = loss_hist.counts
 
             self._log('Heatmap Losses:')
             self._log('Mean loss: {}'.format(mean))
@@ -139,13 +211,7 @@ class HeatmapObjectCountingModel(SemanticSegmentationModel):
             self._log('Histogram of {} losses:'.format(self._loss_fn))
             self._log(hist)
 
-            # Specifically for heatmap object counting, we also want to determine an accuracy in terms of how the sums
-            # over the predicted and ground truth heatmaps compare to each other
-            heatmap_differences = [self.__heatmap_difference(all_predictions[i, ...], all_y[i, ...])
-                                   for i in range(all_y.shape[0])]
-            heatmap_differences = np.array(heatmap_differences)
-            overall_difference = np.mean(heatmap_differences)
-            self._log('Heatmap Differences: {}'.format(heatmap_differences))
+            overall_difference = difference_stats.mean
             self._log('Mean Heatmap Difference: {}'.format(overall_difference))
 
             return overall_difference
@@ -183,6 +249,11 @@ class HeatmapObjectCountingModel(SemanticSegmentationModel):
         super().load_dataset_from_directory_with_segmentation_masks(dirname, seg_dirname)
         self.__label_from_image_file = True
 
+    def load_dataset_from_records(self, dirname):
+        super().load_dataset_from_records(dirname)
+        # Heatmaps loaded from .npy files are stored in the records as arrays, while heatmap images stay encoded
+        self.__label_from_image_file = self._records_info['label_kind'] == 'encoded'
+
     def load_heatmap_dataset_with_csv_from_directory(self, dirname, label_file, ext='jpg'):
         """
         Loads in a dataset for heatmap object counting. This dataset should consist of a directory of image files to
@@ -202,7 +273,11 @@ class HeatmapObjectCountingModel(SemanticSegmentationModel):
 
         labels = loaders.csv_points_to_tuples(labels)
 
-        if self._with_patching:
+        self._patch_container_input = self._with_patching and not self._virtual_patching
+        self._virtual_patch_input = self._with_patching and self._virtual_patching
+        if self._virtual_patch_input:
+            self._raw_image_files, labels = self._virtual_patch_index(self._raw_image_files, labels)
+        elif self._with_patching:
             self._raw_image_files, labels = self.__autopatch_heatmap_dataset(labels)
 
         heatmaps = self.__labels_to_heatmaps(labels)
@@ -221,7 +296,11 @@ class HeatmapObjectCountingModel(SemanticSegmentationModel):
         """
         self._raw_image_files, labels = loaders.read_dataset_from_directory_with_json_labels(dirname)
 
-        if self._with_patching:
+        self._patch_container_input = self._with_patching and not self._virtual_patching
+        self._virtual_patch_input = self._with_patching and self._virtual_patching
+        if self._virtual_patch_input:
+            self._raw_image_files, labels = self._virtual_patch_index(self._raw_image_files, labels)
+        elif self._with_patching:
             self._raw_image_files, labels = self.__autopatch_heatmap_dataset(labels)
 
         heatmaps = self.__labels_to_heatmaps(labels)
@@ -235,183 +314,152 @@ class HeatmapObjectCountingModel(SemanticSegmentationModel):
     def __labels_to_heatmaps(self, labels):
         """
         Converts point labels to heatmap labels and stores them as binary files. This will check for existing heatmaps
-        first and load them if found unless data overwriting is turned on.
+        first and load them if found unless data overwriting is turned on. If heatmaps are generated in the input
+        pipeline instead (including with virtual patching), the points themselves are kept as the labels.
         :param labels: A list of lists of tuples with the point labels for each image
-        :return: A list of file names for the generated heatmaps
-        """
-        out_dir = os.path.join(os.path.curdir, 'generated_heatmaps')
-        if os.path.exists(out_dir) and not self._gen_data_overwrite:
-            # If we've already generated heatmaps, just load their filenames
-            im_names = [os.path.splitext(os.path.basename(f))[0] for f in self._raw_image_files]
-            heatmap_files = ["{}.npy".format(os.path.join(out_dir, f)) for f in im_names]
-            return heatmap_files
-
-        if os.path.exists(out_dir):
-            self._log("Overwriting preexisting heatmaps...")
-            shutil.rmtree(out_dir)
-        os.mkdir(out_dir)
-
-        heatmaps = []
-        for filename, coords in zip(self._raw_image_files, labels):
-            if len(coords) > 0:
-                heatmap = self.__points_to_density_map(coords)
-            else:
-                # There are no points, so the heatmap is blank
-                heatmap = np.full([self._image_height, self._image_width, 1], 0, dtype=np.float32)
-
-            heatmap_file = self.__save_heatmap_as_binary(heatmap, os.path.splitext(os.path.basename(filename))[0],
-                                                         out_dir=out_dir)
-            heatmaps.append(heatmap_file)
-
-        return heatmaps
-
-    def __save_heatmap_as_binary(self, heatmap, filename, out_dir=None):
-        """
-        Saves a floating-point heatmap array as a binary .npy file for later use in training
-        :param heatmap: A float ndarray with a heatmap
-        :param filename: The filename to save the heatmap array with, excluding the extension
-        :return: The file path for later use in reloading the array
+        :return: A list of file names for the generated heatmaps, or an array of points for each image
         """
-        if out_dir is None:
-            out_dir = os.path.curdir
-        out_name = os.path.join(out_dir, '{}.npy'.format(filename))
+        if self._heatmaps_in_graph or self._virtual_patch_input:
+            # Each image's points are padded out with NaNs to the most points in any image so they fit in one array
+            max_points = max([len(coords) for coords in labels] + [1])
+            points = np.full([len(labels), max_points, 2], np.nan, dtype=np.float32)
+            for i, coords in enumerate(labels):
+                if len(coords) > 0:
+                    points[i, 0:len(coords), :] = coords
+            return points
 
-        np.save(out_name, heatmap)
-        return out_name
-
-    def __points_to_density_map(self, points):
-        """
-        Convert point labels for a heatmap into a grayscale image with a gaussian placed at heatmap points
-        :param points: A list of (x,y) tuples for object locations in an image
-        :return: An ndarray of the heatmap image
-        """
-
-        output_img = np.zeros([self._image_height, self._image_width], dtype=np.float32)
-
-        diameter = int(self._density_sigma * 6)
-        radius = diameter / 2
-
-        h = self._image_height
-        w = self._image_width
-
-        gauss = cv2.getGaussianKernel(diameter, self._density_sigma)
-        gauss2d = gauss * gauss.T
-        gauss2d = (gauss2d / np.sum(gauss2d)) * self._multiplier
-
-        for (x, y) in points:
-            gx1 = 0
-            gx2 = diameter
-
-            gy1 = 0
-            gy2 = diameter
-
-            if x - radius < 0:
-                x1 = 0
-                gx1 = int(radius - x)
-            else:
-                x1 = int(x - radius)
-
-            if x + radius > w:
-                x2 = int(w)
-                gx2 = int(radius + (w - x))
-            else:
-                x2 = int(x + radius)
-
-            if y - radius < 0:
-                y1 = 0
-                gy1 = int(radius - y)
-            else:
-                y1 = int(y - radius)
-
-            if y + radius > h:
-                y2 = h
-                gy2 = int(radius + (h - y))
+        out_dir = os.path.join(os.path.curdir, 'generated_heatmaps')
+        settings = [self._image_height, self._image_width, self._density_sigma, self._multiplier]
+        keys = [self._generated_data_key(settings, os.path.basename(f), np.asarray(coords, dtype=np.float64))
+                for f, coords in zip(self._raw_image_files, labels)]
+
+        def heatmap_name(image_file):
+            if self._patch_container_input:
+                container_file, index = loaders.split_patch_reference(image_file)
+                return '{}_{:0>4d}.npy'.format(os.path.splitext(os.path.basename(container_file))[0], index)
+            return '{}.npy'.format(os.path.splitext(os.path.basename(image_file))[0])
+
+        heatmap_names = [heatmap_name(f) for f in self._raw_image_files]
+
+        def generate_heatmaps(indices):
+            jobs = [(os.path.join(out_dir, heatmap_names[i]), labels[i], self._image_height, self._image_width,
+                     self._density_sigma, self._multiplier) for i in indices]
+
+            # OpenCV's filtering and numpy's saving release the GIL, so a pool of threads keeps the cores busy without
+            # the start up cost (and __main__ guard) that a pool of processes would need
+            num_workers = min(self._num_threads, len(jobs))
+            if num_workers > 1:
+                with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+                    for i, _ in zip(indices, executor.map(_write_density_map, jobs)):
+                        yield {'files': [heatmap_names[i]]}
             else:
-                y2 = int(y + radius)
-
-            output_img[y1:y2, x1:x2] += gauss2d[gy1:gy2, gx1:gx2]
+                for i, job in zip(indices, jobs):
+                    _write_density_map(job)
+                    yield {'files': [heatmap_names[i]]}
 
-        return np.expand_dims(output_img, -1)
+        entries = self._update_generated_data(out_dir, keys, generate_heatmaps)
+        return [os.path.join(out_dir, entry['files'][0]) for entry in entries]
 
     def __autopatch_heatmap_dataset(self, labels, patch_dir=None):
         """
         Generates a dataset of image patches from a loaded dataset of larger images and returns the new images and
-        labels. This will check for existing patches first and load them if found unless data overwriting is turned on.
+        labels. Patches from earlier runs are reused for any image whose file, points, and patch size haven't changed
+        since, unless data overwriting is turned on.
         :param labels: A nested list of point tuple labels for the original images (i.e. [[(x,y), (x,y), ...], ...]
         :param patch_dir: The directory to place patched images into, or where to read previous patches from
-        :return: The patched dataset as a list of image filenames and a nested list of their corresponding point labels
+        :return: The patched dataset as a list of references to the image patches and a nested list of their
+        corresponding point labels
         """
         if not patch_dir:
             patch_dir = os.path.curdir
         patch_dir = os.path.join(patch_dir, 'train_patch', '')
-        im_dir = patch_dir
-        point_file = os.path.join(patch_dir, 'patch_point_labels.csv')
+        self._log("Patching dataset: Patches will be in " + patch_dir)
 
-        if os.path.exists(patch_dir) and not self._gen_data_overwrite:
-            # If there already is a patched dataset, just load it
-            self._log("Loading preexisting patched data from " + patch_dir)
-            #image_files = loaders.get_dir_images(im_dir)
-            new_labels, ids = loaders.read_csv_multi_labels_and_ids(point_file, 0)
+        settings = [self._patch_height, self._patch_width, self._image_depth]
+        keys = [self._generated_data_key(settings, im_file, np.asarray(im_labels, dtype=np.float64))
+                for im_file, im_labels in zip(self._raw_image_files, labels)]
 
-            image_files = [os.path.join(patch_dir, id) + '.png' for id in ids]
+        def generate_patches(indices):
+            # We need to construct patches from the previously loaded dataset. We'll take as many of them as we can
+            # fit from the centre of the image, though at the risk of excluding any points that get cut off at the
+            # edges.
+            mode = self._autopatch_image_mode()
+            jobs = [(self._raw_image_files[n], os.path.join(patch_dir, 'im_{}.npy'.format(keys[n])), mode,
+                     self._patch_height, self._patch_width) for n in indices]
+            self._write_patch_containers(jobs)
 
-            new_labels = loaders.csv_points_to_tuples(new_labels)
-            return image_files, new_labels
+            # The points in each patch only depend on the image size, which can be read without decoding the image
+            for n in indices:
+                with Image.open(self._raw_image_files[n]) as im:
+                    patch_start, patch_end = _patch_coords(im.height, im.width, self._patch_height, self._patch_width)
+
+                # The slow, O(mn) way
+                patch_points = [[(x - px0, y - py0) for (x, y) in labels[n] if py0 <= y < py1 and px0 <= x < px1]
+                                for (py0, px0), (py1, px1) in zip(patch_start, patch_end)]
+                yield {'files': ['im_{}.npy'.format(keys[n])], 'points': patch_points}
 
-        self._log("Patching dataset: Patches will be in " + patch_dir)
-        if os.path.exists(patch_dir):
-            self._log("Overwriting preexisting patched data...")
-            shutil.rmtree(patch_dir)
-        os.mkdir(patch_dir)
-
-        # We need to construct patches from the previously loaded dataset. We'll take as many of them as we can fit
-        # from the centre of the image, though at the risk of excluding any points that get cut off at the edges.
-        patch_num = 0
-        n_image = len(self._raw_image_files)
         image_files = []
         new_labels = []
-        out_labels = []
-        label_str = []
-        for n, im_file, im_labels in zip(trange(n_image), self._raw_image_files, labels):
-            im = np.array(Image.open(im_file))
+        for entry in self._update_generated_data(patch_dir, keys, generate_patches):
+            container_file = os.path.join(patch_dir, entry['files'][0])
+            image_files.extend(loaders.patch_reference(container_file, i) for i in range(len(entry['points'])))
+            new_labels.extend([tuple(p) for p in points] for points in entry['points'])
 
-            def place_points_in_patches(tl_corner, br_corner, points):
-                # The slow, O(mn) way
-                for (py0, px0), (py1, px1) in zip(tl_corner, br_corner):
-                    points_in_patch = [(x - px0, y - py0) for (x, y) in points if py0 <= y < py1 and px0 <= x < px1]
-                    serial_points = [c for p in points_in_patch for c in p]  # Convert (x,y) tuples to flat x,y list
-                    new_labels.append(points_in_patch)
-                    out_labels.append(serial_points)
+        return image_files, new_labels
+
+    def _image_cache_settings(self):
+        return super()._image_cache_settings() + [self._heatmaps_in_graph]
 
-            patch_start, patch_end = self._autopatch_get_patch_coords(im)
-            num_patch = len(patch_start)
-            place_points_in_patches(patch_start, patch_end, im_labels)
+    def _parse_load_heatmap_binary(self, filename):
+        return np.load(filename)
 
-            for i, tl_coord, br_coord in zip(itertools.count(patch_num), patch_start, patch_end):
-                im_patch = Image.fromarray(self._autopatch_extract_patch(im, tl_coord, br_coord))
-                im_name = os.path.join(im_dir, 'im_{:0>6d}.png'.format(i))
-                im_patch.save(im_name)
-                image_files.append(im_name)
+    def _parse_points_to_density_map(self, points, height, width):
+        """
+        Generates a heatmap from point labels during dataset parsing, in the same way as _points_to_density_map
+        :param points: A Tensor with the (x,y) point for each object, padded out with NaNs
+        :param height: The height of the heatmap
+        :param width: The width of the heatmap
+        :return: A Tensor with the heatmap
+        """
+        diameter = int(self._density_sigma * 6)
+        radius = diameter / 2
+        pad = diameter - 1
 
-                label_str.append('im_{:0>6d},'.format(i) + ','.join([str(x) for x in out_labels[i]]))
+        # Count the points by the top-left corner of their gaussians, ignoring padding and points outside the image
+        points = tf.boolean_mask(points, tf.reduce_all(tf.is_finite(points), axis=1))
+        corners = tf.cast(points[:, ::-1] - radius, tf.int32) + pad  # Casting truncates, as in _points_to_density_map
+        in_bounds = tf.reduce_all((corners >= 0) & (corners < [height + pad, width + pad]), axis=1)
+        corners = tf.boolean_mask(corners, in_bounds)
+        counts = tf.scatter_nd(corners, tf.ones([tf.shape(corners)[0]]), [height + pad, width + pad])
 
-            patch_num += num_patch
+        # Convolve the counts with the gaussian as two 1D passes
+        gauss = cv2.getGaussianKernel(diameter, self._density_sigma)
+        gauss = (gauss / np.sum(gauss)).astype(np.float32)
+        heatmap = tf.reshape(counts, [1, height + pad, width + pad, 1])
+        heatmap = tf.nn.conv2d(heatmap, np.reshape(gauss, [diameter, 1, 1, 1]), [1, 1, 1, 1], 'VALID')
+        heatmap = tf.nn.conv2d(heatmap, np.reshape(gauss, [1, diameter, 1, 1]), [1, 1, 1, 1], 'VALID')
+        return tf.reshape(heatmap, [height, width, 1]) * self._multiplier
 
-        with open(point_file, 'w') as f:
-            for line in label_str:
-                f.write(line + '\n')
+    def __label_is_points(self, labels):
+        return (self._heatmaps_in_graph or self._virtual_patch_input) and not self.__label_from_image_file \
+            and labels.dtype == tf.float32 and labels.shape.ndims == 2
 
-        return image_files, new_labels
+    def _parse_virtual_patch_labels(self, labels, read_patch, offset):
+        if self.__label_from_image_file:
+            # Heatmaps read in as images are cut out of their source images like segmentation masks
+            return super()._parse_virtual_patch_labels(labels, read_patch, offset)
 
-    def _parse_load_heatmap_binary(self, filename):
-        return np.load(filename)
+        # The points are moved into the patch's coordinates, and the heatmap is made from them later in the pipeline
+        return labels - tf.cast(offset[::-1], tf.float32)
 
     def _parse_apply_preprocessing(self, images, labels):
         if not self.__label_from_image_file:
             # If we generated the heatmaps from points in a CSV or JSON file, then we want to treat the labels like
-            # other labels, with the wrinkle that loading them requires wrapping a binary loader with tf.py_func
+            # other labels, with the wrinkle that loading them requires wrapping a binary loader with tf.py_func. Points
+            # for heatmaps generated in the graph are kept as they are.
             images = self._parse_read_images(images, channels=self._image_depth)
-            labels = tf.numpy_function(self._parse_load_heatmap_binary, [labels], tf.float32)
+            if labels.dtype == tf.string:
+                labels = tf.numpy_function(self._parse_load_heatmap_binary, [labels], tf.float32)
             return images, labels
         else:
             # If we instead read in the heatmaps as images, then we want to use the version in
@@ -419,6 +467,12 @@ class HeatmapObjectCountingModel(SemanticSegmentationModel):
             return super()._parse_apply_preprocessing(images, labels)
 
     def _parse_resize_images(self, images, labels, height, width):
+        if self.__label_is_points(labels):
+            # Scale the points along with the image
+            scale = tf.cast([width, height], tf.float32) / tf.cast(tf.shape(images)[1::-1], tf.float32)
+            images = tf.image.resize_images(images, [height, width])
+            return images, labels * scale
+
         # See _parse_apply_preprocessing for an explanation of whats going on here
         if not self.__label_from_image_file:
             # Skip over the version in SemanticSegmentationModel to use the one in DPPModel
@@ -427,6 +481,14 @@ class HeatmapObjectCountingModel(SemanticSegmentationModel):
             return super()._parse_resize_images(images, labels, height, width)
 
     def _parse_crop_or_pad(self, images, labels, height, width):
+        if self.__label_is_points(labels):
+            # Shift the points by the same amount as the centred crop or pad
+            image_size = tf.shape(images)[1::-1]
+            new_size = tf.constant([width, height])
+            offset = tf.maximum(new_size - image_size, 0) // 2 - tf.maximum(image_size - new_size, 0) // 2
+            images = tf.image.resize_image_with_crop_or_pad(images, height, width)
+            return images, labels + tf.cast(offset, tf.float32)
+
         # See _parse_apply_preprocessing for an explanation of whats going on here
         if not self.__label_from_image_file:
             # Skip over the version in SemanticSegmentationModel to use the one in DPPModel
@@ -434,7 +496,43 @@ class HeatmapObjectCountingModel(SemanticSegmentationModel):
         else:
             return super()._parse_crop_or_pad(images, labels, height, width)
 
+    def _parse_random_crop(self, images, labels, height, width, depth):
+        if not self.__label_is_points(labels):
+            return super()._parse_random_crop(images, labels, height, width, depth)
+
+        # Pick the crop's offset ourselves so the points can be shifted by it too
+        image_size = tf.shape(images)
+        offset_y = tf.random_uniform([], maxval=image_size[0] - height + 1, dtype=tf.int32)
+        offset_x = tf.random_uniform([], maxval=image_size[1] - width + 1, dtype=tf.int32)
+        images = tf.image.crop_to_bounding_box(images, offset_y, offset_x, height, width)
+        return images, labels - tf.cast([offset_x, offset_y], tf.float32)
+
+    def _parse_random_flip(self, images, labels, horizontal):
+        if not self.__label_is_points(labels):
+            return super()._parse_random_flip(images, labels, horizontal)
+
+        # Flipping the image along its width (axis 1) mirrors the points' x coordinates, and vice versa
+        axis = 1 if horizontal else 0
+        image_size = tf.cast(tf.shape(images)[axis], tf.float32)
+        mirror = [-1., 1.] if horizontal else [1., -1.]
+        shift = [image_size, 0.] if horizontal else [0., image_size]
+        flip = tf.random_uniform([]) < 0.5
+        images = tf.cond(flip, lambda: tf.reverse(images, [axis]), lambda: images)
+        labels = tf.cond(flip, lambda: labels * mirror + tf.stack(shift), lambda: labels)
+        return images, labels
+
+    def _parse_flip_batch_labels(self, labels, flipped, axis):
+        if not self._heatmaps_in_graph or self.__label_from_image_file:
+            return labels
+
+        # Batch augmentation runs after the heatmaps are made from the points, so the heatmaps are flipped instead
+        return tf.where(flipped, tf.reverse(labels, axis=[axis]), labels)
+
     def _parse_force_set_shape(self, images, labels, height, width, depth):
+        if self.__label_is_points(labels):
+            # This is the last stage of the input pipeline, so the points are in their final places
+            labels = self._parse_points_to_density_map(labels, height, width)
+
         # See _parse_apply_preprocessing for an explanation of whats going on here
         if not self.__label_from_image_file:
             # Skip over the version in SemanticSegmentationModel to use the one in DPPModel
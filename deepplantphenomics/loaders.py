@@ -5,16 +5,14 @@ import random
 import os
 import datetime
 import json
+import bisect
+import io
+from PIL import Image
 
 
 def split_raw_data(images, labels, test_ratio=0, validation_ratio=0, moderation_features=None, augmentation_images=None,
                    augmentation_labels=None, split_labels=True, force_mask_creation=False):
     """Currently depends on test/validation_ratio being 0 when not using test/validation"""
-    # serialize labels if they are lists (e.g. for regression)
-    if isinstance(labels, list):
-        if split_labels:
-            labels = [' '.join(map(str, label)) for label in labels]
-
     n_aug = len(augmentation_labels) if augmentation_images is not None and augmentation_labels is not None else 0
     mask = _get_split_mask(test_ratio, validation_ratio, len(labels), n_aug, force_mask_creation)
 
@@ -22,6 +20,11 @@ def split_raw_data(images, labels, test_ratio=0, validation_ratio=0, moderation_
         images = images + augmentation_images
         labels = labels + augmentation_labels
 
+    # convert labels to a numeric array if they are lists (e.g. for regression)
+    if isinstance(labels, list):
+        if split_labels:
+            labels = labels_to_float_array(labels)
+
     try:
         if test_ratio != 0 and validation_ratio != 0:
             train_images, test_images, val_images = tf.dynamic_partition(images, mask, 3)
@@ -109,11 +112,152 @@ def _get_split_mask(test_ratio, validation_ratio, n_label, n_augmentation=0, for
     return mask
 
 
-def label_string_to_tensor(x, batch_size, num_outputs=-1):
-    sparse = tf.string_split(x, sep=' ')
-    values = tf.string_to_number(sparse.values)
-    dense = tf.reshape(values, [batch_size, num_outputs])
-    return dense
+def labels_to_float_array(labels):
+    """
+    Converts a list of numeric labels into a 2D float32 array with one row per label. Each label can be a single value
+    or a list/array of values, and the values can be numbers or strings of numbers (e.g. as read from a CSV file).
+    """
+    labels = [np.reshape(np.asarray(label, dtype=np.float32), [-1]) for label in labels]
+
+    label_sizes = set(label.size for label in labels)
+    if len(label_sizes) > 1:
+        raise ValueError("Labels must all have the same number of values, but found labels with sizes " +
+                         str(sorted(label_sizes)))
+
+    return np.stack(labels) if labels else np.zeros([0, 0], dtype=np.float32)
+
+
+def _is_patch_reference(item):
+    """Checks whether a str is a reference to a patch in an existing patch container, from patch_reference"""
+    container_file, _, index = item.rpartition(':')
+    return index.isdigit() and container_file.lower().endswith('.npy') and os.path.isfile(container_file)
+
+
+def _encode_patch(reference):
+    """Reads a patch from its patch container and encodes it as a PNG, so it's stored like the image file it stands in
+    for"""
+    container_file, index = split_patch_reference(reference)
+    patch = np.load(container_file, mmap_mode='r')[index]
+    with io.BytesIO() as f:
+        Image.fromarray(patch[..., 0] if patch.shape[-1] == 1 else np.asarray(patch)).save(f, format='PNG')
+        return f.getvalue()
+
+
+def _record_item_kind(item):
+    """
+    Decides how an image or label is stored in a TFRecord file: 'encoded' image files, numeric 'array's, or 'string's
+    """
+    if isinstance(item, bytes):
+        item = item.decode()
+    if isinstance(item, str):
+        if _is_patch_reference(item):
+            return 'encoded'
+        ext = os.path.splitext(item)[1].lower()
+        if ext in ['.jpg', '.jpeg', '.png'] and os.path.isfile(item):
+            return 'encoded'
+        if ext == '.npy' and os.path.isfile(item):
+            return 'array'
+        return 'string'
+    return 'array'
+
+
+def _record_item_bytes(item, kind):
+    """Gets the bytes to store for an image or label in a TFRecord file, along with its shape for arrays"""
+    if isinstance(item, bytes) and kind != 'string':
+        item = item.decode()
+
+    if kind == 'encoded':
+        if _is_patch_reference(item):
+            return _encode_patch(item), []
+        with open(item, 'rb') as f:
+            return f.read(), []
+    elif kind == 'array':
+        if isinstance(item, str):
+            item = np.load(item)
+        item = np.asarray(item, dtype=np.float32)
+        return item.tobytes(), list(item.shape)
+    else:
+        return item if isinstance(item, bytes) else str(item).encode(), []
+
+
+def write_records_shards(dirname, prefix, images, labels, num_shards):
+    """
+    Writes paired images and labels into TFRecord files split into shards of (nearly) equal size. Image files and
+    segmentation masks are stored in their encoded form (patches referenced in patch containers are encoded as PNGs),
+    arrays (including .npy files) as raw float32 values, and anything else as strings.
+    :param dirname: The directory to write the shards into
+    :param prefix: The prefix for the shard file names, e.g. 'train'
+    :param images: A list or array of image file names or image arrays
+    :param labels: A list or array of labels corresponding to the images
+    :param num_shards: The maximum number of shards to write
+    :return: A dict describing the shards and how their images and labels are stored
+    """
+    if len(images) != len(labels):
+        raise ValueError("Images and labels have mismatched lengths")
+    if len(images) == 0:
+        raise ValueError("Can't write an empty set of images to records")
+
+    image_kind = _record_item_kind(images[0])
+    label_kind = _record_item_kind(labels[0])
+    image_shapes = set()
+    label_shapes = set()
+
+    def _bytes_feature(value):
+        return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+    def _int64_feature(values):
+        return tf.train.Feature(int64_list=tf.train.Int64List(value=values))
+
+    num_shards = min(num_shards, len(images))
+    shard_files = []
+    for shard in range(num_shards):
+        shard_file = '{0}-{1:05d}-of-{2:05d}.tfrecord'.format(prefix, shard, num_shards)
+        shard_files.append(shard_file)
+
+        start = (len(images) * shard) // num_shards
+        end = (len(images) * (shard + 1)) // num_shards
+        with tf.io.TFRecordWriter(os.path.join(dirname, shard_file)) as writer:
+            for image, label in zip(images[start:end], labels[start:end]):
+                image_bytes, image_shape = _record_item_bytes(image, image_kind)
+                label_bytes, label_shape = _record_item_bytes(label, label_kind)
+                image_shapes.add(tuple(image_shape))
+                label_shapes.add(tuple(label_shape))
+
+                example = tf.train.Example(features=tf.train.Features(feature={
+                    'image': _bytes_feature(image_bytes),
+                    'image_shape': _int64_feature(image_shape),
+                    'label': _bytes_feature(label_bytes),
+                    'label_shape': _int64_feature(label_shape)}))
+                writer.write(example.SerializeToString())
+
+    # Arrays that all have the same shape get a static shape when read back in
+    return {'shards': shard_files,
+            'num_samples': len(images),
+            'image_kind': image_kind,
+            'image_shape': list(image_shapes.pop()) if len(image_shapes) == 1 else None,
+            'label_kind': label_kind,
+            'label_shape': list(label_shapes.pop()) if len(label_shapes) == 1 else None}
+
+
+def patch_reference(container_file, index):
+    """
+    Gets the reference to a patch in a patch container (a .npy file with a stack of patches), which stands in for an
+    image file name in autopatched datasets
+    :param container_file: The patch container's file name
+    :param index: The index of the patch in the container
+    :return: The reference as a str
+    """
+    return '{}:{}'.format(container_file, index)
+
+
+def split_patch_reference(reference):
+    """
+    Splits a reference from patch_reference back into its parts
+    :param reference: The patch reference
+    :return: The patch container's file name and the index of the patch in it
+    """
+    container_file, _, index = reference.rpartition(':')
+    return container_file, int(index)
 
 
 def get_dir_images(dirname):
@@ -123,6 +267,56 @@ def get_dir_images(dirname):
     return [f for (f, b1, b2) in zip(dir_files, is_file, is_image) if b1 and b2]
 
 
+def match_ids_to_files(ids, file_paths, whole_names=True):
+    """
+    Puts file paths in the order of a list of IDs, where each ID has to match the end of exactly one of the paths. The
+    paths are indexed once by their reversed strings so that each ID is looked up with a binary search instead of a
+    scan over every path.
+
+    :param ids: A list of IDs, e.g. file names or partial paths like 'snapshot1/VIS_SV_0.png'
+    :param file_paths: A list of file paths to match the IDs to
+    :param whole_names: If True, IDs have to match whole file or directory names in the paths (i.e. 'a.png' matches
+    'dir/a.png' but not 'dir/ba.png'). If False, IDs can match any suffix of the paths.
+    :return: The matched file paths, in the same order as the IDs
+    """
+    # Paths with a shared suffix are next to each other when sorted by their reversed strings, so the paths ending in
+    # an ID are the range of reversed paths starting with the reversed ID
+    reversed_paths = sorted((path.replace(os.sep, '/')[::-1], path) for path in file_paths)
+    reversed_keys = [key for key, _ in reversed_paths]
+
+    matched_paths = []
+    missing_ids = []
+    duplicate_ids = []
+    for image_id in ids:
+        suffix = '/' + image_id if whole_names else image_id
+        reversed_suffix = suffix.replace(os.sep, '/')[::-1]
+        start = bisect.bisect_left(reversed_keys, reversed_suffix)
+        end = start
+        while end < len(reversed_keys) and reversed_keys[end].startswith(reversed_suffix):
+            end += 1
+
+        if end - start == 1:
+            matched_paths.append(reversed_paths[start][1])
+        elif end == start:
+            missing_ids.append(image_id)
+        else:
+            duplicate_ids.append(image_id)
+
+    if missing_ids or duplicate_ids:
+        def _describe(problem_ids):
+            shown = ', '.join(repr(i) for i in problem_ids[:10])
+            return shown + (', ...' if len(problem_ids) > 10 else '')
+
+        message = 'Could not match every ID to a single file.'
+        if missing_ids:
+            message += ' Found no file for {} IDs: {}.'.format(len(missing_ids), _describe(missing_ids))
+        if duplicate_ids:
+            message += ' Found multiple files for {} IDs: {}.'.format(len(duplicate_ids), _describe(duplicate_ids))
+        raise ValueError(message)
+
+    return matched_paths
+
+
 def read_csv_labels(file_name, column_number=False, character=','):
     f = open(file_name, 'r', encoding='utf-8-sig')
     labels = []
@@ -0,0 +1,147 @@
+import numpy as np
+
+
+class StreamingStatistics(object):
+    """
+    Keeps a running count, mean, variance, sum of squares, min, and max of values that arrive a batch at a time, without
+    storing the values themselves. Batches are merged in with Chan et al.'s parallel form of Welford's algorithm, which
+    stays accurate for large numbers of values.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.sum_squares = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self._m2 = 0.0  # Sum of squared differences from the mean
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if values.size == 0:
+            return
+
+        batch_count = values.size
+        batch_mean = np.mean(values)
+        batch_m2 = np.sum(np.square(values - batch_mean))
+
+        total_count = self.count + batch_count
+        delta = batch_mean - self.mean
+        self.mean += delta * batch_count / total_count
+        self._m2 += batch_m2 + delta ** 2 * self.count * batch_count / total_count
+        self.count = total_count
+
+        self.sum_squares += np.sum(np.square(values))
+        self.min = min(self.min, np.min(values))
+        self.max = max(self.max, np.max(values))
+
+    @property
+    def variance(self):
+        """The population variance of the values (like np.var)"""
+        return self._m2 / self.count if self.count else np.nan
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    @property
+    def sum_squared_deviations(self):
+        """The sum of squared differences between the values and their mean"""
+        return self._m2
+
+
+class StreamingHistogram(object):
+    """
+    Builds a histogram of values that arrive a batch at a time. The bins start out spanning the first batch, and
+    whenever values fall outside of them, the bin width is doubled (merging neighbouring bins) until they fit. The
+    final bins cover all of the values, but can be up to twice as wide as the bins np.histogram would pick.
+    """
+
+    def __init__(self, num_bins=100):
+        if num_bins % 2 != 0:
+            raise ValueError("num_bins must be even")
+
+        self.num_bins = num_bins
+        self.counts = np.zeros(num_bins, dtype=np.int64)
+        self._low = None
+        self._width = None
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if values.size == 0:
+            return
+
+        low = np.min(values)
+        high = np.max(values)
+        if self._low is None:
+            # The top edge is kept above every value so that each bin only holds values from its own range
+            self._low = low
+            self._width = (high - low) / (self.num_bins - 1) if high > low else 1.0
+
+        while low < self._low or high >= self._low + self._width * self.num_bins:
+            # Merge pairs of bins, then put the freed up half of the bins on whichever side needs them
+            merged = self.counts.reshape(-1, 2).sum(axis=1)
+            empty = np.zeros_like(merged)
+            if low < self._low:
+                self._low -= self._width * self.num_bins
+                self.counts = np.concatenate([empty, merged])
+            else:
+                self.counts = np.concatenate([merged, empty])
+            self._width *= 2
+
+        bins = ((values - self._low) / self._width).astype(np.int64)
+        bins = np.clip(bins, 0, self.num_bins - 1)  # Guards against rounding at the edges
+        self.counts += np.bincount(bins, minlength=self.num_bins)
+
+    @property
+    def bin_edges(self):
+        if self._low is None:
+            return None
+        return self._low + self._width * np.arange(self.num_bins + 1)
+
+
+class StreamingAveragePrecision(object):
+    """
+    Accumulates detections (a confidence and whether it was a true positive) a batch at a time and calculates their
+    average precision. Detections are counted in fine-grained confidence bins instead of being stored, so detections
+    with confidences in the same bin are treated as tied.
+    """
+
+    def __init__(self, num_bins=10000):
+        self.num_bins = num_bins
+        self.true_positives = np.zeros(num_bins, dtype=np.int64)
+        self.false_positives = np.zeros(num_bins, dtype=np.int64)
+        self.num_truths = 0
+
+    def update(self, confidences, is_true_positive, num_truths=0):
+        """
+        Adds detections and ground truths to the running totals
+        :param confidences: The confidences (from 0 to 1) of each detection
+        :param is_true_positive: Flags for whether each detection was a true positive
+        :param num_truths: The number of ground truth objects the detections were matched against
+        """
+        confidences = np.asarray(confidences, dtype=np.float64).ravel()
+        is_true_positive = np.asarray(is_true_positive, dtype=bool).ravel()
+        bins = np.clip((confidences * self.num_bins).astype(np.int64), 0, self.num_bins - 1)
+
+        self.true_positives += np.bincount(bins[is_true_positive], minlength=self.num_bins)
+        self.false_positives += np.bincount(bins[~is_true_positive], minlength=self.num_bins)
+        self.num_truths += num_truths
+
+    def average_precision(self):
+        # Walk through the detections in order of descending confidence, skipping empty bins
+        true_positives = self.true_positives[::-1]
+        false_positives = self.false_positives[::-1]
+        non_empty = (true_positives + false_positives) > 0
+        if not np.any(non_empty):
+            return np.float32(0)
+
+        cumulative_tp = np.cumsum(true_positives)[non_empty]
+        cumulative_detections = np.cumsum(true_positives + false_positives)[non_empty]
+        precision = cumulative_tp / cumulative_detections
+        recall = cumulative_tp / self.num_truths if self.num_truths else np.zeros_like(precision)
+
+        # Make precision values the maximum precision at further recalls, then take the area under the curve
+        precision = np.maximum.accumulate(precision[::-1])[::-1]
+        recall = np.concatenate([[0], recall])
+        return np.sum(precision * (recall[1:] - recall[:-1]))
@@ -1,4 +1,4 @@
-from . import layers, loaders, definitions, DPPModel
+from . import layers, loaders, definitions, metrics, DPPModel
 import numpy as np
 import tensorflow.compat.v1 as tf
 import os
@@ -6,8 +6,6 @@ import json
 import warnings
 import copy
 import itertools
-import shutil
-from math import ceil
 from collections.abc import Sequence
 from scipy.special import expit
 from PIL import Image
@@ -41,6 +39,8 @@ class ObjectDetectionModel(DPPModel):
         self._THRESH_SIG = 0.6
         self._THRESH_OVERLAP = 0.3
         self._THRESH_CORRECT = 0.5
+        self._nms_in_graph = False
+        self._yolo_decoding_cache = {}
 
     def set_image_dimensions(self, image_height, image_width, image_depth):
         super().set_image_dimensions(image_height, image_width, image_depth)
@@ -107,6 +107,14 @@ class ObjectDetectionModel(DPPModel):
         self._THRESH_OVERLAP = thresh_overlap
         self._THRESH_CORRECT = thresh_correct
 
+    def set_nms_in_graph(self, in_graph):
+        """Do the non-maximal suppression of predicted boxes with Tensorflow's implementation instead of NumPy's. The
+        ops for it are built along with the rest of the graph, so this needs to be set before training or inference."""
+        if not isinstance(in_graph, bool):
+            raise TypeError("in_graph must be a bool")
+
+        self._nms_in_graph = in_graph
+
     def _yolo_compute_iou(self, pred_box, true_box):
         """Helper function to compute the intersection over union of pred_box and true_box
         pred_box and true_box represent multiple boxes with coords being x,y,w,h (0-indexed 0-3)"""
@@ -225,6 +233,14 @@ class ObjectDetectionModel(DPPModel):
 
         self._graph_ops['merged'] = tf.summary.merge_all(key='custom_summaries')
 
+    def _graph_reshape_labels(self, y):
+        """
+        Reshapes a batch of flat YOLO labels into per-grid cell labels
+        :param y: Tensor, a batch of labels with all of the values for an image in one dimension
+        :return: The labels with shape [batch_size, grid_w * grid_h, 5 + NUM_CLASSES]
+        """
+        return tf.reshape(y, [-1, self._grid_w * self._grid_h, 5 + self._NUM_CLASSES])
+
     def _assemble_graph(self):
         with self._graph.as_default():
             self._log('Assembling graph...')
@@ -233,25 +249,11 @@ class ObjectDetectionModel(DPPModel):
             with tf.device('device:cpu:0'):  # Only do preprocessing on the CPU to limit data transfer between devices
                 self._graph_parse_data()
 
-                # For object detection, we need to also deserialize the labels before batching the datasets
-                def _deserialize_label(im, lab):
-                    lab = tf.cond(tf.equal(tf.rank(lab), 0),
-                                  lambda: tf.reshape(lab, [1]),
-                                  lambda: lab)
-                    sparse_lab = tf.string_split(lab, sep=' ')
-                    lab_values = tf.strings.to_number(sparse_lab.values)
-                    lab = tf.reshape(lab_values, [self._grid_w * self._grid_h, 5 + self._NUM_CLASSES])
-                    return im, lab
-
                 # Batch the datasets and create iterators for them
-                self._train_dataset = self._train_dataset.map(_deserialize_label, num_parallel_calls=self._num_threads)
-                train_iter = self._batch_and_iterate(self._train_dataset, shuffle=True)
+                train_iter = self._batch_and_iterate(self._train_dataset, shuffle=True, augment=True)
                 if self._testing:
-                    self._test_dataset = self._test_dataset.map(_deserialize_label,
-                                                                num_parallel_calls=self._num_threads)
                     test_iter = self._batch_and_iterate(self._test_dataset)
                 if self._validation:
-                    self._val_dataset = self._val_dataset.map(_deserialize_label, num_parallel_calls=self._num_threads)
                     val_iter = self._batch_and_iterate(self._val_dataset)
 
                 if self._has_moderation:
@@ -275,6 +277,7 @@ class ObjectDetectionModel(DPPModel):
             for n, d in enumerate(self._get_device_list()):  # Build a graph on either the CPU or all of the GPUs
                 with tf.device(d), tf.name_scope('tower_' + str(n)):
                     x, y = train_iter.get_next()
+                    y = self._graph_reshape_labels(y)
 
                     # Run the network operations
                     if self._has_moderation:
@@ -313,6 +316,7 @@ class ObjectDetectionModel(DPPModel):
             # Calculate test and validation accuracy (on a single device at Tensorflow's discretion)
             if self._testing:
                 x_test, self._graph_ops['y_test'] = test_iter.get_next()
+                self._graph_ops['y_test'] = self._graph_reshape_labels(self._graph_ops['y_test'])
                 n_images = tf.cast(tf.shape(x_test)[0], tf.float32)
 
                 if self._has_moderation:
@@ -331,6 +335,7 @@ class ObjectDetectionModel(DPPModel):
 
             if self._validation:
                 x_val, self._graph_ops['y_val'] = val_iter.get_next()
+                self._graph_ops['y_val'] = self._graph_reshape_labels(self._graph_ops['y_val'])
                 n_images = tf.cast(tf.shape(x_val)[0], tf.float32)
 
                 if self._has_moderation:
@@ -347,6 +352,9 @@ class ObjectDetectionModel(DPPModel):
                 self._graph_ops['val_losses'] = self._graph_problem_loss(self._graph_ops['x_val_predicted'],
                                                                          self._graph_ops['y_val']) / n_images
 
+            if self._nms_in_graph:
+                self.__graph_non_max_suppression()
+
             # Epoch summaries for Tensorboard
             if self._tb_dir is not None:
                 self._graph_tensorboard_summary(l2_cost, gradients, variables, global_grad_norm)
@@ -368,63 +376,74 @@ class ObjectDetectionModel(DPPModel):
                 warnings.warn('Less than a batch of testing data')
                 exit()
 
-            # Initialize storage for the retrieved test variables
-            all_y = []
-            all_predictions = []
+            # Detections are scored a batch at a time, so only their totals are kept
+            average_precision = metrics.StreamingAveragePrecision()
 
             # Main test loop
             for _ in tqdm(range(num_batches)):
                 r_y, r_predicted = self._session.run([self._graph_ops['y_test'],
                                                       self._graph_ops['x_test_predicted']])
-                all_y.append(r_y)
-                all_predictions.append(r_predicted)
-
-            all_y = np.concatenate(all_y, axis=0)
-            all_predictions = np.concatenate(all_predictions, axis=0)
-
-            # Make the images heterogeneous, storing their separate grids in a list
-            test_labels = [all_y[i, ...] for i in range(all_y.shape[0])]
-            test_preds = [all_predictions[i, ...] for i in range(all_predictions.shape[0])]
-            n_images = len(test_labels)
-
-            # Convert coordinates, then filter out the positive ground truth labels and significant predictions
-            for i in range(n_images):
-                conv_label, conv_pred = self.__yolo_coord_convert(test_labels[i], test_preds[i])
-                truth_mask = conv_label[..., 0] == 1
-                if not np.any(truth_mask):
-                    conv_label = None
-                else:
-                    conv_label = conv_label[truth_mask, :]
-                conv_pred = self.__yolo_filter_predictions(conv_pred)
-                test_labels[i] = conv_label
-                test_preds[i] = conv_pred
+
+                # Convert coordinates, then filter out the positive ground truth labels and significant predictions
+                conv_labels, conv_preds = self.__yolo_coord_convert(r_y, r_predicted)
+                filtered_preds = self.__yolo_filter_batch_predictions(conv_preds)
+                for i in range(conv_labels.shape[0]):
+                    truth_mask = conv_labels[i, :, 0] == 1
+                    conv_label = conv_labels[i, truth_mask, :] if np.any(truth_mask) else None
+                    average_precision.update(*self.__yolo_detections(conv_label, filtered_preds[i]))
 
             # Get and log the map
-            yolo_map = self.__yolo_map(test_labels, test_preds)
+            yolo_map = average_precision.average_precision()
             self._log('Yolo mAP: {}'.format(yolo_map))
             return yolo_map.astype(np.float32)
 
-    def __yolo_coord_convert(self, labels=None, preds=None):
+    def __yolo_decoding_arrays(self, region_height, region_width):
+        """
+        Gets the arrays needed to decode Yolo boxes in pixel coordinates. These are cached since they only change with
+        the grid, anchors, and region size.
+
+        :param region_height: The height, in pixels, of the region covered by the Yolo grid
+        :param region_width: The width, in pixels, of the region covered by the Yolo grid
+        :return: The x and y offsets of each grid square's corner, the anchor widths and heights (all in pixels), and
+        the grid square width and height
+        """
+        key = (self._grid_w, self._grid_h, region_height, region_width, tuple(map(tuple, self._ANCHORS)))
+        if key not in self._yolo_decoding_cache:
+            scale_x = region_width / self._grid_w
+            scale_y = region_height / self._grid_h
+            x_offsets = (np.arange(self._grid_w * self._grid_h) % self._grid_w) * scale_x
+            y_offsets = (np.arange(self._grid_w * self._grid_h) // self._grid_w) * scale_y
+            anchors = np.array(self._ANCHORS)
+            self._yolo_decoding_cache = {key: (x_offsets, y_offsets,
+                                               anchors[:, 0] * scale_x, anchors[:, 1] * scale_y,
+                                               scale_x, scale_y)}
+
+        return self._yolo_decoding_cache[key]
+
+    def __yolo_coord_convert(self, labels=None, preds=None, region_size=None):
         """
         Converts Yolo labeled and predicted bounding boxes from xywh coords to x1y1x2y2 coords. Also accounts for
         required sigmoid and exponential conversions in the predictions (including the confidences)
 
-        :param labels: ndarray with Yolo ground-truth bounding boxes (size ?x(NUM_CLASSES+5))
-        :param preds: ndarray with Yolo predicted bounding boxes (size ?x(NUM_BOXES*5))
+        :param labels: ndarray with Yolo ground-truth bounding boxes (size ?x(NUM_CLASSES+5)), optionally with
+        leading batch (and patch) dimensions
+        :param preds: ndarray with Yolo predicted bounding boxes (size ?x(NUM_BOXES*5)), optionally with leading
+        batch (and patch) dimensions
+        :param region_size: The height and width of the region covered by the Yolo grid (e.g. a patch). Defaults to
+        the image dimensions
         :return: `labels` and `preds` with the bounding box coords changed from xywh to x1y1x2y2 and predicted box
         confidences converted to percents
         """
+        if region_size is None:
+            region_size = (self._image_height, self._image_width)
+        x_offsets, y_offsets, anchor_w, anchor_h, scale_x, scale_y = self.__yolo_decoding_arrays(*region_size)
 
-        def xywh_to_xyxy(x, y, w, h):
-            x_centre = np.arange(self._grid_w * self._grid_h) % self._grid_w
-            y_centre = np.arange(self._grid_w * self._grid_h) // self._grid_w
-            scale_x = self._image_width / self._grid_w
-            scale_y = self._image_height / self._grid_h
-
-            x = (x + x_centre) * scale_x
-            y = (y + y_centre) * scale_y
-            w = w * scale_x
-            h = h * scale_y
+        def xywh_to_xyxy(x, y, w, h, per_box=False):
+            # The grid squares are along the last axis, or the second last axis if there are several boxes per square
+            x_corner = x_offsets[:, np.newaxis] if per_box else x_offsets
+            y_corner = y_offsets[:, np.newaxis] if per_box else y_offsets
+            x = x * scale_x + x_corner
+            y = y * scale_y + y_corner
 
             x1 = x - w/2
             x2 = x + w/2
@@ -436,15 +455,13 @@ class ObjectDetectionModel(DPPModel):
             # Labels are already sensible numbers, so convert them first
             lab_coord_idx = np.arange(labels.shape[-1]-4, labels.shape[-1])
             lab_class, lab_x, lab_y, lab_w, lab_h = np.split(labels, lab_coord_idx, axis=-1)
-            lab_x1, lab_y1, lab_x2, lab_y2 = xywh_to_xyxy(np.squeeze(lab_x),  # Squeezing to aid broadcasting in helper
-                                                          np.squeeze(lab_y),
-                                                          np.squeeze(lab_w),
-                                                          np.squeeze(lab_h))
+            lab_x1, lab_y1, lab_x2, lab_y2 = xywh_to_xyxy(lab_x[..., 0], lab_y[..., 0],
+                                                          lab_w[..., 0] * scale_x, lab_h[..., 0] * scale_y)
             labels = np.concatenate([lab_class,
-                                     lab_x1[:, np.newaxis],  # Dummy dimensions to enable concatenation
-                                     lab_y1[:, np.newaxis],
-                                     lab_x2[:, np.newaxis],
-                                     lab_y2[:, np.newaxis]], axis=-1)
+                                     lab_x1[..., np.newaxis],  # Dummy dimensions to enable concatenation
+                                     lab_y1[..., np.newaxis],
+                                     lab_x2[..., np.newaxis],
+                                     lab_y2[..., np.newaxis]], axis=-1)
 
         if preds is not None:
             # Extract the class predictions and reorganize the predicted boxes
@@ -452,21 +469,13 @@ class ObjectDetectionModel(DPPModel):
             preds = np.reshape(preds[..., 0:self._NUM_BOXES * 5], preds.shape[:-1] + (self._NUM_BOXES, 5))
 
             # Predictions are not sensible numbers, so apply sigmoids and exponentials first and then convert them
-            anchors = np.array(self._ANCHORS)
             pred_x = expit(preds[..., 0])
             pred_y = expit(preds[..., 1])
-            pred_w = np.exp(preds[..., 2]) * anchors[:, 0]
-            pred_h = np.exp(preds[..., 3]) * anchors[:, 1]
+            pred_w = np.exp(preds[..., 2]) * anchor_w
+            pred_h = np.exp(preds[..., 3]) * anchor_h
             pred_conf = expit(preds[..., 4])
-            pred_x1, pred_y1, pred_x2, pred_y2 = xywh_to_xyxy(pred_x.T,  # Transposes to aid broadcasting in helper
-                                                              pred_y.T,
-                                                              pred_w.T,
-                                                              pred_h.T)
-            preds[..., :] = np.stack([pred_x1.T,  # Transposes to restore original shape
-                                      pred_y1.T,
-                                      pred_x2.T,
-                                      pred_y2.T,
-                                      pred_conf], axis=-1)
+            pred_x1, pred_y1, pred_x2, pred_y2 = xywh_to_xyxy(pred_x, pred_y, pred_w, pred_h, per_box=True)
+            preds = np.stack([pred_x1, pred_y1, pred_x2, pred_y2, pred_conf], axis=-1)
 
             # Reattach the class predictions
             preds = np.reshape(preds, preds.shape[:-2] + (self._NUM_BOXES * 5,))
@@ -482,50 +491,109 @@ class ObjectDetectionModel(DPPModel):
         are a list of, for each box, [x1, y1, x2, y2, conf] followed by a list of class predictions
         :return: `preds` with only the significant and maximal confidence predictions remaining
         """
+        return self.__yolo_filter_batch_predictions(preds[np.newaxis, ...])[0]
+
+    def __yolo_filter_batch_predictions(self, preds):
+        """
+        Filters the predicted bounding boxes for a batch of images by eliminating insignificant and overlapping
+        predictions
+
+        :param preds: ndarray with predicted bounding boxes for each image in each grid square (see
+        __yolo_filter_predictions), with the images along the first axis
+        :return: A list with, for each image, an ndarray of its significant and maximal confidence predictions, or None
+        if it has no significant predictions
+        """
         # Extract the class predictions and separate the predicted boxes
-        grid_count = preds.shape[0]
         class_preds = preds[..., self._NUM_BOXES * 5:]
         preds = np.reshape(preds[..., 0:self._NUM_BOXES * 5], preds.shape[:-1] + (self._NUM_BOXES, 5))
 
         # In each grid square, the highest confidence box is the one responsible for prediction
         max_conf_idx = np.argmax(preds[..., 4], axis=-1)
-        responsible_boxes = [preds[i, max_conf_idx[i], :] for i in range(grid_count)]
-        preds = np.stack(responsible_boxes, axis=0)
+        preds = np.take_along_axis(preds, max_conf_idx[..., np.newaxis, np.newaxis], axis=-2)[..., 0, :]
+
+        # Eliminate insignificant predicted boxes and apply non-maximal suppression (i.e. eliminate boxes that overlap
+        # with a more confident box) to each image. Box and class predictions should still match up, and the original
+        # grid order shouldn't matter for mAP calculations.
+        filtered_preds = []
+        for im_preds, im_class_preds, maximal_idx in zip(preds, class_preds, self.__batch_non_max_suppression(preds)):
+            if len(maximal_idx) == 0:
+                filtered_preds.append(None)
+                continue
+            filtered_preds.append(np.concatenate([im_preds[maximal_idx, :], im_class_preds[maximal_idx, :]], axis=-1))
 
-        # Eliminate insignificant predicted boxes
-        sig_mask = preds[:, 4] > self._THRESH_SIG
-        if not np.any(sig_mask):
-            return None
-        class_preds = class_preds[sig_mask, :]
-        preds = preds[sig_mask, :]
+        return filtered_preds
+
+    def __batch_non_max_suppression(self, preds):
+        """
+        Finds the significant boxes that don't overlap with a more confident box in each image of a batch
+
+        :param preds: ndarray with [x1, y1, x2, y2, conf] for each box in each image, with the images along the first
+        axis
+        :return: A list with, for each image, an ndarray of the indices of its remaining boxes in order of descending
+        confidence
+        """
+        if self._nms_in_graph:
+            # The whole batch is suppressed with one run of the ops built with the graph, and the padding is dropped
+            batch_idx = self._session.run(self._graph_ops['nms_indices'],
+                                          feed_dict={self._graph_ops['nms_boxes']: preds[..., 0:4],
+                                                     self._graph_ops['nms_confidences']: preds[..., 4],
+                                                     self._graph_ops['nms_sig_threshold']: self._THRESH_SIG,
+                                                     self._graph_ops['nms_threshold']: self._THRESH_OVERLAP})
+            return [im_idx[im_idx >= 0].astype(np.int64) for im_idx in batch_idx]
 
-        # Apply non-maximal suppression (i.e. eliminate boxes that overlap with a more confidant box)
         maximal_idx = []
-        sig_grid_count = preds.shape[0]
-        conf_order = np.argsort(preds[:, 4])
-        pair_iou = np.array([self.__compute_iou(preds[i, 0:4], preds[j, 0:4])
-                             for i in range(sig_grid_count) for j in range(sig_grid_count)])
-        pair_iou = pair_iou.reshape(sig_grid_count, sig_grid_count)
-        while len(conf_order) > 0:
-            # Take the most confidant box, then cull the list down to boxes that don't overlap with it
-            cur_grid = conf_order[-1]
-            maximal_idx.append(cur_grid)
-            non_overlap = pair_iou[cur_grid, conf_order] < self._THRESH_OVERLAP
-            if np.any(non_overlap):
-                conf_order = conf_order[non_overlap]
-                # Make sure that the most confidant box itself isn't still in the list (usually by having a self-IOU of
-                # 0.999999... when the overlap threshold is 1)
-                conf_order = conf_order[conf_order != cur_grid]
-            else:
-                break
+        for im_preds in preds:
+            sig_idx = np.flatnonzero(im_preds[:, 4] > self._THRESH_SIG)
+            maximal_idx.append(sig_idx[self.__non_max_suppression(im_preds[sig_idx, 0:4], im_preds[sig_idx, 4])])
+        return maximal_idx
 
-        # Stick things back together. maximal_idx is not sorted, but box and class predictions should still match up
-        # and the original grid order shouldn't matter for mAP calculations
-        class_preds = class_preds[maximal_idx, :]
-        preds = preds[maximal_idx, :]
-        preds = np.concatenate([preds, class_preds], axis=-1)
+    def __graph_non_max_suppression(self):
+        """
+        Builds the graph ops for Tensorflow's non-maximal suppression over a batch of predicted boxes, unless they've
+        already been built. Each image's box indices are padded out with -1 to the number of boxes per image.
+        """
+        if 'nms_indices' in self._graph_ops:
+            return
 
-        return preds
+        with self._graph.as_default():
+            boxes = tf.placeholder(tf.float32, [None, None, 4])
+            confidences = tf.placeholder(tf.float32, [None, None])
+            sig_threshold = tf.placeholder(tf.float32, [])
+            threshold = tf.placeholder(tf.float32, [])
+
+            def image_nms(image_boxes):
+                im_boxes, im_confidences = image_boxes
+                num_boxes = tf.shape(im_boxes)[0]
+                maximal_idx = tf.image.non_max_suppression(im_boxes, im_confidences, num_boxes,
+                                                           iou_threshold=threshold, score_threshold=sig_threshold)
+                return tf.pad(maximal_idx, [[0, num_boxes - tf.shape(maximal_idx)[0]]], constant_values=-1)
+
+            self._graph_ops['nms_boxes'] = boxes
+            self._graph_ops['nms_confidences'] = confidences
+            self._graph_ops['nms_sig_threshold'] = sig_threshold
+            self._graph_ops['nms_threshold'] = threshold
+            self._graph_ops['nms_indices'] = tf.map_fn(image_nms, (boxes, confidences), dtype=tf.int32)
+
+    def __non_max_suppression(self, boxes, confidences):
+        """
+        Finds the boxes that don't overlap with a more confident box. Boxes are suppressed when their IoU with a more
+        confident box is over the overlap threshold, as in tf.image.non_max_suppression.
+
+        :param boxes: ndarray with [x1, y1, x2, y2] for each box
+        :param confidences: ndarray with the confidence of each box
+        :return: The indices of the remaining boxes, in order of descending confidence
+        """
+        pair_iou = self.__compute_iou(boxes[:, np.newaxis, :], boxes[np.newaxis, :, :])
+        conf_order = np.argsort(confidences)
+        maximal_idx = []
+        while len(conf_order) > 0:
+            # Take the most confident box, then cull the list down to boxes that don't overlap with it
+            cur_box = conf_order[-1]
+            maximal_idx.append(cur_box)
+            conf_order = conf_order[:-1]
+            conf_order = conf_order[pair_iou[cur_box, conf_order] <= self._THRESH_OVERLAP]
+
+        return np.array(maximal_idx, dtype=np.int64)
 
     def __yolo_map(self, labels, preds):
         """
@@ -537,140 +605,109 @@ class ObjectDetectionModel(DPPModel):
         of box parameters [x1, y1, x2, y2, conf] followed by a list of class predictions
         :return: The mean average precision (mAP) of the predictions
         """
-        # Go over each prediction in each image and determine if it's a true or false positive
-        detections = []
+        # With multiple classes, we would also have class tags in the detections so there could be class-separated
+        # accumulators, giving multiple AP values and one true mean AP. We aren't doing that right now because of our
+        # one-class plant detector assumption
+        average_precision = metrics.StreamingAveragePrecision()
         for im_lab, im_pred in zip(labels, preds):
-            # No predictions means no positives
-            if im_pred is None:
-                continue
-            n_pred = im_pred.shape[0]
+            average_precision.update(*self.__yolo_detections(im_lab, im_pred))
 
-            # No labels means all false positives
-            if im_lab is None:
-                for i in range(n_pred):
-                    detections.append((im_pred[i, 4], 0))
-                continue
-            n_lab = im_lab.shape[0]
-
-            # Add a 7th value to the labels so we can tell which ones get matched up with true positives
-            im_lab = np.concatenate([im_lab, np.zeros((n_lab, 1))], axis=-1)
-
-            # Calculate the IoUs of all the prediction and label pairings, then record each detection as a true or
-            # false positive with the prediction confidence
-            pair_ious = np.array([self.__compute_iou(im_pred[i, 0:4], im_lab[j, 2:6])
-                                  for i in range(n_pred) for j in range(n_lab)])
-            pair_ious = np.reshape(pair_ious, (n_pred, n_lab))
-            for i in range(n_pred):
-                j = np.argmax(pair_ious[i, :])
-                if pair_ious[i, j] >= self._THRESH_CORRECT and not im_lab[j, 6]:
-                    detections.append((im_pred[i, 4], 1))
-                    im_lab[j, 6] = 1
-                else:
-                    detections.append((im_pred[i, 4], 0))
+        return average_precision.average_precision()
 
-        # If there are no valid predictions at all, the mAP is 0
-        if not detections:
-            return np.float32(0)  # We need to play nice with compute_full_test_accuracy()'s return
+    def __yolo_detections(self, im_lab, im_pred):
+        """
+        Determines whether each prediction for an image is a true or false positive
 
-        # With multiple classes, we would also have class tags in the detection tuples so the below code could generate
-        # and iterate over class-separated detection lists, giving multiple AP values and one true mean AP. We aren't
-        # doing that right now because of our one-class plant detector assumption
+        :param im_lab: ndarray with the ground truth bounding box labels for the image (see __yolo_map), or None
+        :param im_pred: ndarray with the significant predicted bounding boxes for the image (see __yolo_map), or None
+        :return: The confidence of each prediction, whether each one is a true positive, and the number of labels
+        """
+        n_lab = im_lab.shape[0] if im_lab is not None else 0
+
+        # No predictions means no positives
+        if im_pred is None:
+            return np.zeros(0), np.zeros(0, dtype=bool), n_lab
+        n_pred = im_pred.shape[0]
+        confidences = im_pred[:, 4]
+
+        # No labels means all false positives
+        if im_lab is None:
+            return confidences, np.zeros(n_pred, dtype=bool), 0
+
+        # Calculate the IoUs of all the prediction and label pairings, then record each detection as a true or false
+        # positive, matching each label with at most one prediction
+        pair_ious = self.__compute_iou(im_pred[:, np.newaxis, 0:4], im_lab[np.newaxis, :, 2:6])
+        is_matched = np.zeros(n_lab, dtype=bool)
+        is_true_positive = np.zeros(n_pred, dtype=bool)
+        for i in range(n_pred):
+            j = np.argmax(pair_ious[i, :])
+            if pair_ious[i, j] >= self._THRESH_CORRECT and not is_matched[j]:
+                is_true_positive[i] = True
+                is_matched[j] = True
+
+        return confidences, is_true_positive, n_lab
+
+    def _graph_inference_inputs(self, x):
+        if self._with_patching:
+            # Processing and returning whole images is more important than preventing erroneous results from padding,
+            # so the images are padded as needed to accommodate the patch size
+            x = self._graph_tile_patches(x)
+        return x
 
-        # Determine the precision-recall curve from the cumulative detected true and false positives (in order of
-        # descending confidence)
-        detections = np.array(sorted(detections, key=lambda d: d[0], reverse=True))
-        n_truths = sum([x.shape[0] if (x is not None) else 0
-                        for x in labels])
-        n_positives = detections.shape[0]
-        true_positives = np.cumsum(detections[:, 1])
-        precision = true_positives / np.arange(1, n_positives+1)
-        recall = true_positives / n_truths
+    def _graph_inference_ops(self):
+        super()._graph_inference_ops()
+        if self._nms_in_graph:
+            self.__graph_non_max_suppression()
 
-        # Calculate the area under the precision-recall curve (== AP)
-        for i in range(precision.size - 1, 0, -1):  # Make precision values the maximum precision at further recalls
-            precision[i - 1] = np.max((precision[i], precision[i-1]))
-        ap = np.sum(precision[1:] * (recall[1:] - recall[0:-1]))
+    def _inference_batch_outputs(self, xx):
+        if self._with_patching:
+            num_patch_rows, num_patch_cols, _, _ = self._patch_tiling()
+            xx_output_size = [-1, num_patch_rows * num_patch_cols,
+                              self._grid_w * self._grid_h, 5 * self._NUM_BOXES + self._NUM_CLASSES]
+        else:
+            xx_output_size = [-1,
+                              self._grid_w * self._grid_h, 5 * self._NUM_BOXES + self._NUM_CLASSES]
 
-        return ap
+        return np.reshape(xx, xx_output_size)
 
     def forward_pass_with_file_inputs(self, images):
-        with self._graph.as_default():
-            num_batches = len(images) // self._batch_size
-            if len(images) % self._batch_size != 0:
-                num_batches += 1
-
-            self._parse_images(images)
-            im_data = self._all_images.batch(self._batch_size).prefetch(1)
-            x_test = im_data.make_one_shot_iterator().get_next()
-
-            if self._with_patching:
-                # Processing and returning whole images is more important than preventing erroneous results from
-                # padding, so we the image size with the required padding to accommodate the patch size
-                patch_height = self._patch_height
-                patch_width = self._patch_width
-                num_patch_rows = ceil(self._image_height / patch_height)
-                num_patch_cols = ceil(self._image_width / patch_width)
-                final_height = num_patch_rows * patch_height
-                final_width = num_patch_cols * patch_width
-
-                # Apply any padding to the images if, then extract the patches. Padding is only added to the bottom and
-                # right sides.
-                x_test = tf.image.pad_to_bounding_box(x_test, 0, 0, final_height, final_width)
-                sizes = [1, patch_height, patch_width, 1]
-                strides = [1, patch_height, patch_width, 1]  # Same as sizes in order to tightly tile patches
-                rates = [1, 1, 1, 1]
-                x_test = tf.image.extract_image_patches(x_test, sizes=sizes, strides=strides, rates=rates,
-                                                        padding="VALID")
-                x_test = tf.reshape(x_test, shape=[-1, patch_height, patch_width, self._image_depth])
-
-            if self._load_from_saved:
-                self.load_state()
-
-            # Run model on them
-            x_pred = self.forward_pass(x_test, deterministic=True)
-
-            if self._with_patching:
-                xx_output_size = [-1, num_patch_rows * num_patch_cols,
-                                  self._grid_w * self._grid_h, 5 * self._NUM_BOXES + self._NUM_CLASSES]
-            else:
-                xx_output_size = [-1,
-                                  self._grid_w * self._grid_h, 5 * self._NUM_BOXES + self._NUM_CLASSES]
-
-            total_outputs = []
-            for i in range(int(num_batches)):
-                xx = self._session.run(x_pred)
-                xx = np.reshape(xx, xx_output_size)
-                for img in np.array_split(xx, self._batch_size):
-                    total_outputs.append(img)
-
-            # Delete the weird first row and any outputs which are overruns from the last batch
-            total_outputs = np.concatenate(total_outputs, axis=0)
-
-        return total_outputs
+        batch_outputs = map(self._inference_batch_outputs, self._forward_pass_batches(images))
+        return self._stack_inference_batches(len(images), batch_outputs)
 
     def forward_pass_with_interpreted_outputs(self, x):
+        """
+        Runs the model on images and interprets the outputs as bounding boxes
+        :param x: A list of image filenames
+        :return: A list with, for each image, an ndarray of its significant predicted boxes in image coordinates
+        (each a list of [x1, y1, x2, y2, conf] followed by class predictions), or None if there are no such boxes
+        """
         total_outputs = self.forward_pass_with_file_inputs(x)
         n_images = total_outputs.shape[0]
 
         if self._with_patching:
-            num_patches_vert = self._image_height // self._patch_height
-            num_patches_horiz = self._image_width // self._patch_width
-            num_patches = num_patches_horiz * num_patches_vert
-
-            im_preds = []
-            for i in range(n_images):
-                patch_preds = []
-                for j in range(num_patches):
-                    _, conv_preds = self.__yolo_coord_convert(None, total_outputs[i, j, ...])
-                    filtered_preds = self.__yolo_filter_predictions(conv_preds)
-                    patch_preds.append(filtered_preds)
-                im_preds.append(patch_preds)
+            # Decode every patch of every image at once, then shift the boxes from patch coordinates to image
+            # coordinates. Patches are tiled in row-major order.
+            num_patches = total_outputs.shape[1]
+            _, num_patch_cols, stride_h, stride_w = self._patch_tiling()
+            _, conv_preds = self.__yolo_coord_convert(None, total_outputs,
+                                                      region_size=(self._patch_height, self._patch_width))
+            patch_x = (np.arange(num_patches) % num_patch_cols) * stride_w
+            patch_y = (np.arange(num_patches) // num_patch_cols) * stride_h
+            patch_shift = np.stack([patch_x, patch_y, patch_x, patch_y, np.zeros(num_patches)], axis=-1)
+
+            box_preds = np.reshape(conv_preds[..., 0:self._NUM_BOXES * 5],
+                                   conv_preds.shape[:-1] + (self._NUM_BOXES, 5))
+            box_preds = box_preds + patch_shift[np.newaxis, :, np.newaxis, np.newaxis, :]
+            conv_preds = np.concatenate([np.reshape(box_preds, conv_preds.shape[:-1] + (self._NUM_BOXES * 5,)),
+                                         conv_preds[..., self._NUM_BOXES * 5:]], axis=-1)
+
+            # Treating all of an image's patches as one big grid lets non-maximal suppression merge the boxes for
+            # objects that were split across patch borders
+            conv_preds = np.reshape(conv_preds, (n_images, -1, conv_preds.shape[-1]))
+            im_preds = self.__yolo_filter_batch_predictions(conv_preds)
         else:
-            im_preds = []
-            for i in range(n_images):
-                _, conv_preds = self.__yolo_coord_convert(None, total_outputs[i, ...])
-                filtered_preds = self.__yolo_filter_predictions(conv_preds)
-                im_preds.append(filtered_preds)
+            _, conv_preds = self.__yolo_coord_convert(None, total_outputs)
+            im_preds = self.__yolo_filter_batch_predictions(conv_preds)
 
         return im_preds
 
@@ -678,19 +715,20 @@ class ObjectDetectionModel(DPPModel):
         """
         Need to somehow merge with the iou helper function in the yolo cost function.
 
-        :param box1: x1, y1, x2, y2
-        :param box2: x1, y1, x2, y2
+        :param box1: x1, y1, x2, y2 along the last axis; other axes are broadcast against box2's (e.g. to get the IoUs
+        of every pair of boxes from two lists)
+        :param box2: x1, y1, x2, y2 along the last axis
         :return: Intersection Over Union of box1 and box2
         """
-        x1 = np.maximum(box1[0], box2[0])
-        y1 = np.maximum(box1[1], box2[1])
-        x2 = np.minimum(box1[2], box2[2])
-        y2 = np.minimum(box1[3], box2[3])
+        x1 = np.maximum(box1[..., 0], box2[..., 0])
+        y1 = np.maximum(box1[..., 1], box2[..., 1])
+        x2 = np.minimum(box1[..., 2], box2[..., 2])
+        y2 = np.minimum(box1[..., 3], box2[..., 3])
 
         intersection_area = np.maximum(0., x2 - x1) * np.maximum(0., y2 - y1)
         union_area = \
-            ((box1[2] - box1[0]) * (box1[3] - box1[1])) + \
-            ((box2[2] - box2[0]) * (box2[3] - box2[1])) - \
+            ((box1[..., 2] - box1[..., 0]) * (box1[..., 3] - box1[..., 1])) + \
+            ((box2[..., 2] - box2[..., 0]) * (box2[..., 3] - box2[..., 1])) - \
             intersection_area
 
         return intersection_area / union_area
@@ -820,7 +858,8 @@ class ObjectDetectionModel(DPPModel):
     def __autopatch_object_detection_dataset(self, patch_dir=None):
         """
         Generates a dataset of image patches from a loaded dataset of larger images and returns the new images and
-        labels. This will check for existing patches first and load them if found unless data overwriting is turned on.
+        labels. Patches from an earlier run are reused if none of the images, labels, or patching settings have changed
+        since, unless data overwriting is turned on.
         :param patch_dir: The directory to place patched images into, or where to read previous patches from
         :return: The patched dataset as a list of image filenames and a nested list of their corresponding point labels
         """
@@ -829,23 +868,39 @@ class ObjectDetectionModel(DPPModel):
         patch_dir = os.path.join(patch_dir, 'tmp_train', '')
         img_dir = os.path.join(patch_dir, 'image_patches', '')
         json_file = os.path.join(patch_dir, 'train_patches.json')
+        self._log("Patching dataset: Patches will be in " + patch_dir)
 
-        if os.path.exists(patch_dir) and not self._gen_data_overwrite:
-            # If there already is a patched dataset, just load it
-            self._log("Loading preexisting patched data from " + patch_dir)
-            self._json_no_convert = True
-            self.load_json_labels_from_file(json_file)
-            img_list = loaders.get_dir_images(img_dir)
-            self.load_images_from_list(img_list)
-            self._json_no_convert = False
-            return self._raw_image_files, self._all_labels
+        # Patches are picked at random from across all of the images (and how many are picked depends on how many
+        # images there are), so the whole patched dataset is one item in the cache
+        settings = [self._patch_height, self._patch_width, self._grid_h, self._grid_w]
+        key = self._generated_data_key(settings, *self._raw_image_files,
+                                       *[np.asarray(boxes, dtype=np.float64) for boxes in self._all_labels])
+        patched_data = []
 
-        self._log("Patching dataset: Patches will be in " + patch_dir)
-        if os.path.exists(patch_dir):
-            self._log("Overwriting preexisting patched data...")
-            shutil.rmtree(patch_dir)
-        os.makedirs(patch_dir)
-        os.makedirs(img_dir)
+        def generate_patches(indices):
+            patched_data.extend(self.__generate_object_detection_patches(img_dir, json_file))
+            files = [os.path.relpath(f, patch_dir) for f in patched_data[0]] + [os.path.basename(json_file)]
+            yield {'files': files}
+
+        self._update_generated_data(patch_dir, [key], generate_patches)
+        if patched_data:
+            return patched_data
+
+        self._json_no_convert = True
+        self.load_json_labels_from_file(json_file)
+        img_list = loaders.get_dir_images(img_dir)
+        self.load_images_from_list(img_list)
+        self._json_no_convert = False
+        return self._raw_image_files, self._all_labels
+
+    def __generate_object_detection_patches(self, img_dir, json_file):
+        """
+        Generates patches for an object detection dataset from the loaded images and labels and saves them to disk
+        :param img_dir: The directory to save the patch images in
+        :param json_file: The JSON file to save the patch labels in
+        :return: The list of patch filenames and the nested list of their labels
+        """
+        os.makedirs(img_dir, exist_ok=True)
 
         # We need to construct a patched dataset, but we'll be picking them out with various methods
         img_dict = {}
@@ -1079,7 +1134,7 @@ class ObjectDetectionModel(DPPModel):
             self._log(str(img_num + 1) + '/' + str(num_orig_images))
 
         # Save all of the patch labels as a JSON file before returning the patch filenames and labels
-        with open(json_file + 'train_patches.json', 'w', encoding='utf-8') as outfile:
+        with open(json_file, 'w', encoding='utf-8') as outfile:
             json.dump(img_dict, outfile)
 
         return new_raw_image_files, new_raw_labels
@@ -1,4 +1,4 @@
-from . import layers, loaders, definitions, DPPModel
+from . import layers, loaders, definitions, metrics, DPPModel
 import numpy as np
 import tensorflow.compat.v1 as tf
 import os
@@ -56,25 +56,11 @@ class RegressionModel(DPPModel):
                 # Generate training, testing, and validation datasets
                 self._graph_parse_data()
 
-                # For regression, we need to also deserialize the labels before batching the datasets
-                def _deserialize_label(im, lab):
-                    lab = tf.cond(tf.equal(tf.rank(lab), 0),
-                                  lambda: tf.reshape(lab, [1]),
-                                  lambda: lab)
-                    sparse_lab = tf.string_split(lab, sep=' ')
-                    lab_values = tf.strings.to_number(sparse_lab.values)
-                    lab = tf.reshape(lab_values, [self._num_regression_outputs])
-                    return im, lab
-
                 # Batch the datasets and create iterators for them
-                self._train_dataset = self._train_dataset.map(_deserialize_label, num_parallel_calls=self._num_threads)
-                train_iter = self._batch_and_iterate(self._train_dataset, shuffle=True)
+                train_iter = self._batch_and_iterate(self._train_dataset, shuffle=True, augment=True)
                 if self._testing:
-                    self._test_dataset = self._test_dataset.map(_deserialize_label,
-                                                                num_parallel_calls=self._num_threads)
                     test_iter = self._batch_and_iterate(self._test_dataset)
                 if self._validation:
-                    self._val_dataset = self._val_dataset.map(_deserialize_label, num_parallel_calls=self._num_threads)
                     val_iter = self._batch_and_iterate(self._val_dataset)
 
                 if self._has_moderation:
@@ -236,36 +222,38 @@ class RegressionModel(DPPModel):
                 warnings.warn('Less than a batch of testing data')
                 exit()
 
-            all_losses = []
-            all_y = []
-            all_predictions = []
+            # Statistics are accumulated a batch at a time, so memory use doesn't grow with the test set
+            loss_stats = metrics.StreamingStatistics()
+            abs_loss_stats = metrics.StreamingStatistics()
+            y_stats = metrics.StreamingStatistics()
+            loss_hist = metrics.StreamingHistogram(num_bins=100)
 
             # Main test loop
             for _ in tqdm(range(num_batches)):
                 r_losses, r_y, r_predicted = self._session.run([self._graph_ops['test_losses'],
                                                                 self._graph_ops['y_test'],
                                                                 self._graph_ops['x_test_predicted']])
-                all_losses.append(r_losses)
-                all_y.append(r_y)
-                all_predictions.append(r_predicted)
+                loss_stats.update(r_losses)
+                abs_loss_stats.update(np.abs(r_losses))
+                y_stats.update(r_y)
+                loss_hist.update(r_losses)
 
-            all_losses = np.concatenate(all_losses, axis=0)
-            all_y = np.concatenate(all_y, axis=0)
-            all_predictions = np.concatenate(all_predictions, axis=0)
+                self._log('Test labels:')
+                self._log(r_y)
+                self._log('Predictions:')
+                self._log(r_predicted)
 
             # For regression problems we want relative and abs mean, std of L2 norms, plus a histogram of errors
-            abs_mean = np.mean(np.abs(all_losses))
-            abs_var = np.var(np.abs(all_losses))
-            abs_std = np.sqrt(abs_var)
+            abs_mean = np.float64(abs_loss_stats.mean)
+            abs_std = abs_loss_stats.std
 
-            mean = np.mean(all_losses)
-            var = np.var(all_losses)
-            mse = np.mean(np.square(all_losses))
-            std = np.sqrt(var)
-            loss_max = np.amax(all_losses)
-            loss_min = np.amin(all_losses)
+            mean = loss_stats.mean
+            mse = loss_stats.sum_squares / loss_stats.count
+            std = loss_stats.std
+            loss_max = loss_stats.max
+            loss_min = loss_stats.min
 
-            hist, _ = np.histogram(all_losses, bins=100)
+            hist = loss_hist.counts
 
             self._log('Mean loss: {}'.format(mean))
             self._log('Loss standard deviation: {}'.format(std))
@@ -275,9 +263,8 @@ class RegressionModel(DPPModel):
             self._log('Max error: {}'.format(loss_max))
             self._log('MSE: {}'.format(mse))
 
-            all_y_mean = np.mean(all_y)
-            total_error = np.sum(np.square(all_y - all_y_mean))
-            unexplained_error = np.sum(np.square(all_losses))
+            total_error = y_stats.sum_squared_deviations
+            unexplained_error = loss_stats.sum_squares
             # division by zero can happen when using small test sets
             if total_error == 0:
                 r2 = -np.inf
@@ -285,11 +272,6 @@ class RegressionModel(DPPModel):
                 r2 = 1. - (unexplained_error / total_error)
 
             self._log('R^2: {}'.format(r2))
-            self._log('All test labels:')
-            self._log(all_y)
-
-            self._log('All predictions:')
-            self._log(all_predictions)
 
             self._log('Histogram of {} losses:'.format(self._loss_fn))
             self._log(hist)
@@ -297,30 +279,7 @@ class RegressionModel(DPPModel):
             return abs_mean.astype(np.float32)
 
     def forward_pass_with_file_inputs(self, images):
-        with self._graph.as_default():
-            num_batches = len(images) // self._batch_size
-            if len(images) % self._batch_size != 0:
-                num_batches += 1
-
-            self._parse_images(images)
-            im_data = self._all_images.batch(self._batch_size).prefetch(1)
-            x_test = im_data.make_one_shot_iterator().get_next()
-
-            if self._load_from_saved:
-                self.load_state()
-
-            # Run model on them
-            x_pred = self.forward_pass(x_test, deterministic=True)
-
-            total_outputs = []
-            for i in range(int(num_batches)):
-                xx = self._session.run(x_pred)
-                for img in np.array_split(xx, xx.shape[0]):
-                    total_outputs.append(img)
-
-            total_outputs = np.concatenate(total_outputs, axis=0)
-
-        return total_outputs
+        return self._stack_inference_batches(len(images), self._forward_pass_batches(images))
 
     def forward_pass_with_interpreted_outputs(self, x):
         # Nothing special required for regression
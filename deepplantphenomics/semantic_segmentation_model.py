@@ -2,15 +2,103 @@ from . import loaders, layers, definitions, DPPModel
 import numpy as np
 import tensorflow.compat.v1 as tf
 import os
+import time
 import warnings
 import copy
-import itertools
-import shutil
+import threading
+import collections
+import tempfile
+import concurrent.futures
 from math import ceil
-from tqdm import tqdm, trange
+from tqdm import tqdm
 from PIL import Image
 
 
+def _patch_coords(im_height, im_width, patch_height, patch_width):
+    """
+    Gets the starting (top-left) and ending (bottom-right) coordinates for splitting an image into patches. Patches
+    are taken starting from the top and left edges of the image and continue, padding the bottom and right images
+    with black if they go over the edge.
+    :param im_height: The height of the image
+    :param im_width: The width of the image
+    :param patch_height: The height of the patches
+    :param patch_width: The width of the patches
+    :return: Lists of tuples with the starting (top-left) and ending (bottom-right) coordinates for patches
+    """
+    num_patch_h = ceil(im_height / patch_height)
+    num_patch_w = ceil(im_width / patch_width)
+
+    patch_start = [(y * patch_height, x * patch_width) for y in range(num_patch_h) for x in range(num_patch_w)]
+    patch_end = [(y + patch_height, x + patch_width) for (y, x) in patch_start]
+
+    return patch_start, patch_end
+
+
+def _extract_patch(im, tl_coord, br_coord):
+    """
+    Extracts a patch from an image, padding it with black if it extends over the edge
+    :param im: An ndarray for the image to extract the patch from
+    :param tl_coord: A tuple for the top-left (y, x) corner of the patch
+    :param br_coord: A tuple for the bottom-right (y, x) corner of the patch
+    :return: An ndarray of the extracted patch suitable for saving as a PNG
+    """
+    y0, x0 = tl_coord
+    y1, x1 = br_coord
+    patch_x = x1 - x0
+    patch_y = y1 - y0
+    if im.ndim == 2:
+        im = np.expand_dims(im, axis=-1)  # Give 2D images an explicit 1-channel dimension
+    im_height, im_width, im_depth = im.shape
+
+    fill_x = x1 - im_width if x1 > im_width else 0
+    fill_y = y1 - im_height if y1 > im_height else 0
+    if x1 > im_width:
+        x1 -= fill_x
+    if y1 > im_height:
+        y1 -= fill_y
+
+    im_patch = np.full((patch_y, patch_x, im_depth), 0, dtype=np.uint8)
+    im_patch[0:patch_y - fill_y, 0:patch_x - fill_x, :] = im[y0:y1, x0:x1, :].astype(np.uint8)
+
+    if im_depth == 1:
+        return im_patch.squeeze(axis=2)  # Remove the 1-channel dimension; some image libraries don't like it
+    return im_patch
+
+
+def _read_image_array(im_file, mode):
+    """
+    Reads an image file into an ndarray with the given PIL mode. Palette images are kept as their palette indices when
+    one channel is wanted, since that's how segmentation masks with several classes tend to be stored.
+    :param im_file: The image file to read
+    :param mode: The PIL mode to convert the image to, e.g. 'RGB' or 'L'
+    :return: An ndarray of the image
+    """
+    with Image.open(im_file) as im:
+        if im.mode != mode and not (im.mode == 'P' and mode == 'L'):
+            im = im.convert(mode)
+        return np.array(im)
+
+
+def _write_patch_container(job):
+    """
+    Splits an image into patches and saves all of them together as one uncompressed .npy file (a patch container),
+    which is much faster to write and read than a PNG for each patch. The container is written under a temporary name
+    and renamed once it's done, so a container that exists is always complete.
+    :param job: A tuple of the image file, the container file to write, the PIL mode to convert the image to, and the
+    patch height and width
+    """
+    im_file, container_file, mode, patch_height, patch_width = job
+    im = _read_image_array(im_file, mode)
+
+    patch_start, patch_end = _patch_coords(im.shape[0], im.shape[1], patch_height, patch_width)
+    patches = np.stack([_extract_patch(im, tl_coord, br_coord) for tl_coord, br_coord in zip(patch_start, patch_end)])
+    patches = np.reshape(patches, [len(patch_start), patch_height, patch_width, -1])
+
+    temp_file = container_file + '.part.npy'
+    np.save(temp_file, patches)
+    os.replace(temp_file, container_file)
+
+
 class SemanticSegmentationModel(DPPModel):
     _supported_loss_fns = ['sigmoid cross entropy', 'softmax cross entropy']
     _supported_augmentations = [definitions.AugmentationType.CONTRAST_BRIGHT]
@@ -24,6 +112,68 @@ class SemanticSegmentationModel(DPPModel):
         # State variables specific to semantic segmentation for constructing the graph and passing to Tensorboard
         self._graph_forward_pass = None
 
+        # Autopatched datasets are made of references to patches in patch containers, which may still be getting
+        # written by a pool of threads while the model trains on the ones that are done
+        self._patch_container_input = False
+        self._parse_from_patch_containers = False
+        self._patch_pool = None
+        self._patch_generation = None
+        self._patch_containers = {}
+
+        # Virtual patching keeps an index of patches in the source images instead of writing patches out, and cuts them
+        # from recently decoded source images as they're loaded
+        self._virtual_patching = False
+        self._virtual_patch_random_offsets = False
+        self._virtual_patch_input = False
+        self._parse_virtual_patches = False
+        self._virtual_patch_sources = collections.OrderedDict()
+        self._virtual_patch_lock = threading.Lock()
+        self._records_patch_dir = None
+
+    def __getstate__(self):
+        # The patch containers have to be finished for another process to use them, since it can't see the pool
+        if self._patch_generation is not None:
+            concurrent.futures.wait(self._patch_generation)
+
+        state = super().__getstate__()
+        state['_patch_pool'] = None
+        state['_patch_generation'] = None
+        state['_patch_containers'] = {}
+        state['_virtual_patch_sources'] = collections.OrderedDict()
+        state['_virtual_patch_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self._virtual_patch_lock = threading.Lock()
+
+    def shut_down(self):
+        super().shut_down()
+
+        if self._patch_pool is not None:
+            # Containers that haven't been started are dropped, and the ones being written are left to finish
+            for job in self._patch_generation:
+                job.cancel()
+            self._patch_pool.shutdown()
+            self._patch_pool = None
+
+    def set_virtual_patching(self, virtual, random_offsets=False):
+        """
+        Sets whether automatic patching of training images is done virtually. Instead of writing patches to disk before
+        training, the loaders keep an index of where each patch is in the source images, and the patches (and their
+        labels) are cut out as they're loaded. This needs to be set before loading the dataset.
+        :param virtual: A flag for virtual patching
+        :param random_offsets: A flag for cutting training patches from random places in their source images, which
+        change every epoch, instead of from a fixed grid. Testing and validation patches always use the grid.
+        """
+        if not isinstance(virtual, bool):
+            raise TypeError("virtual must be a bool")
+        if not isinstance(random_offsets, bool):
+            raise TypeError("random_offsets must be a bool")
+
+        self._virtual_patching = virtual
+        self._virtual_patch_random_offsets = random_offsets
+
     def set_num_segmentation_classes(self, num_class):
         """
         Sets the number of classes to segment images into
@@ -67,7 +217,7 @@ class SemanticSegmentationModel(DPPModel):
                 self._graph_parse_data()
 
                 # Batch the datasets and create iterators for them
-                train_iter = self._batch_and_iterate(self._train_dataset, shuffle=True)
+                train_iter = self._batch_and_iterate(self._train_dataset, shuffle=True, augment=True)
                 if self._testing:
                     test_iter = self._batch_and_iterate(self._test_dataset)
                 if self._validation:
@@ -240,68 +390,66 @@ class SemanticSegmentationModel(DPPModel):
 
             return abs_mean.astype(np.float32)
 
-    def forward_pass_with_file_inputs(self, images):
-        with self._graph.as_default():
-            num_batches = len(images) // self._batch_size
-            if len(images) % self._batch_size != 0:
-                num_batches += 1
-
-            self._parse_images(images)
-            im_data = self._all_images.batch(self._batch_size).prefetch(1)
-            x_test = im_data.make_one_shot_iterator().get_next()
-
-            if self._load_from_saved:
-                self.load_state()
-
-            if self._with_patching:
-                # Processing and returning whole images is more important than preventing erroneous results from
-                # padding, so we the image size with the required padding to accommodate the patch size
-                patch_height = self._patch_height
-                patch_width = self._patch_width
-                num_patch_rows = ceil(self._image_height / patch_height)
-                num_patch_cols = ceil(self._image_width / patch_width)
-                final_height = num_patch_rows * patch_height
-                final_width = num_patch_cols * patch_width
-
-                # Apply any padding to the images if, then extract the patches. Padding is only added to the bottom and
-                # right sides.
-                x_test = tf.image.pad_to_bounding_box(x_test, 0, 0, final_height, final_width)
-                sizes = [1, patch_height, patch_width, 1]
-                strides = [1, patch_height, patch_width, 1]  # Same as sizes in order to tightly tile patches
-                rates = [1, 1, 1, 1]
-                x_test = tf.image.extract_image_patches(x_test, sizes=sizes, strides=strides, rates=rates,
-                                                        padding="VALID")
-                x_test = tf.reshape(x_test, shape=[-1, patch_height, patch_width, self._image_depth])
-
-            # Run model on them
-            x_pred = self.forward_pass(x_test, deterministic=True)
-
-            total_outputs = []
-            if self._with_patching:
-                n_patches = num_patch_rows * num_patch_cols
-                for i in range(num_batches):
-                    xx = self._session.run(x_pred)
-
-                    for img_patches in np.array_split(xx, xx.shape[0] / n_patches):
-                        # Stitch individual rows together, than stitch the rows into a full image
-                        full_img = []
-                        for row_of_patches in np.array_split(img_patches, num_patch_rows):
-                            row_patches = [row_of_patches[i] for i in range(num_patch_cols)]
-                            full_img.append(np.concatenate(row_patches, axis=1))
-                        full_img = np.concatenate(full_img, axis=0)
-
-                        # Trim off any padding that was added
-                        full_img = full_img[0:self._image_height, 0:self._image_width, :]
-
-                        # Keep the final image, but with an extra dimension to concatenate the images together
-                        total_outputs.append(np.expand_dims(full_img, axis=0))
-            else:
-                for i in range(num_batches):
-                    xx = self._session.run(x_pred)
-                    for img_patches in np.array_split(xx, xx.shape[0]):
-                        total_outputs.append(img_patches)
+    def _graph_inference_inputs(self, x):
+        if self._with_patching:
+            # Processing and returning whole images is more important than preventing erroneous results from padding,
+            # so the images are padded as needed to accommodate the patch size
+            x = self._graph_tile_patches(x)
+        return x
 
-            total_outputs = np.concatenate(total_outputs, axis=0)
+    def __blend_patches(self, patches, outputs):
+        """
+        Stitches the patches for a batch of images back together, blending where they overlap
+        :param patches: ndarray with the outputs for each patch, with all of the patches for one image consecutive and
+        in row-major order
+        :param outputs: A zero-filled ndarray (or a slice of one) to write the full image outputs into
+        """
+        num_patch_rows, num_patch_cols, stride_h, stride_w = self._patch_tiling()
+        n_patches = num_patch_rows * num_patch_cols
+        patch_corners = [(row * stride_h, col * stride_w)
+                         for row in range(num_patch_rows) for col in range(num_patch_cols)]
+
+        # Patches hanging off the bottom and right of the image only cover the padding there, so they're cropped
+        patch_extents = [(min(self._patch_height, self._image_height - y),
+                          min(self._patch_width, self._image_width - x)) for y, x in patch_corners]
+        weights = self._patch_blend_weights()
+        weight_sum = np.zeros([self._image_height, self._image_width, 1], dtype=np.float32)
+        for (y, x), (h, w) in zip(patch_corners, patch_extents):
+            weight_sum[y:y + h, x:x + w] += weights[:h, :w]
+
+        # Blend each image's patches straight into its output, then normalize by the total blending weight
+        for full_img, img_patches in zip(outputs, np.reshape(patches, (-1, n_patches) + patches.shape[1:])):
+            for patch, (y, x), (h, w) in zip(img_patches, patch_corners, patch_extents):
+                full_img[y:y + h, x:x + w] += patch[:h, :w] * weights[:h, :w]
+            full_img /= weight_sum
+
+    def _inference_batch_outputs(self, xx):
+        if not self._with_patching:
+            return xx
+
+        num_patch_rows, num_patch_cols, _, _ = self._patch_tiling()
+        num_images = xx.shape[0] // (num_patch_rows * num_patch_cols)
+        outputs = np.zeros([num_images, self._image_height, self._image_width, xx.shape[-1]], dtype=xx.dtype)
+        self.__blend_patches(xx, outputs)
+        return outputs
+
+    def forward_pass_with_file_inputs(self, images):
+        if self._with_patching:
+            num_patch_rows, num_patch_cols, _, _ = self._patch_tiling()
+            n_patches = num_patch_rows * num_patch_cols
+
+            # The patches are stitched straight into the preallocated outputs
+            total_outputs = None
+            i = 0
+            for xx in self._forward_pass_batches(images):
+                if total_outputs is None:
+                    total_outputs = self._allocate_inference_output(
+                        [len(images), self._image_height, self._image_width, xx.shape[-1]])
+                num_images = xx.shape[0] // n_patches
+                self.__blend_patches(xx, total_outputs[i:i + num_images])
+                i += num_images
+        else:
+            total_outputs = self._stack_inference_batches(len(images), self._forward_pass_batches(images))
 
         return total_outputs
 
@@ -363,7 +511,12 @@ class SemanticSegmentationModel(DPPModel):
         """
         self._raw_image_files = loaders.get_dir_images(dirname)
         self._raw_labels = loaders.get_dir_images(seg_dirname)
-        if self._with_patching:
+        self._patch_container_input = self._with_patching and not self._virtual_patching
+        self._virtual_patch_input = self._with_patching and self._virtual_patching
+        if self._virtual_patch_input:
+            self._raw_image_files, self._raw_labels = self._virtual_patch_index(self._raw_image_files,
+                                                                                self._raw_labels)
+        elif self._with_patching:
             self._raw_image_files, self._raw_labels = self.__autopatch_segmentation_dataset()
 
         self._total_raw_samples = len(self._raw_image_files)
@@ -374,57 +527,235 @@ class SemanticSegmentationModel(DPPModel):
     def __autopatch_segmentation_dataset(self, patch_dir=None):
         """
         Generates a dataset of image patches from a loaded dataset of larger images and returns the new images and
-        labels. This will check for existing patches first and load them if found unless data overwriting is turned on.
+        labels. Patches from earlier runs are reused for any image whose image file, mask file, and patch size haven't
+        changed since, unless data overwriting is turned on.
         :param patch_dir: The directory to place patched images into, or where to read previous patches from
-        :return The patched dataset as lists of the image and segmentation mask filenames
+        :return The patched dataset as lists of references to the image and segmentation mask patches
         """
         if not patch_dir:
             patch_dir = os.path.curdir
         patch_dir = os.path.join(patch_dir, 'train_patch', '')
-        im_dir = os.path.join(patch_dir, 'im_patch', '')
-        seg_dir = os.path.join(patch_dir, 'mask_patch', '')
+        self._log("Patching dataset: Patches will be in " + patch_dir)
 
-        if os.path.exists(patch_dir) and not self._gen_data_overwrite:
-            # If there already is a patched dataset, just load it
-            self._log("Loading preexisting patched data from " + patch_dir)
-            image_files = loaders.get_dir_images(im_dir)
-            seg_files = loaders.get_dir_images(seg_dir)
-            return image_files, seg_files
+        settings = [self._patch_height, self._patch_width, self._image_depth]
+        keys = [self._generated_data_key(settings, im_file, seg_file)
+                for im_file, seg_file in zip(self._raw_image_files, self._raw_labels)]
+
+        def generate_patches(indices):
+            # We need to construct patches from the previously loaded dataset. We'll take as many of them as we can
+            # fit from the centre of the image.
+            mode = self._autopatch_image_mode()
+            jobs = []
+            for n in indices:
+                jobs.append((self._raw_image_files[n], os.path.join(patch_dir, 'im_{}.npy'.format(keys[n])), mode,
+                             self._patch_height, self._patch_width))
+                jobs.append((self._raw_labels[n], os.path.join(patch_dir, 'seg_{}.npy'.format(keys[n])), 'L',
+                             self._patch_height, self._patch_width))
+            self._write_patch_containers(jobs)
+
+            # The number of patches only depends on the image size, which can be read without decoding the image
+            for n in indices:
+                with Image.open(self._raw_image_files[n]) as im:
+                    num_patch = len(_patch_coords(im.height, im.width, self._patch_height, self._patch_width)[0])
+                yield {'files': ['im_{}.npy'.format(keys[n]), 'seg_{}.npy'.format(keys[n])], 'num_patches': num_patch}
 
-        self._log("Patching dataset: Patches will be in " + patch_dir)
-        if os.path.exists(patch_dir):
-            self._log("Overwriting preexisting patched data...")
-            shutil.rmtree(patch_dir)
-        os.mkdir(patch_dir)
-        os.mkdir(im_dir)
-        os.mkdir(seg_dir)
-
-        # We need to construct patches from the previously loaded dataset. We'll take as many of them as we can fit
-        # from the centre of the image.
-        patch_num = 0
-        n_image = len(self._raw_image_files)
         image_files = []
         seg_files = []
-        for n, im_file, seg_file in zip(trange(n_image), self._raw_image_files, self._raw_labels):
-            im = np.array(Image.open(im_file))
-            seg = np.array(Image.open(seg_file))
+        for entry in self._update_generated_data(patch_dir, keys, generate_patches):
+            im_container, seg_container = [os.path.join(patch_dir, f) for f in entry['files']]
+            image_files.extend(loaders.patch_reference(im_container, i) for i in range(entry['num_patches']))
+            seg_files.extend(loaders.patch_reference(seg_container, i) for i in range(entry['num_patches']))
 
-            patch_start, patch_end = self._autopatch_get_patch_coords(im)
-            num_patch = len(patch_start)
+        return image_files, seg_files
 
-            for i, tl_coord, br_coord in zip(itertools.count(patch_num), patch_start, patch_end):
-                im_patch = Image.fromarray(self._autopatch_extract_patch(im, tl_coord, br_coord))
-                seg_patch = Image.fromarray(self._autopatch_extract_patch(seg, tl_coord, br_coord))
-                im_name = os.path.join(im_dir, 'im_{:0>6d}.png'.format(i))
-                seg_name = os.path.join(seg_dir, 'seg_{:0>6d}.png'.format(i))
-                im_patch.save(im_name)
-                seg_patch.save(seg_name)
-                image_files.append(im_name)
-                seg_files.append(seg_name)
+    def _virtual_patch_index(self, image_files, labels):
+        """
+        Builds the index of patches for virtual patching, with a reference to each patch's place in the grid of
+        patches covering its source image
+        :param image_files: A list of the source image files
+        :param labels: A list of the labels for each source image
+        :return: A list of references to the patches, from loaders.patch_reference, and a list of their labels
+        """
+        patch_images = []
+        patch_labels = []
+        for im_file, label in zip(image_files, labels):
+            # Only the image size is needed, which can be read without decoding the image
+            with Image.open(im_file) as im:
+                num_patch = len(_patch_coords(im.height, im.width, self._patch_height, self._patch_width)[0])
+            patch_images.extend(loaders.patch_reference(im_file, i) for i in range(num_patch))
+            if isinstance(label, str):
+                # Labels in image files (i.e. masks) are cut into patches the same way
+                patch_labels.extend(loaders.patch_reference(label, i) for i in range(num_patch))
+            else:
+                patch_labels.extend([label] * num_patch)
 
-            patch_num += num_patch
+        self._log('Indexed {} virtual patches from {} images'.format(len(patch_images), len(image_files)))
+        return patch_images, patch_labels
 
-        return image_files, seg_files
+    def _parse_load_virtual_patch(self, reference, mode, position):
+        """
+        Cuts a patch out of a source image for virtual patching. Decoded source images are kept for a while, since the
+        patches from an image are loaded one after another.
+        :param reference: The patch's reference, from loaders.patch_reference
+        :param mode: The PIL mode to read the source image with
+        :param position: The fractions of the way down and across the source image to cut a patch from, or negative
+        values to use the patch's place in the grid of patches
+        :return: An ndarray with the patch and an ndarray with its (y, x) offset in the source image
+        """
+        image_file, index = loaders.split_patch_reference(reference.decode())
+        mode = mode.decode()
+
+        with self._virtual_patch_lock:
+            im = self._virtual_patch_sources.pop((image_file, mode), None)
+        if im is None:
+            im = _read_image_array(image_file, mode)
+        with self._virtual_patch_lock:
+            self._virtual_patch_sources[(image_file, mode)] = im
+            while len(self._virtual_patch_sources) > 2 * self._num_threads:
+                self._virtual_patch_sources.popitem(last=False)
+
+        im_height, im_width = im.shape[0:2]
+        if position[0] < 0:
+            num_patch_w = ceil(im_width / self._patch_width)
+            offset = ((index // num_patch_w) * self._patch_height, (index % num_patch_w) * self._patch_width)
+        else:
+            offset = (int(position[0] * (max(im_height - self._patch_height, 0) + 1)),
+                      int(position[1] * (max(im_width - self._patch_width, 0) + 1)))
+
+        patch = _extract_patch(im, offset, (offset[0] + self._patch_height, offset[1] + self._patch_width))
+        return np.reshape(patch, [self._patch_height, self._patch_width, -1]), np.array(offset, dtype=np.int32)
+
+    def _parse_read_virtual_patches(self, images, labels, random_offsets):
+        """
+        Loads virtual patches and their labels during dataset parsing, in place of reading whole images
+        :param images: The references to the patches
+        :param labels: The accompanying labels
+        :param random_offsets: A flag for cutting the patch from a random place in the source image
+        :return: The image patches and the label patches
+        """
+        position = tf.random.uniform([2]) if random_offsets else tf.fill([2], -1.0)
+
+        def read_patch(reference, mode, channels):
+            patch, offset = tf.numpy_function(self._parse_load_virtual_patch, [reference, mode, position],
+                                              [tf.uint8, tf.int32])
+            patch.set_shape([self._patch_height, self._patch_width, channels])
+            offset.set_shape([2])
+            return patch, offset
+
+        images, offset = read_patch(images, self._autopatch_image_mode(), self._image_depth)
+        images = tf.image.convert_image_dtype(images, dtype=tf.float32)
+        return images, self._parse_virtual_patch_labels(labels, read_patch, offset)
+
+    def _parse_virtual_patch_labels(self, labels, read_patch, offset):
+        """
+        Cuts the labels for a virtual patch out of the labels for its source image
+        :param labels: The labels for the source image
+        :param read_patch: A function taking a patch reference, PIL mode, and number of channels and returning the
+        patch from the same place as the image patch
+        :param offset: The (y, x) offset of the patch in its source image
+        :return: The labels for the patch
+        """
+        # Same as _parse_apply_preprocessing, class masks are cast to keep their values instead of being scaled
+        labels, _ = read_patch(labels, 'L', 1)
+        if self._num_seg_class > 2:
+            return tf.cast(labels, tf.float32)
+        return tf.image.convert_image_dtype(labels, dtype=tf.float32)
+
+    def _autopatch_image_mode(self):
+        """Gets the PIL image mode for patches of input images, matching the channels that images are decoded to"""
+        return {1: 'L', 2: 'LA', 3: 'RGB', 4: 'RGBA'}[self._image_depth]
+
+    def save_dataset_to_records(self, dirname, num_shards=16):
+        if self._patch_generation is not None:
+            # Patches are read from their containers to be written, so any containers still in progress need to finish
+            for job in self._patch_generation:
+                job.result()
+        if not self._virtual_patch_input:
+            super().save_dataset_to_records(dirname, num_shards)
+            return
+
+        # Virtual patches are only references to places in their source images, so they're cut out into temporary patch
+        # containers to be encoded like the patches from regular autopatching
+        with tempfile.TemporaryDirectory() as patch_dir:
+            self._records_patch_dir = patch_dir
+            try:
+                super().save_dataset_to_records(dirname, num_shards)
+            finally:
+                self._records_patch_dir = None
+
+    def _get_raw_partitions(self):
+        partitions = super()._get_raw_partitions()
+        if self._records_patch_dir is None:
+            return partitions
+
+        containers = {}
+        jobs = []
+
+        def container_references(references, mode):
+            patches = []
+            for reference in references:
+                if not isinstance(reference, (str, bytes)):
+                    raise RuntimeError("Virtual patches can only be written to records with labels from image files, "
+                                       "since other labels aren't stored per patch; turn off virtual patching to "
+                                       "write them")
+                source_file, index = loaders.split_patch_reference(
+                    reference.decode() if isinstance(reference, bytes) else reference)
+                if (source_file, mode) not in containers:
+                    containers[(source_file, mode)] = os.path.join(self._records_patch_dir,
+                                                                   'patches_{}.npy'.format(len(containers)))
+                    jobs.append((source_file, containers[(source_file, mode)], mode, self._patch_height,
+                                 self._patch_width))
+                patches.append(loaders.patch_reference(containers[(source_file, mode)], index))
+            return patches
+
+        partitions = {name: (images, labels) if images is None or len(images) == 0 else
+                      (container_references(images, self._autopatch_image_mode()), container_references(labels, 'L'))
+                      for name, (images, labels) in partitions.items()}
+        with concurrent.futures.ThreadPoolExecutor(self._num_threads) as executor:
+            list(executor.map(_write_patch_container, jobs))
+        return partitions
+
+    def _write_patch_containers(self, jobs):
+        """
+        Writes patch containers for autopatching. With more than one thread, they are written by a pool of threads in
+        the background (decoding the images and saving the containers release the GIL), so training can start on the
+        finished containers while the rest are written.
+        :param jobs: A list of arguments for _write_patch_container, in the order the containers are needed in
+        """
+        num_workers = min(self._num_threads, len(jobs))
+        if num_workers > 1:
+            if self._patch_pool is not None:
+                self._patch_pool.shutdown()
+            self._patch_pool = concurrent.futures.ThreadPoolExecutor(num_workers)
+            self._patch_generation = [self._patch_pool.submit(_write_patch_container, job) for job in jobs]
+        else:
+            for job in tqdm(jobs):
+                _write_patch_container(job)
+
+    def _parse_load_patch(self, reference):
+        """
+        Loads one patch from a patch container, waiting for the container to be written if it's still in progress
+        :param reference: The patch's reference, from loaders.patch_reference
+        :return: An ndarray with the patch
+        """
+        container_file, index = loaders.split_patch_reference(reference.decode())
+
+        while not os.path.isfile(container_file):
+            generation = self._patch_generation
+            if generation is not None and not all(job.done() for job in generation):
+                time.sleep(0.1)
+                continue
+            if generation is not None:
+                for job in generation:
+                    job.result()  # Raises any error from writing the containers
+            if not os.path.isfile(container_file):
+                raise FileNotFoundError("The patch container " + container_file + " doesn't exist")
+
+        patches = self._patch_containers.get(container_file)
+        if patches is None:
+            patches = np.load(container_file, mmap_mode='r')
+            self._patch_containers[container_file] = patches
+        return np.array(patches[index])
 
     def _autopatch_get_patch_coords(self, im):
         """
@@ -434,15 +765,7 @@ class SemanticSegmentationModel(DPPModel):
         :param im: A numpy array with an image to split into patches
         :return: Lists of tuples with the starting (top-left) and ending (bottom-right) coordinates for patches
         """
-        im_height, im_width, _ = im.shape
-        num_patch_h = ceil(im_height / self._patch_height)
-        num_patch_w = ceil(im_width / self._patch_width)
-
-        patch_start = [(y * self._patch_height, x * self._patch_width)
-                       for y in range(num_patch_h) for x in range(num_patch_w)]
-        patch_end = [(y + self._patch_height, x + self._patch_width) for (y, x) in patch_start]
-
-        return patch_start, patch_end
+        return _patch_coords(im.shape[0], im.shape[1], self._patch_height, self._patch_width)
 
     def _autopatch_extract_patch(self, im, tl_coord, br_coord):
         """
@@ -452,27 +775,44 @@ class SemanticSegmentationModel(DPPModel):
         :param br_coord: A tuple for the bottom-right (y, x) corner of the patch
         :return: An ndarray of the extracted patch suitable for saving as a PNG
         """
-        y0, x0 = tl_coord
-        y1, x1 = br_coord
-        patch_x = x1 - x0
-        patch_y = y1 - y0
-        if im.ndim == 2:
-            im = np.expand_dims(im, axis=-1)  # Give 2D images an explicit 1-channel dimension
-        im_height, im_width, im_depth = im.shape
-
-        fill_x = x1 - im_width if x1 > im_width else 0
-        fill_y = y1 - im_height if y1 > im_height else 0
-        if x1 > im_width:
-            x1 -= fill_x
-        if y1 > im_height:
-            y1 -= fill_y
-
-        im_patch = np.full((patch_y, patch_x, im_depth), 0, dtype=np.uint8)
-        im_patch[0:patch_y - fill_y, 0:patch_x - fill_x, :] = im[y0:y1, x0:x1, :].astype(np.uint8)
-
-        if im_depth == 1:
-            return im_patch.squeeze(axis=2)  # Remove the 1-channel dimension; some image libraries don't like it
-        return im_patch
+        return _extract_patch(im, tl_coord, br_coord)
+
+    def _graph_parse_data(self):
+        # Autopatched datasets refer to patches instead of image files, but only the datasets do; inference still reads
+        # image files
+        self._parse_from_patch_containers = self._patch_container_input
+        self._parse_virtual_patches = self._virtual_patch_input
+        try:
+            super()._graph_parse_data()
+        finally:
+            self._parse_from_patch_containers = False
+            self._parse_virtual_patches = False
+
+    def _input_stages(self, train_set):
+        load_stages, augment_stages = super()._input_stages(train_set)
+        if not self._parse_virtual_patches:
+            return load_stages, augment_stages
+
+        random_offsets = train_set and self._virtual_patch_random_offsets
+        read_stage = ('read', lambda x, y: self._parse_read_virtual_patches(x, y, random_offsets))
+        if random_offsets:
+            # Random patches have to be cut after any caching, so that they change every epoch
+            return [], [read_stage] + load_stages[1:] + augment_stages
+        return [read_stage] + load_stages[1:], augment_stages
+
+    def _parse_read_images(self, images, channels=1, image_type=tf.float32):
+        if not self._parse_from_patch_containers:
+            return super()._parse_read_images(images, channels, image_type)
+
+        images = tf.numpy_function(self._parse_load_patch, [images], tf.uint8)
+        images.set_shape([None, None, channels])
+        return tf.image.convert_image_dtype(images, dtype=image_type)
+
+    def _image_cache_settings(self):
+        settings = super()._image_cache_settings() + [self._num_seg_class]
+        if self._virtual_patch_input:
+            settings += [self._patch_height, self._patch_width]
+        return settings
 
     def _parse_apply_preprocessing(self, images, labels):
         # Apply pre-processing to the image labels too (which are images for semantic segmentation). If there are
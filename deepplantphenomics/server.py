@@ -0,0 +1,350 @@
+from . import networks, metrics
+import numpy as np
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import tempfile
+import argparse
+import threading
+import importlib.util
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+class _pendingRequest(object):
+    """An image waiting to be run through the model, and a slot for its result"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.arrival_time = time.time()
+        self.done = threading.Event()
+        self.output = None
+        self.error = None
+
+
+def _to_json(output):
+    """Converts a model output (an array, a list of arrays, None, etc.) into something JSON serializable"""
+    if isinstance(output, np.ndarray):
+        return output.tolist()
+    if isinstance(output, np.generic):
+        return output.item()
+    if isinstance(output, (list, tuple)):
+        return [_to_json(x) for x in output]
+    return output
+
+
+class InferenceServer(object):
+    """
+    Serves predictions from a loaded model over HTTP. Requests that arrive close together are grouped into batches of
+    up to the model's batch size, so the model runs full batches instead of one image at a time under load.
+
+    Images are POSTed (as the raw file contents) to /predict and the interpreted output for the image is returned as
+    JSON. GET /metrics returns the queue depth, batch sizes, and request latencies.
+    """
+
+    def __init__(self, model, host='127.0.0.1', port=8000, unix_socket=None, max_batch_size=None, max_latency=0.05,
+                 request_timeout=60):
+        """
+        :param model: The model to serve, either a DPPModel (using forward_pass_with_interpreted_outputs) or a
+        pre-trained network from `networks` (using forward_pass)
+        :param host: The address to listen on
+        :param port: The port to listen on. Use 0 to pick any free port
+        :param unix_socket: The path of a Unix socket to listen on instead of a host and port
+        :param max_batch_size: The largest number of images to run in one batch. Defaults to the model's batch size
+        :param max_latency: The longest time, in seconds, that a request waits for a batch to fill up before the
+        batch is run anyway
+        :param request_timeout: The longest time, in seconds, that a request waits for its output before it's answered
+        with a 504 error
+        """
+        if not isinstance(port, int):
+            raise TypeError("port must be an int")
+        if unix_socket is not None and not isinstance(unix_socket, str):
+            raise TypeError("unix_socket must be a str or None")
+        if max_batch_size is not None:
+            if not isinstance(max_batch_size, int):
+                raise TypeError("max_batch_size must be an int or None")
+            if max_batch_size <= 0:
+                raise ValueError("max_batch_size must be positive")
+        if not isinstance(max_latency, (int, float)):
+            raise TypeError("max_latency must be a number")
+        if max_latency < 0:
+            raise ValueError("max_latency can't be negative")
+        if not isinstance(request_timeout, (int, float)):
+            raise TypeError("request_timeout must be a number")
+        if request_timeout <= 0:
+            raise ValueError("request_timeout must be positive")
+
+        self.model = model
+        if hasattr(model, 'forward_pass_with_interpreted_outputs'):
+            self._predict = model.forward_pass_with_interpreted_outputs
+            default_batch_size = model._batch_size
+        else:
+            self._predict = model.forward_pass
+            default_batch_size = model.model._batch_size
+        self.max_batch_size = max_batch_size if max_batch_size is not None else default_batch_size
+        self.max_latency = max_latency
+        self.request_timeout = request_timeout
+
+        self._queue = queue.Queue()
+        self._upload_dir = tempfile.mkdtemp(prefix='dpp_serve_')
+        self._upload_count = 0
+        self._stopping = threading.Event()
+        self._batcher = None
+        self._server_thread = None
+
+        # Metrics, updated by the batching thread
+        self._metrics_lock = threading.Lock()
+        self._num_requests = 0
+        self._num_errors = 0
+        self._batch_sizes = metrics.StreamingStatistics()
+        self._latencies = metrics.StreamingStatistics()
+        self._recent_latencies = deque(maxlen=1000)
+
+        server = self
+
+        class _RequestHandler(BaseHTTPRequestHandler):
+            def address_string(self):
+                # Unix socket clients don't have an address
+                return self.client_address[0] if isinstance(self.client_address, tuple) else unix_socket
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, code, body):
+                body = json.dumps(body).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path == '/metrics':
+                    self._send_json(200, server.get_metrics())
+                else:
+                    self._send_json(404, {'error': 'Unknown path ' + self.path})
+
+            def do_POST(self):
+                if self.path != '/predict':
+                    self._send_json(404, {'error': 'Unknown path ' + self.path})
+                    return
+
+                length = int(self.headers.get('Content-Length', 0))
+                if length <= 0:
+                    self._send_json(400, {'error': 'No image was sent'})
+                    return
+
+                request = server.submit(self.rfile.read(length))
+                if not request.done.wait(server.request_timeout):
+                    self._send_json(504, {'error': 'Timed out waiting for the model'})
+                elif request.error is not None:
+                    self._send_json(500, {'error': request.error})
+                else:
+                    self._send_json(200, {'prediction': _to_json(request.output)})
+
+        if unix_socket is not None:
+            if os.path.exists(unix_socket):
+                os.remove(unix_socket)
+            self._httpd = _ThreadingUnixHTTPServer(unix_socket, _RequestHandler)
+        else:
+            self._httpd = _ThreadingHTTPServer((host, port), _RequestHandler)
+        self.address = self._httpd.server_address
+
+    def submit(self, image_bytes):
+        """
+        Queues an image to be run through the model in the next batch
+        :param image_bytes: The contents of an image file
+        :return: The pending request, whose `done` event is set once its `output` (or `error`) is filled in
+        """
+        # The model's input pipeline reads images from files, so each upload is written to one first
+        with self._metrics_lock:
+            self._upload_count += 1
+            filename = os.path.join(self._upload_dir, 'upload_{}'.format(self._upload_count))
+        with open(filename, 'wb') as f:
+            f.write(image_bytes)
+
+        request = _pendingRequest(filename)
+        self._queue.put(request)
+        return request
+
+    def _next_batch(self):
+        """
+        Waits for requests and groups them into a batch. The batch is returned once it's full or the oldest request in
+        it has waited for max_latency seconds.
+        :return: A list of pending requests, or None if the server is stopping
+        """
+        while not self._stopping.is_set():
+            try:
+                batch = [self._queue.get(timeout=0.1)]
+                break
+            except queue.Empty:
+                continue
+        else:
+            return None
+
+        deadline = batch[0].arrival_time + self.max_latency
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run_batches(self):
+        """Runs batches of queued requests through the model until the server stops"""
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        """
+        Runs one batch of requests through the model and fills in their outputs. Every request is marked as done, even
+        if something goes wrong, so no request waits on a batch that has already been run.
+        :param batch: A list of pending requests
+        """
+        error = None
+        outputs = [None] * len(batch)
+        try:
+            batch_outputs = self._predict([request.filename for request in batch])
+            if len(batch_outputs) != len(batch):
+                raise RuntimeError("The model returned {} outputs for a batch of {} images"
+                                   .format(len(batch_outputs), len(batch)))
+            outputs = batch_outputs
+        except Exception as e:
+            error = '{}: {}'.format(type(e).__name__, e)
+
+        try:
+            now = time.time()
+            latencies = [now - request.arrival_time for request in batch]
+            with self._metrics_lock:
+                self._num_requests += len(batch)
+                if error is not None:
+                    self._num_errors += len(batch)
+                self._batch_sizes.update([len(batch)])
+                self._latencies.update(latencies)
+                self._recent_latencies.extend(latencies)
+        finally:
+            for request, output in zip(batch, outputs):
+                request.output = output
+                request.error = error
+                try:
+                    os.remove(request.filename)
+                except OSError:
+                    pass
+                request.done.set()
+
+    def get_metrics(self):
+        """
+        :return: A dict with the number of queued requests, the number of requests and batches run, the mean batch
+        size, and request latencies in seconds (mean and max overall, plus percentiles over the most recent requests)
+        """
+        with self._metrics_lock:
+            recent = np.array(self._recent_latencies)
+            return {'queue_depth': self._queue.qsize(),
+                    'requests': self._num_requests,
+                    'errors': self._num_errors,
+                    'batches': self._batch_sizes.count,
+                    'mean_batch_size': float(self._batch_sizes.mean) if self._batch_sizes.count else 0.0,
+                    'mean_latency': float(self._latencies.mean) if self._latencies.count else 0.0,
+                    'max_latency': float(self._latencies.max) if self._latencies.count else 0.0,
+                    'p50_latency': float(np.percentile(recent, 50)) if recent.size else 0.0,
+                    'p95_latency': float(np.percentile(recent, 95)) if recent.size else 0.0}
+
+    def start(self):
+        """Starts serving requests in background threads"""
+        self._batcher = threading.Thread(target=self._run_batches, daemon=True)
+        self._batcher.start()
+        self._server_thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._server_thread.start()
+
+    def serve_forever(self):
+        """Serves requests until interrupted"""
+        self._batcher = threading.Thread(target=self._run_batches, daemon=True)
+        self._batcher.start()
+        try:
+            self._httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.shut_down()
+
+    def shut_down(self):
+        """Stops serving requests and cleans up uploaded images. The model itself is left running."""
+        self._stopping.set()
+        if self._server_thread is not None:
+            self._httpd.shutdown()
+            self._server_thread.join()
+        self._httpd.server_close()
+        if self._batcher is not None:
+            self._batcher.join()
+        if isinstance(self._httpd, UnixStreamServer) and os.path.exists(self.address):
+            os.remove(self.address)
+        shutil.rmtree(self._upload_dir, ignore_errors=True)
+
+
+def _load_model(args):
+    """Builds the model to serve from the command line arguments"""
+    if args.network is not None:
+        network_class = getattr(networks, args.network, None)
+        if not isinstance(network_class, type):
+            raise ValueError("'" + args.network + "' is not one of the pre-trained networks")
+        return network_class(batch_size=args.batch_size) if args.batch_size else network_class()
+
+    # A model script builds the model's architecture and loads its saved state, as in the deployment tutorial
+    spec = importlib.util.spec_from_file_location('dpp_served_model', args.model_script)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.build_model()
+
+
+def main(argv=None):
+    """The `dpp` command line entry point"""
+    parser = argparse.ArgumentParser(prog='dpp', description='Deep Plant Phenomics')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    serve = subparsers.add_parser('serve', help='Serve predictions from a trained model over HTTP')
+    model_source = serve.add_mutually_exclusive_group(required=True)
+    model_source.add_argument('--network', help='The name of a pre-trained network in deepplantphenomics.networks')
+    model_source.add_argument('--model-script', help='A Python file with a build_model() function returning the model')
+    serve.add_argument('--batch-size', type=int, default=None, help='The batch size for a pre-trained network')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8000)
+    serve.add_argument('--unix-socket', default=None, help='Listen on this Unix socket instead of a host and port')
+    serve.add_argument('--max-latency', type=float, default=0.05,
+                       help='Seconds a request can wait for its batch to fill up')
+    serve.add_argument('--request-timeout', type=float, default=60,
+                       help='Seconds a request can wait for its output before getting a 504 error')
+
+    args = parser.parse_args(argv)
+
+    model = _load_model(args)
+    server = InferenceServer(model, host=args.host, port=args.port, unix_socket=args.unix_socket,
+                             max_latency=args.max_latency, request_timeout=args.request_timeout)
+    print('Serving on {}'.format(server.address), file=sys.stderr)
+    try:
+        server.serve_forever()
+    finally:
+        model.shut_down()
+
+
+if __name__ == '__main__':
+    main()
@@ -5,9 +5,11 @@ import pytest
 import numpy as np
 import os.path
 import random
+import pickle
+import json
 import tensorflow.compat.v1 as tf
 import deepplantphenomics as dpp
-from deepplantphenomics import loaders, layers
+from deepplantphenomics import loaders, layers, definitions
 from deepplantphenomics.tests.mock_dpp_model import MockDPPModel
 
 
@@ -24,6 +26,40 @@ def model():
     return model
 
 
+@pytest.fixture()
+def tiny_data_dir(tmp_path):
+    """A directory of a few tiny images with one regression label each, listed in labels.csv"""
+    from PIL import Image
+
+    data_dir = tmp_path / 'tiny_data'
+    data_dir.mkdir()
+    rng = np.random.RandomState(0)
+    with open(str(data_dir / 'labels.csv'), 'w') as f:
+        for i in range(8):
+            Image.fromarray(rng.randint(0, 256, [8, 8, 3], dtype=np.uint8)).save(str(data_dir / 'im_{}.png'.format(i)))
+            f.write('im_{}.png,{}\n'.format(i, i / 8))
+    return str(data_dir)
+
+
+def make_tiny_regression_model(data_dir, save_dir, num_cpu_workers=1):
+    """Makes a small regression model loaded with the images from tiny_data_dir, ready to train"""
+    model = dpp.RegressionModel(debug=False, save_checkpoints=False, report_rate=1, save_dir=save_dir)
+    model.set_batch_size(2)
+    if num_cpu_workers > 1:
+        model.set_number_of_cpu_workers(num_cpu_workers)
+    model.set_image_dimensions(8, 8, 3)
+    model.set_num_regression_outputs(1)
+    model.set_test_split(0.25)
+    model.set_maximum_training_epochs(1)
+    model.set_learning_rate(0.001)
+    model.load_multiple_labels_from_csv(os.path.join(data_dir, 'labels.csv'))
+    model.load_images_with_ids_from_directory(data_dir)
+    model.add_input_layer()
+    model.add_convolutional_layer(filter_dimension=[3, 3, 3, 4], stride_length=1, activation_function='relu')
+    model.add_output_layer()
+    return model
+
+
 def test_set_number_of_threads(model):
     with pytest.raises(TypeError):
         model.set_number_of_threads(5.0)
@@ -406,6 +442,382 @@ def test_set_original_image_dimensions(model):
         model.set_original_image_dimensions(1, -1)
 
 
+def test_set_batch_augmentation(model):
+    with pytest.raises(TypeError):
+        model.set_batch_augmentation(1)
+    model.set_batch_augmentation(True)
+    assert model._batch_augmentation
+
+
+def test_batch_augmentation_statistics():
+    model = dpp.RegressionModel()
+    model.set_image_dimensions(4, 6, 1)
+    model.set_augmentation_flip_horizontal(True)
+    model.set_augmentation_brightness_and_contrast(True)
+    model._supports_standardization = False  # Standardizing would hide the brightness and contrast changes
+
+    # Many copies of one image, which brightens from left to right so flipped copies can be picked out
+    num_images = 2000
+    image = np.tile(np.arange(6, dtype=np.float32) * 10, [4, 1])[..., np.newaxis]
+    images = np.tile(image, [num_images, 1, 1, 1])
+    labels = np.zeros([num_images, 1], dtype=np.float32)
+
+    with model._graph.as_default():
+        tf.set_random_seed(0)
+
+        # Augment the images one at a time, as in the input pipeline without batch augmentation
+        _, augment_stages = model._input_stages(train_set=True)
+        dataset = tf.data.Dataset.from_tensor_slices((images, labels))
+        for name, stage in augment_stages:
+            if name in ['flip_horizontal', 'contrast']:
+                dataset = dataset.map(stage)
+        per_image = tf.data.make_one_shot_iterator(dataset.batch(num_images)).get_next()[0]
+
+        model.set_batch_augmentation(True)
+        per_batch, _ = model._parse_augment_batch(tf.constant(images), tf.constant(labels))
+    per_image, per_batch = model._session.run([per_image, per_batch])
+
+    def augmentation_stats(augmented):
+        flipped = augmented[:, :, -1, 0].mean(axis=1) < augmented[:, :, 0, 0].mean(axis=1)
+        brightness = augmented.mean(axis=(1, 2, 3)) - image.mean()  # Contrast changes keep the mean the same
+        contrast = augmented.std(axis=(1, 2, 3)) / image.std()
+        return [flipped.mean(), brightness.mean(), brightness.std(), contrast.mean(), contrast.std()]
+
+    # Flips are 50/50, brightness changes are uniform in [-63, 63], and contrast factors are uniform in [0.2, 1.8]
+    expected = [0.5, 0, 63 / np.sqrt(3), 1, 0.8 / np.sqrt(3)]
+    tolerances = [0.05, 4, 3, 0.05, 0.04]
+    for stats in [augmentation_stats(per_image), augmentation_stats(per_batch)]:
+        assert np.all(np.abs(np.array(stats) - expected) < tolerances)
+    assert np.all(np.abs(np.array(augmentation_stats(per_image)) - augmentation_stats(per_batch)) < tolerances)
+
+
+def test_begin_training_with_successive_halving(model):
+    with pytest.raises(TypeError):
+        model.begin_training_with_successive_halving(reduction_factor=2.0)
+    with pytest.raises(ValueError):
+        model.begin_training_with_successive_halving(reduction_factor=1)
+    with pytest.raises(TypeError):
+        model.begin_training_with_successive_halving(search_dir=5)
+
+
+def test_successive_halving_resume(model, tmp_path, monkeypatch):
+    model._validation = True
+    model.set_maximum_training_epochs(4)
+    search_dir = str(tmp_path / 'search')
+
+    cells = []
+
+    def train_cell(current_l2, current_lr, base_tb_dir, unaltered):
+        if len(cells) == 5:
+            raise KeyboardInterrupt
+        cells.append((model._save_dir, model._warm_start_dir, unaltered[2]))
+        model._final_validation_loss = current_l2 + current_lr
+
+    monkeypatch.setattr(model, '_train_hyperparameter_search_cell', train_cell)
+
+    # 4 settings are trained for 1, 2, and then 4 epochs in 3 rounds, keeping the best half after each round. The
+    # search is interrupted partway through the second round and then resumed.
+    search_args = dict(l2_reg_limits=[0.1, 0.2], lr_limits=[0.001, 0.004], num_steps=2, reduction_factor=2,
+                       search_dir=search_dir)
+    with pytest.raises(KeyboardInterrupt):
+        model.begin_training_with_successive_halving(**search_args)
+    best_l2, best_lr = model.begin_training_with_successive_halving(**search_args)
+    assert best_l2 == pytest.approx(0.1) and best_lr == pytest.approx(0.001)
+
+    def round_dir(config, r):
+        return os.path.join(search_dir, 'config_{}'.format(config), 'round_{}'.format(r))
+
+    # Each round continues from the end of the setting's last round, never from its own (possibly partial) checkpoints
+    assert cells[0:4] == [(round_dir(i, 0), None, 1) for i in range(4)]
+    assert cells[4:] == [(round_dir(0, 1), round_dir(0, 0), 1),
+                         (round_dir(1, 1), round_dir(1, 0), 1),
+                         (round_dir(0, 2), round_dir(0, 1), 2)]
+
+
+def test_successive_halving_whole_epochs(model, tmp_path, monkeypatch):
+    model._validation = True
+    model.set_maximum_training_epochs(10)
+    search_dir = str(tmp_path / 'search')
+
+    epochs = []
+
+    def train_cell(current_l2, current_lr, base_tb_dir, unaltered):
+        epochs.append(unaltered[2])
+        model._final_validation_loss = current_l2 + current_lr
+
+    monkeypatch.setattr(model, '_train_hyperparameter_search_cell', train_cell)
+
+    # 9 settings over 3 rounds would end at 10/9, 10/3, and 10 epochs, which are rounded to whole epochs
+    model.begin_training_with_successive_halving(l2_reg_limits=[0.1, 0.3], lr_limits=[0.001, 0.003], num_steps=3,
+                                                 reduction_factor=3, search_dir=search_dir)
+    assert epochs == [1] * 9 + [2] * 3 + [7]
+    with open(os.path.join(search_dir, 'search_state.json')) as f:
+        round_epochs = json.load(f)['round_epochs']
+    assert round_epochs == [1, 3, 10] and all(isinstance(e, int) for e in round_epochs)
+
+
+def test_set_maximum_checkpoints(model):
+    with pytest.raises(TypeError):
+        model.set_maximum_checkpoints(1.0)
+    with pytest.raises(ValueError):
+        model.set_maximum_checkpoints(-1)
+    model.set_maximum_checkpoints(0)
+    assert model._max_checkpoints == 0
+
+
+def test_set_number_of_cpu_workers(model):
+    with pytest.raises(TypeError):
+        model.set_number_of_cpu_workers(2.0)
+    with pytest.raises(ValueError):
+        model.set_number_of_cpu_workers(0)
+    model.set_batch_size(4)
+    model.set_number_of_cpu_workers(2)
+    assert model._num_cpu_workers == 2
+
+
+def test_cpu_workers_train_twice(tiny_data_dir, tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    model = make_tiny_regression_model(tiny_data_dir, str(tmp_path / 'saved'), num_cpu_workers=2)
+    if model._max_gpus != 0:
+        pytest.skip("CPU workers are only used without GPUs")
+
+    # Training shuts the session down at the end, and the second run (as in a hyperparameter search) reuses the cluster
+    # from the first instead of starting another one
+    servers = []
+    for _ in range(2):
+        model._reset_graph()
+        model._reset_session()
+        model._maximum_training_batches = 1  # Parsing the dataset turns this from epochs into batches
+        loss = model.begin_training(return_test_loss=True)
+        assert np.isfinite(loss)
+        assert model._cluster_server is None
+        servers.append(dpp.deepplantpheno._cpu_clusters[2])
+    assert servers[0] is servers[1]
+
+    with pytest.raises(RuntimeError):
+        model.begin_training_with_hyperparameter_search(num_processes=2)
+
+
+def test_cpu_workers_taken_port(tiny_data_dir, tmp_path, monkeypatch):
+    import socket
+
+    model = make_tiny_regression_model(tiny_data_dir, str(tmp_path / 'saved'), num_cpu_workers=2)
+    monkeypatch.setattr(dpp.deepplantpheno, '_cpu_clusters', {})
+
+    # The first ports picked are taken by another socket before the workers can bind them, so the cluster has to be
+    # started again on new ones
+    taken = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    taken.bind(('localhost', 0))
+    taken.listen(1)
+    free_local_ports = dpp.deepplantpheno._free_local_ports
+    picks = [[taken.getsockname()[1]] * 2]
+    monkeypatch.setattr(dpp.deepplantpheno, '_free_local_ports',
+                        lambda num_ports: picks.pop() if picks else free_local_ports(num_ports))
+    try:
+        model._start_cpu_workers()
+        assert model._cluster_server is not None and not picks
+        assert str(taken.getsockname()[1]) not in model._cluster_server.target
+    finally:
+        model.shut_down()
+        taken.close()
+
+
+def test_measure_input_pipeline_throughput(tiny_data_dir, tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    model = make_tiny_regression_model(tiny_data_dir, str(tmp_path / 'saved'))
+    model.set_augmentation_flip_horizontal(True)
+    with pytest.raises(ValueError):
+        model.measure_input_pipeline_throughput(0)
+
+    num_ops = len(model._graph.get_operations())
+    throughput = model.measure_input_pipeline_throughput(num_samples=8)
+    assert [name for name, _ in throughput] == ['read', 'flip_horizontal', 'standardize', 'set_shape']
+    assert all(samples_per_sec > 0 for _, samples_per_sec in throughput)
+
+    # The measurements are built in their own graphs, so the model's graph is left as it was and can still train
+    assert len(model._graph.get_operations()) == num_ops
+    model._maximum_training_batches = 1
+    assert np.isfinite(model.begin_training(return_test_loss=True))
+
+
+def test_pickle_model_with_layers(tiny_data_dir, tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    model = make_tiny_regression_model(tiny_data_dir, str(tmp_path / 'saved'))
+    copied = pickle.loads(pickle.dumps(model))
+
+    # The layers keep their settings but none of the original graph
+    assert [type(layer) for layer in copied._layers] == [type(layer) for layer in model._layers]
+    assert copied._first_layer().filter_dimension == [3, 3, 3, 4]
+    for layer in copied._layers:
+        assert not any(isinstance(value, (tf.Tensor, tf.Variable, tf.Operation)) for value in vars(layer).values())
+    assert copied._graph is not model._graph and copied._graph_ops == {}
+    assert list(copied._raw_image_files) == list(model._raw_image_files)
+
+    # The copy builds its own graph and trains like the original would
+    copied._maximum_training_batches = 1
+    assert np.isfinite(copied.begin_training(return_test_loss=True))
+
+
+def test_hyperparameter_search_processes_failed_runs(tiny_data_dir, tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    logs = []
+    monkeypatch.setattr(dpp.RegressionModel, '_log', lambda self, message: logs.append(message))
+
+    # A file where the image cache directory should be makes every run fail as it starts training in its process
+    model = make_tiny_regression_model(tiny_data_dir, str(tmp_path / 'saved'))
+    (tmp_path / 'not_a_dir').write_text('')
+    model.set_image_cache_dir(str(tmp_path / 'not_a_dir'))
+
+    # The failed runs come back as NaN results instead of leaving the search waiting on them
+    model.begin_training_with_hyperparameter_search(lr_limits=[0.001, 0.002], num_steps=2, num_processes=2)
+    finished = [message for message in logs if message.startswith('HYPERPARAMETER SEARCH: Finished')]
+    assert len(finished) == 2
+    assert all(message.endswith('with loss nan') for message in finished)
+
+
+def test_set_fused_input_pipeline(model):
+    with pytest.raises(TypeError):
+        model.set_fused_input_pipeline(1)
+    model.set_fused_input_pipeline(True)
+    assert model._fused_input_pipeline
+
+
+def test_set_image_cache_dir(model):
+    with pytest.raises(TypeError):
+        model.set_image_cache_dir(5)
+    model.set_image_cache_dir('cache')
+    assert model._image_cache_dir == 'cache'
+    model.set_image_cache_dir(None)
+    assert model._image_cache_dir is None
+
+
+def test_load_dataset_from_records(model, tmp_path):
+    with pytest.raises(TypeError):
+        model.load_dataset_from_records(5)
+    with pytest.raises(ValueError):
+        model.load_dataset_from_records(str(tmp_path))
+    with pytest.raises(TypeError):
+        model.save_dataset_to_records(5)
+    with pytest.raises(ValueError):
+        model.save_dataset_to_records(str(tmp_path), num_shards=0)
+
+
+def _read_parsed_samples(model):
+    """Gets every (image, label) pair in a model's datasets, after only the input stage that reads them in"""
+    model._input_stage_limit = 1
+    samples = []
+    with model._graph.as_default():
+        model._graph_parse_data()
+        for dataset in [model._train_dataset, model._test_dataset, model._val_dataset]:
+            if dataset is None:
+                continue
+            next_sample = tf.data.make_one_shot_iterator(dataset).get_next()
+            while True:
+                try:
+                    samples.append(model._session.run(next_sample))
+                except tf.errors.OutOfRangeError:
+                    break
+    return samples
+
+
+@pytest.mark.parametrize('label_kind', ['encoded', 'array', 'string'])
+def test_records_round_trip(label_kind, tiny_data_dir, tmp_path, monkeypatch):
+    from PIL import Image
+
+    monkeypatch.chdir(str(tmp_path))
+    image_names = sorted(f for f in os.listdir(tiny_data_dir) if f.endswith('.png'))
+    images = {f: np.array(Image.open(os.path.join(tiny_data_dir, f))) for f in image_names}
+
+    if label_kind == 'encoded':
+        # Segmentation masks are images themselves
+        mask_dir = tmp_path / 'masks'
+        mask_dir.mkdir()
+        for f, image in images.items():
+            Image.fromarray((image[..., 0] > 127).astype(np.uint8) * 255).save(str(mask_dir / f))
+        expected_labels = {f: (image[..., 0:1] > 127).astype(np.float32) for f, image in images.items()}
+
+        def make_model():
+            model = dpp.SemanticSegmentationModel()
+            model.set_batch_size(2)
+            model.set_image_dimensions(8, 8, 3)
+            model.set_test_split(0.25)
+            model.load_dataset_from_directory_with_segmentation_masks(tiny_data_dir, str(mask_dir))
+            return model
+    else:
+        def make_model():
+            return make_tiny_regression_model(tiny_data_dir, str(tmp_path / 'saved'))
+
+        expected_labels = {'im_{}.png'.format(i): np.array([i / 8], dtype=np.float32) for i in range(8)}
+
+    model = make_model()
+    if label_kind == 'string':
+        model._raw_labels = ['plant in ' + os.path.basename(f) for f in model._raw_image_files]
+        model._split_labels = False
+        expected_labels = {f: ('plant in ' + f).encode() for f in image_names}
+
+    records_dir = str(tmp_path / 'records')
+    model.save_dataset_to_records(records_dir, num_shards=2)
+    with open(os.path.join(records_dir, 'dataset_info.json')) as f:
+        assert json.load(f)['label_kind'] == label_kind
+
+    records_model = make_model()
+    records_model.load_dataset_from_records(records_dir)
+    samples = _read_parsed_samples(records_model)
+
+    # Every sample comes back once, with its image and label the same as they were read from the original files
+    matched = []
+    for image, label in samples:
+        image = np.round(image * 255).astype(np.uint8)
+        name = next(f for f in image_names if np.array_equal(images[f], image))
+        matched.append(name)
+        if label_kind == 'string':
+            assert label == expected_labels[name]
+        else:
+            assert np.allclose(label, expected_labels[name])
+    assert sorted(matched) == image_names
+
+
+def test_records_round_trip_virtual_patches(tiny_data_dir, tmp_path, monkeypatch):
+    from PIL import Image
+
+    monkeypatch.chdir(str(tmp_path))
+    mask_dir = tmp_path / 'masks'
+    mask_dir.mkdir()
+    expected = []
+    for f in sorted(os.listdir(tiny_data_dir)):
+        if f.endswith('.png'):
+            image = np.array(Image.open(os.path.join(tiny_data_dir, f)))
+            Image.fromarray((image[..., 0] > 127).astype(np.uint8) * 255).save(str(mask_dir / f))
+            mask = (image[..., 0:1] > 127).astype(np.float32)
+            expected.extend((image[y:y + 4, x:x + 4], mask[y:y + 4, x:x + 4]) for y in [0, 4] for x in [0, 4])
+
+    def make_model():
+        model = dpp.SemanticSegmentationModel()
+        model.set_batch_size(2)
+        model.set_image_dimensions(4, 4, 3)
+        model.set_test_split(0.25)
+        return model
+
+    model = make_model()
+    model.set_patch_size(4, 4)
+    model.set_virtual_patching(True)
+    model.load_dataset_from_directory_with_segmentation_masks(tiny_data_dir, str(mask_dir))
+    records_dir = str(tmp_path / 'records')
+    model.save_dataset_to_records(records_dir, num_shards=2)
+    assert model._records_patch_dir is None
+
+    records_model = make_model()
+    records_model.load_dataset_from_records(records_dir)
+    samples = _read_parsed_samples(records_model)
+
+    # The patches are cut out of their source images, and their masks from the same place in the masks
+    assert len(samples) == len(expected)
+    for image, label in samples:
+        image = np.round(image * 255).astype(np.uint8)
+        expected_label = next(mask for patch, mask in expected if np.array_equal(patch, image))
+        assert np.array_equal(label, expected_label)
+
+
 def test_set_patch_size(model):
     with pytest.raises(TypeError):
         model.set_patch_size(1.0, 1)
@@ -417,6 +829,125 @@ def test_set_patch_size(model):
         model.set_patch_size(1, -1)
 
 
+def test_set_inference_output_file(model, tmp_path):
+    with pytest.raises(TypeError):
+        model.set_inference_output_file(5)
+
+    filename = str(tmp_path / 'outputs.npy')
+    model.set_inference_output_file(filename)
+    outputs = model._stack_inference_batches(5, (np.full([n, 2], n, dtype=np.float32) for n in [3, 2]))
+    assert isinstance(outputs, np.memmap)
+    outputs.flush()
+    assert np.array_equal(np.load(filename), [[3, 3]] * 3 + [[2, 2]] * 2)
+
+    model.set_inference_output_file(None)
+    outputs = model._stack_inference_batches(5, (np.full([n, 2], n, dtype=np.float32) for n in [3, 2]))
+    assert not isinstance(outputs, np.memmap)
+
+
+def test_update_generated_data(model, tmp_path):
+    data_dir = str(tmp_path / 'generated')
+    generated = []
+
+    def generate(indices):
+        for i in indices:
+            generated.append(i)
+            name = 'item_{}.txt'.format(i)
+            with open(os.path.join(data_dir, name), 'w') as f:
+                f.write(str(i))
+            yield {'files': [name], 'index': i}
+
+    # Everything is generated the first time, then only items with changed keys
+    keys = [model._generated_data_key([1], 'a'), model._generated_data_key([1], 'b')]
+    assert keys[0] != keys[1]
+    assert model._update_generated_data(data_dir, keys, generate) == [{'files': ['item_0.txt'], 'index': 0},
+                                                                      {'files': ['item_1.txt'], 'index': 1}]
+    assert generated == [0, 1]
+
+    generated.clear()
+    model._update_generated_data(data_dir, keys, generate)
+    assert generated == []
+
+    generated.clear()
+    keys = [keys[0], model._generated_data_key([2], 'b'), model._generated_data_key([1], 'c')]
+    entries = model._update_generated_data(data_dir, keys, generate)
+    assert generated == [1, 2]
+    assert [entry['index'] for entry in entries] == [0, 1, 2]
+
+    # Missing files and data overwriting both cause items to be generated again
+    generated.clear()
+    os.remove(os.path.join(data_dir, 'item_0.txt'))
+    model._update_generated_data(data_dir, keys, generate)
+    assert generated == [0]
+
+    generated.clear()
+    model.set_gen_data_overwrite(True)
+    model._update_generated_data(data_dir, keys, generate)
+    assert generated == [0, 1, 2]
+
+
+def test_inference_path_source(model):
+    # Filenames should be remembered in the order they're sent into the input pipeline
+    model._inference_source = (name for name in ['a.png', 'b.png', 'c.png'])
+    assert list(model._inference_path_source()) == ['a.png', 'b.png', 'c.png']
+    assert list(model._inference_paths) == ['a.png', 'b.png', 'c.png']
+
+
+def test_set_patch_overlap(model):
+    with pytest.raises(TypeError):
+        model.set_patch_overlap(1.0)
+    with pytest.raises(ValueError):
+        model.set_patch_overlap(-1)
+    with pytest.raises(TypeError):
+        model.set_patch_overlap(1, 1)
+    with pytest.raises(ValueError):
+        model.set_patch_overlap(1, 'cubic')
+
+    model.set_image_dimensions(10, 10, 1)
+    model.set_patch_size(4, 4)
+    model.set_patch_overlap(2, 'linear')
+    assert model._patch_tiling() == (4, 4, 2, 2)
+    weights = model._patch_blend_weights()
+    assert weights.shape == (4, 4, 1)
+    assert weights[0, 0, 0] == pytest.approx(1 / 9) and weights[1, 1, 0] == pytest.approx(4 / 9)
+
+    model.set_patch_overlap(4)
+    with pytest.raises(RuntimeError):
+        model._patch_tiling()
+
+
+def test_patch_settings_reset_inference_ops(model):
+    model._graph_ops['inference_init'] = 'init'
+    model._graph_ops['inference_output'] = 'output'
+    model.set_patch_size(4, 4)
+    assert 'inference_init' not in model._graph_ops and 'inference_output' not in model._graph_ops
+
+    model._graph_ops['inference_output'] = 'output'
+    model.set_patch_overlap(2)
+    assert 'inference_output' not in model._graph_ops
+
+
+@pytest.mark.parametrize('blending', ['uniform', 'linear', 'gaussian'])
+def test_blend_patches(blending):
+    model = dpp.SemanticSegmentationModel()
+    model.set_image_dimensions(10, 13, 1)
+    model.set_patch_size(4, 5)
+    model.set_patch_overlap(2, blending)
+    num_patch_rows, num_patch_cols, stride_h, stride_w = model._patch_tiling()
+
+    # Cut overlapping patches out of two known images, padded on the bottom and right as in _graph_tile_patches
+    images = np.random.RandomState(0).rand(2, 10, 13, 1).astype(np.float32)
+    padded = np.pad(images, [(0, 0), (0, 4), (0, 5), (0, 0)])
+    patches = np.stack([padded[i, y:y + 4, x:x + 5] for i in range(2)
+                        for y in range(0, num_patch_rows * stride_h, stride_h)
+                        for x in range(0, num_patch_cols * stride_w, stride_w)])
+
+    # Blending agreeing patches back together has to give back the images exactly, with no seams
+    outputs = np.zeros_like(images)
+    model._SemanticSegmentationModel__blend_patches(patches, outputs)
+    assert np.allclose(outputs, images, atol=1e-6)
+
+
 @pytest.mark.parametrize("model,bad_loss,good_loss",
                          [(dpp.ClassificationModel(), 'l2', 'softmax cross entropy'),
                           (dpp.RegressionModel(), 'softmax cross entropy', 'l2'),
@@ -479,6 +1010,42 @@ def test_set_yolo_parameters():
     model.set_yolo_parameters([13, 13], ['plant', 'knat'], [(100, 30), (200, 10), (50, 145)])
 
 
+def test_set_nms_in_graph():
+    model = dpp.ObjectDetectionModel()
+    with pytest.raises(TypeError):
+        model.set_nms_in_graph(1)
+    model.set_nms_in_graph(True)
+    assert model._nms_in_graph is True
+
+
+def test_yolo_non_max_suppression():
+    model = dpp.ObjectDetectionModel()
+    boxes = np.array([[0, 0, 10, 10], [1, 1, 11, 11], [20, 20, 30, 30]], dtype=np.float32)
+    confidences = np.array([0.7, 0.9, 0.8], dtype=np.float32)
+    maximal_idx = model._ObjectDetectionModel__non_max_suppression(boxes, confidences)
+    assert list(maximal_idx) == [1, 2]
+
+
+def test_yolo_batch_non_max_suppression():
+    model = dpp.ObjectDetectionModel()
+    model.set_yolo_thresholds(thresh_sig=0.5, thresh_overlap=0.5)
+
+    # The first image has a pair of boxes overlapping by exactly the threshold (kept) and a box overlapping by more
+    # (suppressed); the second has an insignificant box and padding boxes with no confidence
+    preds = np.array([[[0, 0, 10, 10, 0.9], [0, 0, 10, 20, 0.8], [0, 0, 10, 11, 0.7], [50, 50, 60, 60, 0.6]],
+                      [[0, 0, 10, 10, 0.4], [20, 20, 30, 30, 0.95], [0, 0, 0, 0, 0], [0, 0, 0, 0, 0]]],
+                     dtype=np.float32)
+    expected_idx = [[0, 1, 3], [1]]
+
+    maximal_idx = model._ObjectDetectionModel__batch_non_max_suppression(preds)
+    assert [list(idx) for idx in maximal_idx] == expected_idx
+
+    model.set_nms_in_graph(True)
+    model._ObjectDetectionModel__graph_non_max_suppression()
+    maximal_idx = model._ObjectDetectionModel__batch_non_max_suppression(preds)
+    assert [list(idx) for idx in maximal_idx] == expected_idx
+
+
 # adding layers may require some more indepth testing
 def test_add_input_layer(model):
     model.set_batch_size(1)
@@ -722,6 +1289,209 @@ def test_load_ippn_leaf_count_dataset_from_directory(test_data_dir):
     model.load_ippn_leaf_count_dataset_from_directory(data_path)
 
 
+def test_write_patch_container(tmp_path):
+    from deepplantphenomics.semantic_segmentation_model import _write_patch_container
+    from PIL import Image
+
+    im = np.random.randint(0, 256, [5, 7, 3], dtype=np.uint8)
+    Image.fromarray(im).save(str(tmp_path / 'im.png'))
+    container_file = str(tmp_path / 'im.npy')
+
+    # Patches are padded with black over the bottom and right edges, and grayscale patches keep a 1-channel dimension
+    _write_patch_container((str(tmp_path / 'im.png'), container_file, 'RGB', 4, 4))
+    patches = np.load(container_file)
+    assert patches.shape == (4, 4, 4, 3)
+    assert np.array_equal(patches[1, 0:4, 0:3], im[0:4, 4:7])
+    assert np.all(patches[3, 1:, :] == 0) and np.all(patches[3, :, 3:] == 0)
+    assert sorted(os.listdir(str(tmp_path))) == ['im.npy', 'im.png']  # No partly written container is left over
+
+    _write_patch_container((str(tmp_path / 'im.png'), container_file, 'L', 4, 4))
+    assert np.load(container_file).shape == (4, 4, 4, 1)
+
+    model = dpp.SemanticSegmentationModel()
+    patch = model._parse_load_patch(loaders.patch_reference(container_file, 2).encode())
+    assert patch.shape == (4, 4, 1)
+    with pytest.raises(FileNotFoundError):
+        model._parse_load_patch(loaders.patch_reference(str(tmp_path / 'missing.npy'), 0).encode())
+
+
+def test_patch_containers_threads(tiny_data_dir, tmp_path, monkeypatch):
+    from PIL import Image
+
+    mask_dir = tmp_path / 'masks'
+    mask_dir.mkdir()
+    for f in os.listdir(tiny_data_dir):
+        if f.endswith('.png'):
+            image = np.array(Image.open(os.path.join(tiny_data_dir, f)))
+            Image.fromarray((image[..., 0] > 127).astype(np.uint8) * 255).save(str(mask_dir / f))
+
+    patches = {}
+    for num_threads in [1, 2]:
+        out_dir = tmp_path / str(num_threads)
+        out_dir.mkdir()
+        monkeypatch.chdir(out_dir)
+
+        model = dpp.SemanticSegmentationModel()
+        model.set_image_dimensions(4, 4, 3)
+        model.set_patch_size(4, 4)
+        model.set_number_of_threads(num_threads)
+        model.load_dataset_from_directory_with_segmentation_masks(tiny_data_dir, str(mask_dir))
+        assert (model._patch_pool is not None) == (num_threads > 1)
+
+        # Patches from containers still being written in the background are waited on
+        references = model._raw_image_files + model._raw_labels
+        patches[num_threads] = [model._parse_load_patch(ref.encode()) for ref in references]
+        model.shut_down()
+
+    assert len(patches[1]) == len(patches[2]) == 2 * 8 * 4
+    assert all(np.array_equal(a, b) for a, b in zip(patches[1], patches[2]))
+
+
+def test_set_virtual_patching():
+    model = dpp.SemanticSegmentationModel()
+    with pytest.raises(TypeError):
+        model.set_virtual_patching(1)
+    with pytest.raises(TypeError):
+        model.set_virtual_patching(True, random_offsets=1)
+
+    model.set_virtual_patching(True, random_offsets=True)
+    assert model._virtual_patching and model._virtual_patch_random_offsets
+
+
+def test_virtual_patches(tmp_path):
+    from PIL import Image
+
+    im = np.random.randint(0, 256, [5, 7, 3], dtype=np.uint8)
+    im_file = str(tmp_path / 'im.png')
+    Image.fromarray(im).save(im_file)
+
+    model = dpp.SemanticSegmentationModel()
+    model.set_image_dimensions(4, 4, 3)
+    model.set_patch_size(4, 4)
+    images, labels = model._virtual_patch_index([im_file], [im_file])
+    assert images == [loaders.patch_reference(im_file, i) for i in range(4)]
+    assert labels == images
+
+    # Patches come from a grid over the image, or from anywhere in it when given a position
+    patch, offset = model._parse_load_virtual_patch(images[1].encode(), b'RGB', np.array([-1, -1], np.float32))
+    assert list(offset) == [0, 4]
+    assert np.array_equal(patch[:, 0:3], im[0:4, 4:7]) and np.all(patch[:, 3] == 0)
+
+    patch, offset = model._parse_load_virtual_patch(images[0].encode(), b'RGB', np.array([0.99, 0.99], np.float32))
+    assert list(offset) == [1, 3]
+    assert np.array_equal(patch, im[1:5, 3:7])
+
+
+def test_heatmap_virtual_patches_from_images(tmp_path):
+    from PIL import Image
+
+    for name in ['images', 'heatmaps']:
+        (tmp_path / name).mkdir()
+    Image.fromarray(np.zeros([5, 7, 3], dtype=np.uint8)).save(str(tmp_path / 'images' / 'im.png'))
+    Image.fromarray(np.full([5, 7], 255, dtype=np.uint8)).save(str(tmp_path / 'heatmaps' / 'im.png'))
+
+    model = dpp.HeatmapObjectCountingModel()
+    model.set_image_dimensions(4, 4, 3)
+    model.set_patch_size(4, 4)
+    model.set_virtual_patching(True)
+    model.load_dataset_from_directory_with_segmentation_masks(str(tmp_path / 'images'), str(tmp_path / 'heatmaps'))
+
+    # Heatmaps read in as images are cut out of their source images like masks instead of being treated as points
+    read_modes = []
+
+    def read_patch(reference, mode, channels):
+        read_modes.append((mode, channels))
+        return tf.fill([4, 4, 1], tf.constant(255, tf.uint8)), tf.constant([1, 3])
+
+    with model._graph.as_default():
+        labels = model._parse_virtual_patch_labels(tf.constant(model._raw_labels[0]), read_patch, tf.constant([1, 3]))
+    assert read_modes == [('L', 1)]
+    assert np.all(model._session.run(labels) == 1)
+
+
+def test_points_to_density_map():
+    from deepplantphenomics.heatmap_object_counting_model import _points_to_density_map
+    import cv2
+
+    # Gaussians fully inside the image should match one placed directly at the point, and add up for repeated points
+    heatmap = _points_to_density_map([(10, 12), (10, 12), (1, 1), (100, 100)], 20, 30, 1, 100.)
+    assert heatmap.shape == (20, 30, 1)
+    gauss = cv2.getGaussianKernel(6, 1)
+    gauss2d = gauss * gauss.T / np.sum(gauss * gauss.T) * 100.
+    assert np.allclose(heatmap[9:15, 7:13, 0], 2 * gauss2d, atol=1e-4)
+
+    # The gaussian at (1, 1) is cut off by the image border, and the one at (100, 100) is outside of it
+    assert np.sum(heatmap) == pytest.approx(200 + np.sum(gauss2d[2:, 2:]), rel=1e-4)
+    assert np.all(_points_to_density_map([], 20, 30, 1, 100.) == 0)
+
+
+def test_set_heatmaps_in_graph():
+    model = dpp.HeatmapObjectCountingModel()
+    with pytest.raises(TypeError):
+        model.set_heatmaps_in_graph(1)
+    with pytest.raises(RuntimeError):
+        model.set_augmentation_flip_horizontal(True)
+    model.set_heatmaps_in_graph(True)
+    assert model._heatmaps_in_graph is True
+
+    # Point labels can follow crops and flips, so they're allowed once the heatmaps are made in the pipeline
+    model.set_augmentation_flip_horizontal(True)
+    model.set_augmentation_flip_vertical(True)
+    model.set_augmentation_crop(True)
+    with pytest.raises(RuntimeError):
+        model.set_heatmaps_in_graph(False)
+    assert definitions.AugmentationType.CROP not in dpp.HeatmapObjectCountingModel._supported_augmentations
+
+
+def test_heatmap_flip_moves_points():
+    model = dpp.HeatmapObjectCountingModel()
+    model.set_heatmaps_in_graph(True)
+    model.set_density_map_sigma(1)
+
+    # Mark the point's pixel in the image so the flipped point can be checked against the flipped image
+    image = np.zeros([20, 30, 1], dtype=np.float32)
+    image[12, 10, 0] = 1
+    points = np.array([(10.5, 12.5), (np.nan, np.nan)], dtype=np.float32)
+
+    with model._graph.as_default():
+        images, labels = model._parse_random_flip(tf.constant(image), tf.constant(points), horizontal=True)
+        labels = model._parse_points_to_density_map(labels, 20, 30)
+    flips = 0
+    for _ in range(10):
+        flipped_image, heatmap = model._session.run([images, labels])
+        image_peak = np.unravel_index(np.argmax(flipped_image), image.shape)
+        heatmap_peak = np.unravel_index(np.argmax(heatmap), heatmap.shape)
+        assert image_peak[0] == 12 and image_peak[1] in (10, 19)
+        assert heatmap_peak[0] in (11, 12) and abs(heatmap_peak[1] - image_peak[1]) <= 1
+        flips += image_peak[1] == 19
+    assert 0 < flips < 10
+
+    # Batch augmentation flips the heatmaps made from the points with the same draws as the images
+    model.set_augmentation_flip_horizontal(True)
+    model.set_augmentation_flip_vertical(True)
+    batch = np.zeros([8, 20, 30, 1], dtype=np.float32)
+    batch[:, 12, 10, 0] = 1
+    with model._graph.as_default():
+        images, labels = model._parse_augment_batch(tf.constant(batch), tf.constant(batch))
+    images, labels = model._session.run([images, labels])
+    for flipped_image, heatmap in zip(images, labels):
+        assert np.argmax(flipped_image) == np.argmax(heatmap)
+
+
+def test_parse_points_to_density_map():
+    from deepplantphenomics.heatmap_object_counting_model import _points_to_density_map
+
+    model = dpp.HeatmapObjectCountingModel()
+    model.set_density_map_sigma(1.5)
+    points = [(10, 12), (10, 12), (1, 1), (100, 100)]
+    padded_points = np.array(points + [(np.nan, np.nan)], dtype=np.float32)
+
+    with model._graph.as_default():
+        heatmap = model._parse_points_to_density_map(tf.constant(padded_points), 20, 30)
+    heatmap = model._session.run(heatmap)
+    assert np.allclose(heatmap, _points_to_density_map(points, 20, 30, 1.5, model._multiplier), atol=1e-4)
+
+
 def test_heatmap_csv_data_load(test_data_dir):
     im_dir = os.path.join(test_data_dir, 'test_Ara2013_heatmap')
     expected_heatmap_dir = os.path.join(os.path.curdir, 'generated_heatmaps')
@@ -754,6 +1524,25 @@ def test_heatmap_csv_data_load(test_data_dir):
     shutil.rmtree(expected_heatmap_dir)
 
 
+def test_heatmap_generation_threads(test_data_dir, tmp_path, monkeypatch):
+    im_dir = os.path.abspath(os.path.join(test_data_dir, 'test_Ara2013_heatmap'))
+
+    heatmaps = {}
+    for num_threads in [1, 4]:
+        out_dir = tmp_path / str(num_threads)
+        out_dir.mkdir()
+        monkeypatch.chdir(out_dir)
+
+        model = dpp.HeatmapObjectCountingModel()
+        model.set_image_dimensions(128, 128, 3)
+        model.set_number_of_threads(num_threads)
+        model.load_heatmap_dataset_with_csv_from_directory(im_dir, 'point_labels.csv', ext='png')
+        heatmaps[num_threads] = [np.load(f) for f in model._raw_labels]
+
+    assert len(heatmaps[4]) == len(heatmaps[1])
+    assert all(np.array_equal(a, b) for a, b in zip(heatmaps[1], heatmaps[4]))
+
+
 def test_heatmap_json_data_load(test_data_dir):
     im_dir = os.path.join(test_data_dir, 'test_Ara2013_heatmap')
     expected_heatmap_dir = os.path.join(os.path.curdir, 'generated_heatmaps')
@@ -889,6 +1678,77 @@ def test_graph_problem_loss_semantic():
         assert np.allclose(out_multi, out_loss_multi, atol=0.0001)
 
 
+def test_training_batch_report_ops(model):
+    model._graph_ops = {'cost': 'cost', 'val_cost': 'val_cost', 'merged': 'merged'}
+    assert model._training_batch_report_ops() == {'cost': 'cost'}
+    model._validation = True
+    assert model._training_batch_report_ops() == {'cost': 'cost', 'val_cost': 'val_cost'}
+    assert model._training_batch_report_ops(with_summary=True) == {'cost': 'cost', 'val_cost': 'val_cost',
+                                                                   'merged': 'merged'}
+
+    model = dpp.ClassificationModel()
+    model._validation = False
+    model._graph_ops = {'cost': 'cost', 'accuracy': 'accuracy', 'val_accuracy': 'val_accuracy'}
+    assert model._training_batch_report_ops() == {'cost': 'cost', 'accuracy': 'accuracy'}
+    model._validation = True
+    assert model._training_batch_report_ops() == {'cost': 'cost', 'accuracy': 'accuracy',
+                                                  'val_accuracy': 'val_accuracy'}
+
+
+def test_tools_model_cache():
+    from deepplantphenomics.tools import _run_cached_network, _model_cache_lock
+
+    class MockNetwork(object):
+        instances = []
+
+        def __init__(self, batch_size):
+            if batch_size < 0:
+                raise ValueError("batch_size can't be negative")
+
+            # Networks are built without holding up the rest of the cache
+            assert not _model_cache_lock.locked()
+            self.batch_size = batch_size
+            self.is_shut_down = False
+            MockNetwork.instances.append(self)
+
+        def forward_pass(self, x):
+            return [self.batch_size for _ in x]
+
+        def shut_down(self):
+            self.is_shut_down = True
+
+    with pytest.raises(TypeError):
+        dpp.tools.set_model_cache_size(1.0)
+    with pytest.raises(ValueError):
+        dpp.tools.set_model_cache_size(-1)
+
+    try:
+        dpp.tools.set_model_cache_size(1)
+        assert _run_cached_network(MockNetwork, ['a', 'b'], batch_size=2) == [2, 2]
+        assert _run_cached_network(MockNetwork, ['a'], batch_size=2) == [2]
+        assert len(MockNetwork.instances) == 1
+
+        # A network with different settings is a different cache entry, evicting the least recently used one
+        _run_cached_network(MockNetwork, ['a'], batch_size=4)
+        assert len(MockNetwork.instances) == 2
+        assert MockNetwork.instances[0].is_shut_down
+        assert not MockNetwork.instances[1].is_shut_down
+
+        # A network that fails to build isn't left in the cache
+        with pytest.raises(ValueError):
+            _run_cached_network(MockNetwork, ['a'], batch_size=-1)
+        assert len(MockNetwork.instances) == 2
+        assert MockNetwork.instances[1].is_shut_down
+        with pytest.raises(ValueError):
+            _run_cached_network(MockNetwork, ['a'], batch_size=-1)
+
+        dpp.tools.set_model_cache_size(0)
+        _run_cached_network(MockNetwork, ['a'], batch_size=4)
+        assert MockNetwork.instances[2].is_shut_down
+    finally:
+        dpp.tools.set_model_cache_size(4)
+
+
 def test_det_random_mask(model, test_data_dir):
     data_path = os.path.join(test_data_dir, 'test_Ara2013_Canon', '')
 
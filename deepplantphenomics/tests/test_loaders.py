@@ -2,8 +2,11 @@ import shutil
 
 import pytest
 from unittest.mock import patch
+import io
 import os
 import numpy as np
+import tensorflow.compat.v1 as tf
+from PIL import Image
 from deepplantphenomics import loaders
 
 
@@ -62,6 +65,85 @@ def test_indices_to_onehot():
     assert np.array_equal(onehot, expected_output)
 
 
+def test_labels_to_float_array(csv_data):
+    labels = [list(x) for x in zip(csv_data['col1'], csv_data['col2'])]
+    label_array = loaders.labels_to_float_array(labels)
+    assert label_array.dtype == np.float32
+    assert label_array.shape == (10, 2)
+    assert np.array_equal(label_array[:, 1], np.arange(1, 11))
+
+    # Single values (e.g. augmentation labels) become length 1 rows
+    label_array = loaders.labels_to_float_array([['7'], '8', 6.0])
+    assert np.array_equal(label_array, np.array([[7.0], [8.0], [6.0]], dtype=np.float32))
+
+    with pytest.raises(ValueError):
+        loaders.labels_to_float_array([[1, 2], [3]])
+
+
+def test_match_ids_to_files():
+    files = ['data/snap1/VIS_SV_0.png', 'data/snap2/VIS_SV_0.png', 'data/snap1/VIS_SV_90.png', 'data/a.png',
+             'data/ba.png']
+
+    assert loaders.match_ids_to_files(['a.png', 'snap2/VIS_SV_0.png', 'ba.png'], files) == \
+        ['data/a.png', 'data/snap2/VIS_SV_0.png', 'data/ba.png']
+    assert loaders.match_ids_to_files(['SV_90.png'], files, whole_names=False) == ['data/snap1/VIS_SV_90.png']
+
+    # Every missing and duplicated ID is reported at once
+    with pytest.raises(ValueError) as err:
+        loaders.match_ids_to_files(['VIS_SV_0.png', 'b.png', 'c.png', 'a.png'], files)
+    assert "'b.png', 'c.png'" in str(err.value)
+    assert "'VIS_SV_0.png'" in str(err.value)
+    with pytest.raises(ValueError):
+        loaders.match_ids_to_files(['a.png'], files, whole_names=False)
+
+
+def test_patch_reference():
+    reference = loaders.patch_reference('C:/train_patch/im_0a1b.npy', 12)
+    assert loaders.split_patch_reference(reference) == ('C:/train_patch/im_0a1b.npy', 12)
+
+
+def test_write_records_shards(tmp_path):
+    labels = [[1, 2], [3, 4], [5, 6]]
+    info = loaders.write_records_shards(str(tmp_path), 'train', ['a', 'b', 'c'], labels, 2)
+
+    assert info['shards'] == ['train-00000-of-00002.tfrecord', 'train-00001-of-00002.tfrecord']
+    assert info['num_samples'] == 3
+    assert info['image_kind'] == 'string' and info['label_kind'] == 'array'
+    assert info['label_shape'] == [2]
+
+    records = [r for f in info['shards'] for r in tf.io.tf_record_iterator(str(tmp_path / f))]
+    assert len(records) == 3
+    example = tf.train.Example.FromString(records[2])
+    assert example.features.feature['image'].bytes_list.value[0] == b'c'
+    label = np.frombuffer(example.features.feature['label'].bytes_list.value[0], dtype=np.float32)
+    assert np.all(label == [5, 6])
+
+    with pytest.raises(ValueError):
+        loaders.write_records_shards(str(tmp_path), 'test', ['a'], [], 2)
+
+
+def test_write_records_shards_patch_references(tmp_path):
+    container_file = str(tmp_path / 'im.npy')
+    patches = np.random.RandomState(0).randint(0, 256, [2, 4, 5, 3]).astype(np.uint8)
+    masks = (patches[..., 0:1] > 127).astype(np.uint8) * 255
+    np.save(container_file, patches)
+    np.save(str(tmp_path / 'im_mask.npy'), masks)
+
+    images = [loaders.patch_reference(container_file, i) for i in range(2)]
+    labels = [loaders.patch_reference(str(tmp_path / 'im_mask.npy'), i) for i in range(2)]
+    info = loaders.write_records_shards(str(tmp_path), 'train', images, labels, 1)
+    assert info['image_kind'] == 'encoded'
+    assert info['label_kind'] == 'encoded'
+
+    # Patches are stored as PNGs, which are decoded back into the same patches
+    records = list(tf.io.tf_record_iterator(str(tmp_path / info['shards'][0])))
+    example = tf.train.Example.FromString(records[1])
+    image = Image.open(io.BytesIO(example.features.feature['image'].bytes_list.value[0]))
+    mask = Image.open(io.BytesIO(example.features.feature['label'].bytes_list.value[0]))
+    assert np.array_equal(np.array(image), patches[1])
+    assert np.array_equal(np.array(mask), masks[1, ..., 0])
+
+
 def test_get_split_mask():
     test_mask_name = os.path.join(os.path.curdir, 'mask_ckpt.txt')
     if os.path.exists(test_mask_name):
@@ -0,0 +1,41 @@
+import pytest
+import numpy as np
+from deepplantphenomics import metrics
+
+
+def test_streaming_statistics():
+    values = np.random.RandomState(0).normal(5, 2, size=1000)
+    stats = metrics.StreamingStatistics()
+    for batch in np.array_split(values, 7):
+        stats.update(batch)
+
+    assert stats.count == 1000
+    assert stats.mean == pytest.approx(np.mean(values))
+    assert stats.variance == pytest.approx(np.var(values))
+    assert stats.sum_squares == pytest.approx(np.sum(np.square(values)))
+    assert stats.sum_squared_deviations == pytest.approx(np.sum(np.square(values - np.mean(values))))
+    assert stats.min == np.min(values) and stats.max == np.max(values)
+
+
+def test_streaming_histogram():
+    hist = metrics.StreamingHistogram(num_bins=10)
+    hist.update([0, 1])
+    hist.update([-3, 5, 5])
+
+    assert np.sum(hist.counts) == 5
+    edges = hist.bin_edges
+    assert edges[0] <= -3 and edges[-1] >= 5
+    assert np.all(hist.counts == np.histogram([0, 1, -3, 5, 5], bins=edges)[0])
+
+    with pytest.raises(ValueError):
+        metrics.StreamingHistogram(num_bins=5)
+
+
+def test_streaming_average_precision():
+    ap = metrics.StreamingAveragePrecision()
+    assert ap.average_precision() == 0
+
+    # Two of three objects are found by the two most confident detections, then there's a false positive
+    ap.update([0.9, 0.3], [True, False], num_truths=2)
+    ap.update([0.8], [True], num_truths=1)
+    assert ap.average_precision() == pytest.approx(2 / 3)
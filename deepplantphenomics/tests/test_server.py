@@ -0,0 +1,102 @@
+import json
+import time
+import threading
+import urllib.error
+import urllib.request
+import pytest
+from deepplantphenomics.server import InferenceServer
+
+
+class _FileSizeModel(object):
+    """Stands in for a trained model by 'predicting' the size of each image file"""
+
+    _batch_size = 4
+
+    def __init__(self):
+        self.batches = []
+
+    def forward_pass_with_interpreted_outputs(self, x):
+        self.batches.append(len(x))
+        sizes = []
+        for filename in x:
+            with open(filename, 'rb') as f:
+                sizes.append(len(f.read()))
+        return sizes
+
+
+class _BrokenModel(_FileSizeModel):
+    """Drops the last output of each batch, or takes too long to run it when slow"""
+
+    def __init__(self, slow=False):
+        super().__init__()
+        self.slow = slow
+
+    def forward_pass_with_interpreted_outputs(self, x):
+        if self.slow:
+            time.sleep(1)
+        return super().forward_pass_with_interpreted_outputs(x)[:-1]
+
+
+@pytest.fixture()
+def server():
+    server = InferenceServer(_FileSizeModel(), port=0, max_latency=0.5)
+    server.start()
+    yield server
+    server.shut_down()
+
+
+def _post(server, body):
+    url = 'http://127.0.0.1:{}/predict'.format(server.address[1])
+    with urllib.request.urlopen(urllib.request.Request(url, data=body, method='POST')) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def test_inference_server_batches_requests(server):
+    results = {}
+
+    def post(n):
+        results[n] = _post(server, b'x' * n)['prediction']
+
+    threads = [threading.Thread(target=post, args=(n,)) for n in range(1, 5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # Every request gets its own output back, and the concurrent requests share batches
+    assert results == {1: 1, 2: 2, 3: 3, 4: 4}
+    assert sum(server.model.batches) == 4 and len(server.model.batches) < 4
+
+    url = 'http://127.0.0.1:{}/metrics'.format(server.address[1])
+    with urllib.request.urlopen(url) as response:
+        server_metrics = json.loads(response.read().decode('utf-8'))
+    assert server_metrics['requests'] == 4
+    assert server_metrics['queue_depth'] == 0
+    assert server_metrics['batches'] == len(server.model.batches)
+    assert server_metrics['max_latency'] >= server_metrics['mean_latency'] > 0
+
+
+def test_inference_server_settings():
+    with pytest.raises(TypeError):
+        InferenceServer(_FileSizeModel(), port='8000')
+    with pytest.raises(ValueError):
+        InferenceServer(_FileSizeModel(), max_batch_size=0)
+    with pytest.raises(ValueError):
+        InferenceServer(_FileSizeModel(), max_latency=-1)
+    with pytest.raises(TypeError):
+        InferenceServer(_FileSizeModel(), request_timeout='60')
+    with pytest.raises(ValueError):
+        InferenceServer(_FileSizeModel(), request_timeout=0)
+
+
+@pytest.mark.parametrize('slow, code', [(False, 500), (True, 504)])
+def test_inference_server_failed_batches(slow, code):
+    server = InferenceServer(_BrokenModel(slow), port=0, max_latency=0, request_timeout=0.2)
+    server.start()
+    try:
+        # A batch with a missing output fails every request in it instead of leaving one waiting forever
+        with pytest.raises(urllib.error.HTTPError) as e:
+            _post(server, b'x')
+        assert e.value.code == code
+    finally:
+        server.shut_down()
@@ -1,6 +1,78 @@
 from . import networks
 import numpy as np
 import cv2
+import threading
+from collections import OrderedDict
+
+# Networks built by the tools are kept loaded between calls, keyed by their class and constructor arguments, so that
+# repeated calls don't rebuild the graph and restore the checkpoint each time. The least recently used networks are shut
+# down once there are more than _model_cache_size of them.
+_model_cache = OrderedDict()
+_model_cache_lock = threading.Lock()
+_model_cache_size = 4
+
+
+class _cachedNetwork(object):
+    """
+    A pre-trained network in the model cache, with a lock so only one thread at a time builds or uses it. Entries go
+    into the cache before their network is built, so that building one network doesn't hold up the rest of the cache.
+    """
+
+    def __init__(self):
+        self.net = None
+        self.lock = threading.Lock()
+        self.is_shut_down = False
+
+    def shut_down(self):
+        with self.lock:
+            if not self.is_shut_down:
+                if self.net is not None:
+                    self.net.shut_down()
+                self.is_shut_down = True
+
+
+def _run_cached_network(network_class, x, **kwargs):
+    """
+    Runs a forward pass with a pre-trained network from the model cache, building (and caching) it first if needed
+    :param network_class: The class of the network in `networks` to use
+    :param x: The list of image filenames to do the forward pass on
+    :param kwargs: The constructor arguments for the network
+    :return: The outputs from the network's forward pass
+    """
+    key = (network_class.__name__, tuple(sorted(kwargs.items())))
+
+    while True:
+        evicted = []
+        with _model_cache_lock:
+            cached = _model_cache.get(key)
+            if cached is None:
+                cached = _cachedNetwork()
+                _model_cache[key] = cached
+            _model_cache.move_to_end(key)
+            while len(_model_cache) > _model_cache_size:
+                evicted.append(_model_cache.popitem(last=False)[1])
+
+        try:
+            with cached.lock:
+                # The network may have been evicted and shut down by another thread while waiting for the lock
+                if cached.is_shut_down:
+                    continue
+
+                if cached.net is None:
+                    try:
+                        cached.net = network_class(**kwargs)
+                    except Exception:
+                        # Drop the entry so that the next call tries to build the network again
+                        cached.is_shut_down = True
+                        with _model_cache_lock:
+                            if _model_cache.get(key) is cached:
+                                del _model_cache[key]
+                        raise
+
+                return cached.net.forward_pass(x)
+        finally:
+            for old in evicted:
+                old.shut_down()
 
 
 class tools(object):
@@ -8,16 +80,43 @@ class tools(object):
     Provides stand-alone phenotyping tools which can be called statically.
     """
 
+    @staticmethod
+    def set_model_cache_size(size):
+        """
+        Sets how many pre-trained networks are kept loaded between calls to the tools. The least recently used
+        networks are shut down when the limit is exceeded. A size of 0 shuts down every network after each call.
+        """
+        global _model_cache_size
+
+        if not isinstance(size, int):
+            raise TypeError("size must be an int")
+        if size < 0:
+            raise ValueError("size must be non-negative")
+
+        with _model_cache_lock:
+            _model_cache_size = size
+        tools.clear_model_cache(keep=size)
+
+    @staticmethod
+    def clear_model_cache(keep=0):
+        """
+        Shuts down the pre-trained networks kept loaded by the tools, apart from the `keep` most recently used ones
+        """
+        evicted = []
+        with _model_cache_lock:
+            while len(_model_cache) > keep:
+                evicted.append(_model_cache.popitem(last=False)[1])
+
+        for cached in evicted:
+            cached.shut_down()
+
     @staticmethod
     def predict_rosette_leaf_count(x, batch_size=8):
         """
         Uses a pre-trained network to predict the number of leaves on rosette plants.
         Images are input as a list of filenames.
         """
-
-        net = networks.rosetteLeafRegressor(batch_size=batch_size)
-        predictions = net.forward_pass(x)
-        net.shut_down()
+        predictions = _run_cached_network(networks.rosetteLeafRegressor, x, batch_size=batch_size)
 
         # round for leaf counts
         predictions = np.round(predictions)
@@ -29,9 +128,7 @@ class tools(object):
         """
         Uses a pre-trained fully convolutional network to perform vegetation segmentation
         """
-        net = networks.vegetationSegmentationNetwork(batch_size=batch_size)
-        predictions = net.forward_pass(x)
-        net.shut_down()
+        predictions = _run_cached_network(networks.vegetationSegmentationNetwork, x, batch_size=batch_size)
 
         # round for binary mask
         predictions = predictions.astype(np.float32)
@@ -43,11 +140,9 @@ class tools(object):
 
     @staticmethod
     def count_canola_flowers(x, batch_size=1, image_height=300, image_width=300, image_depth=3):
-
-        net = networks.countCeptionCounter(
-            batch_size=batch_size, image_height=image_height, image_width=image_width, image_depth=image_depth)
-        predictions = net.forward_pass(x)
-        net.shut_down()
+        predictions = _run_cached_network(networks.countCeptionCounter, x, batch_size=batch_size,
+                                          image_height=image_height, image_width=image_width,
+                                          image_depth=image_depth)
 
         # round for counts
         predictions = np.round(predictions)
@@ -5,6 +5,7 @@ setup(
     version='',
     packages=['deepplantphenomics'],
     package_data={'deepplantphenomics': ['network_states/*', 'network_states/**/*']},
+    entry_points={'console_scripts': ['dpp = deepplantphenomics.server:main']},
     url='',
     license='MIT',
     author='Jordan Ubbens',